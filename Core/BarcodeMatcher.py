@@ -0,0 +1,1011 @@
+import hashlib
+import itertools
+import os
+import pathlib
+import pickle
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from Core.FastqIO import BASE_CODES, PAD_CODE, encode_sequences
+
+try:
+    import ahocorasick  # pyahocorasick; optional C implementation of the automaton
+except ImportError:
+    ahocorasick = None
+
+NO_MATCH = -1
+MULTI_HIT = -2  # Several barcodes, see AhoCorasickMatcher._build
+STRANDS = ["forward", "reverse", "both"]
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+# Bump when the pickled BarcodeIndex layout changes, invalidates the cache
+INDEX_VERSION = 2
+
+
+def load_barcodes(barcode_file: pathlib.Path, sep=":") -> pd.DataFrame:
+    """
+    > Load a barcode file into a Gene/Barcode dataframe, keeping the file order
+
+    :param barcode_file: the barcode file, one "Gene{sep}Barcode" entry per line
+    :type barcode_file: pathlib.Path
+    :param sep: separator character of the barcode file
+    :return: A dataframe with Gene and Barcode columns, barcodes are unique and upper-cased
+    """
+    barcode_df = pd.read_csv(
+        barcode_file, sep=sep, header=None, names=["Gene", "Barcode"]
+    ).iloc[
+        :, [0, 1]
+    ]  # Use only Gene and Barcode columns
+    if not barcode_df["Barcode"].is_unique:
+        # Barcode used as a PK in the database, so duplication is not allowed
+        print("Barcode duplication detected!")
+        print("Remove duplicated Barcodes... only the first one will be kept.")
+        barcode_df.drop_duplicates(subset=["Barcode"], keep="first", inplace=True)
+
+    barcode_df["Barcode"] = barcode_df["Barcode"].str.upper()
+
+    return barcode_df
+
+
+def hamming_neighbors(barcode: str, max_mismatch: int, alphabet="ACGTN"):
+    """
+    > Generate every sequence within max_mismatch substitutions of the barcode
+
+    :param barcode: the barcode sequence
+    :param max_mismatch: the maximum number of substituted positions
+    :param alphabet: the bases a position can be substituted with
+    :return: A generator of (sequence, number of mismatches), each sequence only once
+    """
+    yield barcode, 0
+    for n_mismatch in range(1, max_mismatch + 1):
+        for positions in itertools.combinations(range(len(barcode)), n_mismatch):
+            substitutions = [
+                [base for base in alphabet if base != barcode[pos]] for pos in positions
+            ]
+            for bases in itertools.product(*substitutions):
+                neighbor = list(barcode)
+                for pos, base in zip(positions, bases):
+                    neighbor[pos] = base
+                yield "".join(neighbor), n_mismatch
+
+
+class NeighborhoodIndex(object):
+    """
+    > Precomputed Hamming neighborhood of the barcode library
+
+    Every sequence within max_mismatch substitutions of a barcode is mapped to a rank,
+    n_mismatch * n_barcodes + barcode index, so the smallest rank is the barcode with the
+    fewest mismatches and then the first one in the file order. A neighbor shared by two
+    barcodes is a collision: it is kept for the closer barcode and dropped when both are
+    at the same distance, as the read cannot be assigned unambiguously.
+    """
+
+    def __init__(self, barcodes: list, max_mismatch=1):
+        self.n_barcodes = len(barcodes)
+        self.max_mismatch = max_mismatch
+        self.index = {}
+        # (neighbor, barcode index, barcode index, mismatches, mismatches)
+        self.collisions = []
+
+        ambiguous = set()
+        for idx, barcode in enumerate(barcodes):
+            for neighbor, n_mismatch in hamming_neighbors(barcode, max_mismatch):
+                rank = n_mismatch * self.n_barcodes + idx
+                prev_rank = self.index.get(neighbor)
+                if prev_rank is None:
+                    self.index[neighbor] = rank
+                    continue
+
+                prev_mismatch, prev_idx = divmod(prev_rank, self.n_barcodes)
+                self.collisions.append(
+                    (neighbor, prev_idx, idx, prev_mismatch, n_mismatch)
+                )
+                if n_mismatch < prev_mismatch:
+                    self.index[neighbor] = rank
+                    ambiguous.discard(neighbor)
+                elif n_mismatch == prev_mismatch:
+                    ambiguous.add(neighbor)
+
+        for neighbor in ambiguous:
+            del self.index[neighbor]
+        self.n_ambiguous = len(ambiguous)
+
+    def collision_report(self, barcodes: list) -> pd.DataFrame:
+        """
+        > Tabulate the neighbors shared between barcodes
+
+        :param barcodes: the barcode list the index was built from
+        :return: A dataframe with one row per collision
+        """
+        return pd.DataFrame(
+            [
+                (neighbor, barcodes[idx_a], barcodes[idx_b], mm_a, mm_b, mm_a == mm_b)
+                for neighbor, idx_a, idx_b, mm_a, mm_b in self.collisions
+            ],
+            columns=[
+                "Neighbor",
+                "Barcode_A",
+                "Barcode_B",
+                "Mismatch_A",
+                "Mismatch_B",
+                "Dropped",
+            ],
+        )
+
+
+def reverse_complement(seq: str) -> str:
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def stranded_ranks(ranks: dict, n_barcodes: int, strand="forward"):
+    """
+    > Orient the patterns of a library like the reads
+
+    The reverse complement of a pattern keeps its rank, so a read of the other strand
+    is assigned to the same barcode with the same number of mismatches. On both strands
+    a sequence claimed by two barcodes at the same distance is ambiguous and dropped,
+    as in NeighborhoodIndex.
+
+    :param ranks: the pattern -> rank dict of the forward strand
+    :param n_barcodes: the number of barcodes of the library
+    :param strand: forward, reverse or both
+    :return: The pattern -> rank dict of the reads, and the number of ambiguous patterns
+    """
+    if strand == "forward":
+        return ranks, 0
+    reverse = {reverse_complement(pattern): rank for pattern, rank in ranks.items()}
+    if strand == "reverse":
+        return reverse, 0
+
+    both, ambiguous = dict(ranks), set()
+    for pattern, rank in reverse.items():
+        prev_rank = both.get(pattern)
+        if prev_rank is None or prev_rank == rank:
+            both[pattern] = rank
+        elif rank // n_barcodes < prev_rank // n_barcodes:
+            both[pattern] = rank
+            ambiguous.discard(pattern)
+        elif rank // n_barcodes == prev_rank // n_barcodes:
+            ambiguous.add(pattern)
+    for pattern in ambiguous:
+        del both[pattern]
+    return both, len(ambiguous)
+
+
+def _reverse_anchors(anchors: tuple) -> tuple:
+    # The downstream region of the barcode comes first on the reverse strand
+    return reverse_complement(anchors[1]), reverse_complement(anchors[0])
+
+
+def _exact_ranks(barcodes: list, max_mismatch: int, ranks=None) -> dict:
+    if ranks is not None:
+        return ranks
+    if max_mismatch > 0:
+        return NeighborhoodIndex(barcodes, max_mismatch).index
+    return {barcode: idx for idx, barcode in enumerate(barcodes)}
+
+
+class _RankedMatcher(object):
+    # Common bookkeeping of the matchers looking up ranks, see NeighborhoodIndex
+
+    def __init__(self, barcodes: list, max_mismatch=0):
+        self.n_barcodes = len(barcodes)
+        self.max_mismatch = max_mismatch
+        self._no_hit = (max_mismatch + 1) * max(self.n_barcodes, 1)
+        self.mismatched = 0  # Reads assigned with at least one mismatch
+        self.multi_hit = 0  # Reads containing several distinct barcodes
+
+    def reset_counters(self):
+        # The matcher outlives a chunk in the workers, counters are reported per chunk
+        self.mismatched = 0
+        self.multi_hit = 0
+
+    def _to_assignment(self, ranks: list, multi=None) -> np.ndarray:
+        # multi flags the reads hitting several barcodes, see _multi_hits
+        ranks = np.asarray(ranks, dtype=np.int64)
+        detected = ranks < self._no_hit
+        self.mismatched += int((detected & (ranks >= self.n_barcodes)).sum())
+        if multi is not None:
+            self.multi_hit += int(np.count_nonzero(multi))
+
+        assignment = np.full(ranks.shape[0], NO_MATCH, dtype=np.int32)
+        assignment[detected] = ranks[detected] % self.n_barcodes
+        return assignment
+
+    def _multi_hits(self, n_sequences: int, reads, ranks) -> np.ndarray:
+        # The reads whose hits name at least two different barcodes
+        n_barcodes = max(self.n_barcodes, 1)
+        barcodes = np.asarray(ranks, dtype=np.int64) % n_barcodes
+        lowest = np.full(n_sequences, n_barcodes, dtype=np.int64)
+        highest = np.full(n_sequences, -1, dtype=np.int64)
+        np.minimum.at(lowest, reads, barcodes)
+        np.maximum.at(highest, reads, barcodes)
+        return highest > lowest
+
+    def match_hits(self, sequences):
+        """
+        > Assign each read like match(), and also report every barcode found in it
+
+        :param sequences: a list of read sequences
+        :return: The int32 assignment array, then the read positions (int32), barcode
+            indices (int32) and mismatches (int8) of the hits, one per (read, barcode)
+        """
+        reads, ranks = self._hit_ranks(sequences)
+        return self._hits(len(sequences), reads, ranks)
+
+    def _hits(self, n_sequences: int, reads, ranks):
+        reads = np.asarray(reads, dtype=np.int32)
+        ranks = np.asarray(ranks, dtype=np.int64)
+
+        best = np.full(n_sequences, self._no_hit, dtype=np.int64)
+        np.minimum.at(best, reads, ranks)
+        assignment = self._to_assignment(best)
+
+        barcodes = (ranks % max(self.n_barcodes, 1)).astype(np.int32)
+        mismatches = (ranks // max(self.n_barcodes, 1)).astype(np.int8)
+        # Keep one hit per (read, barcode), the one with the fewest mismatches
+        order = np.lexsort((ranks, barcodes, reads))
+        reads, barcodes, mismatches = reads[order], barcodes[order], mismatches[order]
+        first = np.ones(reads.shape[0], dtype=bool)
+        first[1:] = (reads[1:] != reads[:-1]) | (barcodes[1:] != barcodes[:-1])
+        reads, barcodes, mismatches = reads[first], barcodes[first], mismatches[first]
+
+        # The second hit of a read starts a run of repeated read positions
+        repeated = np.zeros(reads.shape[0], dtype=bool)
+        repeated[1:] = reads[1:] == reads[:-1]
+        self.multi_hit += int((repeated[1:] & ~repeated[:-1]).sum())
+
+        return assignment, reads, barcodes, mismatches
+
+
+class AhoCorasickMatcher(_RankedMatcher):
+    """
+    > Multi-pattern matcher scanning each read once for every barcode of the library
+
+    A read is assigned to the barcode that comes first in the file order among all the
+    barcodes it contains, which is what the drop-based str.contains loop produces.
+    With max_mismatch > 0 the Hamming neighbors of the barcodes are added to the
+    automaton, and the barcode with the fewest mismatches wins.
+    """
+
+    def __init__(self, barcodes: list, max_mismatch=0, ranks=None):
+        super().__init__(barcodes, max_mismatch)
+        patterns = _exact_ranks(barcodes, max_mismatch, ranks)
+
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for pattern, rank in patterns.items():
+                self._automaton.add_word(pattern, rank)
+            self._automaton.make_automaton()
+        else:
+            self._automaton = None
+            self._build(patterns)
+
+    def _build(self, patterns: dict):
+        # Trie: goto[node] = {char: child}, best[node] = the smallest rank ending here
+        # or at any suffix; own[node] and link[node] (the nearest suffix with an output)
+        # enumerate every hit for match_hits
+        goto = [{}]
+        best = [self._no_hit]
+        for pattern, rank in patterns.items():
+            node = 0
+            for char in pattern:
+                if char not in goto[node]:
+                    goto[node][char] = len(goto)
+                    goto.append({})
+                    best.append(self._no_hit)
+                node = goto[node][char]
+            best[node] = min(best[node], rank)
+
+        # BFS over the trie turns it into a complete DFA over the barcode alphabet,
+        # so scanning a read costs one dict lookup per base
+        alphabet = {char for pattern in patterns for char in pattern}
+        own = list(best)
+        link = [0] * len(goto)
+        fail = [0] * len(goto)
+        delta = [dict() for _ in goto]
+        queue = deque()
+        for char in alphabet:
+            child = goto[0].get(char)
+            if child is None:
+                delta[0][char] = 0
+            else:
+                delta[0][char] = child
+                queue.append(child)
+
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            best[node] = min(best[node], best[fail[node]])
+            for char in alphabet:
+                child = goto[node].get(char)
+                if child is None:
+                    delta[node][char] = delta[fail[node]][char]
+                else:
+                    fail[child] = delta[fail[node]][char]
+                    delta[node][char] = child
+                    queue.append(child)
+                    suffix = fail[child]
+                    link[child] = suffix if own[suffix] < self._no_hit else link[suffix]
+
+        # barcodes[node]: the barcode of every hit ending at the node, MULTI_HIT when they
+        # name several; the suffixes come first in the BFS order
+        n_barcodes = max(self.n_barcodes, 1)
+        barcodes = [NO_MATCH] * len(goto)
+        for node in order:
+            suffix = barcodes[link[node]]
+            if own[node] >= self._no_hit:
+                barcodes[node] = suffix
+            elif suffix in (NO_MATCH, own[node] % n_barcodes):
+                barcodes[node] = own[node] % n_barcodes
+            else:
+                barcodes[node] = MULTI_HIT
+
+        self._delta = delta
+        self._best = best
+        self._own = own
+        self._link = link
+        self._barcodes = barcodes
+
+    def match(self, sequences) -> np.ndarray:
+        """
+        > Assign each read to the first barcode (file order) found in it
+
+        :param sequences: an iterable of read sequences
+        :return: An int32 array of barcode indices, NO_MATCH for the undetected reads
+        """
+        return self._to_assignment(*self._best_ranks(sequences))
+
+    def _best_ranks(self, sequences):
+        # The lowest rank found in every read and whether it hits several barcodes, see
+        # Core.ReadCollapser
+        if self._automaton is not None:
+            return self._automaton_ranks(sequences)
+
+        delta, best, barcodes, no_hit = (
+            self._delta,
+            self._best,
+            self._barcodes,
+            self._no_hit,
+        )
+        ranks, multi = [], []
+        for seq in sequences:
+            state, hit, first, several = 0, no_hit, NO_MATCH, False
+            for char in seq:
+                state = delta[state].get(char, 0)
+                if best[state] < no_hit:
+                    barcode = barcodes[state]
+                    if barcode != first:
+                        several |= first != NO_MATCH or barcode == MULTI_HIT
+                        first = barcode
+                    if best[state] < hit:
+                        hit = best[state]
+                    if hit == 0 and several:
+                        break
+            ranks.append(hit)
+            multi.append(several)
+
+        return np.asarray(ranks, dtype=np.int64), np.asarray(multi, dtype=bool)
+
+    def _automaton_ranks(self, sequences):
+        n_barcodes = max(self.n_barcodes, 1)
+        ranks, multi = [], []
+        for seq in sequences:
+            hit, first, several = self._no_hit, NO_MATCH, False
+            for _, rank in self._automaton.iter(seq):
+                if rank < hit:
+                    hit = rank
+                if first == NO_MATCH:
+                    first = rank % n_barcodes
+                elif rank % n_barcodes != first:
+                    several = True
+            ranks.append(hit)
+            multi.append(several)
+
+        return np.asarray(ranks, dtype=np.int64), np.asarray(multi, dtype=bool)
+
+    def _hit_ranks(self, sequences):
+        reads, ranks = [], []
+        if self._automaton is not None:
+            for read, seq in enumerate(sequences):
+                for _, rank in self._automaton.iter(seq):
+                    reads.append(read)
+                    ranks.append(rank)
+            return reads, ranks
+
+        delta, own, link = self._delta, self._own, self._link
+        for read, seq in enumerate(sequences):
+            state = 0
+            for char in seq:
+                state = delta[state].get(char, 0)
+                node = state if own[state] < self._no_hit else link[state]
+                while node:
+                    reads.append(read)
+                    ranks.append(own[node])
+                    node = link[node]
+        return reads, ranks
+
+
+class KmerMatcher(_RankedMatcher):
+    """
+    > Vectorized lookup of every k-mer of the reads in the sorted barcode hashes
+
+    A batch is encoded into a uint8 matrix of 3-bit base codes and the hashes of all
+    the k-mers are built from shifted column slices, one pass for every barcode length.
+    A hashed bitmap of the patterns discards most windows, the rest is looked up with
+    np.searchsorted, so no Python loop runs over the bases. The assignment is the same
+    as the AhoCorasickMatcher one.
+    """
+
+    MAX_LENGTH = 21  # 3 bits per base in a uint64 hash
+    _MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)  # Fibonacci hashing into the bitmap
+
+    def __init__(self, barcodes: list, max_mismatch=0, ranks=None):
+        super().__init__(barcodes, max_mismatch)
+        patterns = _exact_ranks(barcodes, max_mismatch, ranks)
+
+        by_length = {}
+        for pattern, rank in patterns.items():
+            if len(pattern) > self.MAX_LENGTH or set(pattern) - set("ACGTN"):
+                raise ValueError(
+                    f"The vectorized engine supports ACGTN barcodes of up to "
+                    f"{self.MAX_LENGTH} bases: {pattern}"
+                )
+            by_length.setdefault(len(pattern), []).append((kmer_hash(pattern), rank))
+
+        # k -> (sorted hashes, ranks in the same order)
+        self.tables = {}
+        for k, pairs in sorted(by_length.items()):
+            hashes, pattern_ranks = (np.array(column) for column in zip(*pairs))
+            order = np.argsort(hashes)
+            self.tables[k] = (hashes[order].astype(np.uint64), pattern_ranks[order])
+
+        # At most 1/8 of the bitmap is set, whatever the number of patterns
+        self._bits = int(min(max(8 * len(patterns), 1 << 12), 1 << 24) - 1).bit_length()
+        self._bitmap = np.zeros(1 << self._bits, dtype=bool)
+        for hashes, _ in self.tables.values():
+            self._bitmap[self._slot(hashes)] = True
+
+    def _slot(self, hashes: np.ndarray) -> np.ndarray:
+        return (hashes * self._MULTIPLIER) >> np.uint64(64 - self._bits)
+
+    def _window_hits(self, sequences):
+        # (reads, ranks) of the k-mer windows found in the patterns, one pair per k
+        if not self.tables:
+            return
+        matrix, _ = encode_sequences(sequences)
+        width = matrix.shape[1]
+        # Windows running past the end of a read hold padding and never match
+        matrix = np.pad(
+            matrix, ((0, 0), (0, max(self.tables) - 1)), constant_values=PAD_CODE
+        )
+
+        window_hashes = np.zeros((matrix.shape[0], width), dtype=np.uint64)
+        for pos in range(max(self.tables)):
+            window_hashes <<= np.uint64(3)
+            window_hashes |= matrix[:, pos : pos + width]
+            if pos + 1 not in self.tables:
+                continue
+
+            hashes, pattern_ranks = self.tables[pos + 1]
+            flat_hashes = window_hashes.ravel()
+            candidates = np.flatnonzero(self._bitmap[self._slot(flat_hashes)])
+            found = np.minimum(
+                np.searchsorted(hashes, flat_hashes[candidates]), hashes.shape[0] - 1
+            )
+            hit = hashes[found] == flat_hashes[candidates]
+            yield candidates[hit] // max(width, 1), pattern_ranks[found[hit]]
+
+    def match(self, sequences) -> np.ndarray:
+        """
+        > Assign each read to the first barcode (file order) found in it
+
+        :param sequences: a list of read sequences
+        :return: An int32 array of barcode indices, NO_MATCH for the undetected reads
+        """
+        return self._to_assignment(*self._best_ranks(sequences))
+
+    def _best_ranks(self, sequences):
+        reads, ranks = self._hit_ranks(sequences)
+        best = np.full(len(sequences), self._no_hit, dtype=np.int64)
+        np.minimum.at(best, reads, ranks)
+        return best, self._multi_hits(len(sequences), reads, ranks)
+
+    def _hit_ranks(self, sequences):
+        reads, ranks = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for window_reads, window_ranks in self._window_hits(sequences):
+            reads.append(window_reads)
+            ranks.append(window_ranks)
+        return np.concatenate(reads), np.concatenate(ranks)
+
+
+def kmer_hash(sequence: str) -> int:
+    # 3 bits per base, see Core.FastqIO.BASE_CODES
+    value = 0
+    for code in BASE_CODES[np.frombuffer(sequence.encode("ascii"), np.uint8)]:
+        value = (value << 3) | int(code)
+    return value
+
+
+class PositionMatcher(_RankedMatcher):
+    """
+    > Hash lookup of the barcode window at a known position of the read
+
+    The window is either sliced at a fixed offset or located between the upstream and
+    downstream constant regions (anchors), then looked up in a dict built from the
+    barcode file, so the cost does not depend on the library size.
+    """
+
+    def __init__(
+        self,
+        barcodes: list,
+        offset: int = None,
+        upstream="",
+        downstream="",
+        max_mismatch=0,
+        ranks=None,
+    ):
+        if offset is None and not (upstream or downstream):
+            raise ValueError("Barcode offset or anchor sequences are required")
+
+        super().__init__(barcodes, max_mismatch)
+        self.offset = offset
+        self.upstream = upstream.upper() if upstream else ""
+        self.downstream = downstream.upper() if downstream else ""
+        self.index = _exact_ranks(barcodes, max_mismatch, ranks)
+        self.lengths = sorted({len(barcode) for barcode in barcodes})
+        self.unlocated = 0  # Reads whose barcode window could not be located
+
+    def reset_counters(self):
+        super().reset_counters()
+        self.unlocated = 0
+
+    def _locate(self, seq: str):
+        # (start, end) of the barcode window, either side is None when it is not fixed
+        if self.offset is not None:
+            return self.offset, None
+
+        start = None
+        if self.upstream:
+            pos = seq.find(self.upstream)
+            if pos < 0:
+                return None, None
+            start = pos + len(self.upstream)
+        if self.downstream:
+            pos = seq.find(self.downstream, start or 0)
+            if pos < 0:
+                return None, None
+            return start, pos
+
+        return start, None
+
+    def _lookup(self, seq: str) -> int:
+        start, end = self._locate(seq)
+        if start is None and end is None:
+            self.unlocated += 1
+            return self._no_hit
+
+        if start is not None and end is not None:
+            return self.index.get(seq[start:end], self._no_hit)
+
+        # Only one side of the window is fixed, try every barcode length in the library
+        hit, first = self._no_hit, NO_MATCH
+        for length in self.lengths:
+            if start is not None:
+                if start + length > len(seq):
+                    break
+                window = seq[start : start + length]
+            else:
+                if end < length:
+                    break
+                window = seq[end - length : end]
+            rank = self.index.get(window, self._no_hit)
+            if rank < self._no_hit:
+                if first == NO_MATCH:
+                    first = rank % self.n_barcodes
+                elif rank % self.n_barcodes != first and first != MULTI_HIT:
+                    # Windows of different lengths holding different barcodes
+                    self.multi_hit += 1
+                    first = MULTI_HIT
+                hit = min(hit, rank)
+        else:
+            return hit
+
+        if length == self.lengths[0]:
+            # The read is too short for even the shortest barcode window
+            self.unlocated += 1
+        return hit
+
+    def _hit_ranks(self, sequences):
+        reads, ranks = [], []
+        for read, seq in enumerate(sequences):
+            start, end = self._locate(seq)
+            if start is None and end is None:
+                self.unlocated += 1
+                continue
+            if start is not None and end is not None:
+                windows = [seq[start:end]]
+            elif start is not None:
+                windows = [
+                    seq[start : start + length]
+                    for length in self.lengths
+                    if start + length <= len(seq)
+                ]
+            else:
+                windows = [
+                    seq[end - length : end] for length in self.lengths if end >= length
+                ]
+            if not windows and self.lengths:
+                # The read is too short for even the shortest barcode window
+                self.unlocated += 1
+            for window in windows:
+                rank = self.index.get(window)
+                if rank is not None:
+                    reads.append(read)
+                    ranks.append(rank)
+        return reads, ranks
+
+    def match(self, sequences) -> np.ndarray:
+        """
+        > Assign each read to the barcode found in its window
+
+        :param sequences: an iterable of read sequences
+        :return: An int32 array of barcode indices, NO_MATCH for the undetected reads
+        """
+        return self._to_assignment([self._lookup(seq) for seq in sequences])
+
+
+class SharedMatcher(object):
+    """
+    > Several barcode libraries matched in one scan of the reads
+
+    Every pattern (barcode or Hamming neighbor) of the libraries is added once to a
+    single matcher, which reports pattern ids. The rank of each pattern in each library
+    is then looked up in a per-library table, so every library is assigned exactly as
+    by its own matcher, collisions and ambiguous neighbors included.
+    """
+
+    def __init__(
+        self,
+        libraries: list,
+        engine="aho-corasick",
+        barcode_offset=None,
+        anchors=("", ""),
+        max_mismatch=0,
+        ranks=None,
+    ):
+        patterns = {}
+        pattern_ranks = []
+        self.libraries = []
+        self.offsets = []
+        offset = 0
+        for barcodes, library_ranks in zip(libraries, ranks or [None] * len(libraries)):
+            library_ranks = _exact_ranks(barcodes, max_mismatch, library_ranks)
+            pattern_ranks.append(
+                [
+                    (patterns.setdefault(pattern, len(patterns)), rank)
+                    for pattern, rank in library_ranks.items()
+                ]
+            )
+            self.libraries.append(_RankedMatcher(barcodes, max_mismatch))
+            self.offsets.append(offset)
+            offset += len(barcodes)
+
+        # rank_tables[library][pattern id], no hit for the patterns of the other libraries
+        self.rank_tables = []
+        for library, pairs in zip(self.libraries, pattern_ranks):
+            table = np.full(len(patterns), library._no_hit, dtype=np.int64)
+            if pairs:
+                ids, library_ranks = zip(*pairs)
+                table[list(ids)] = library_ranks
+            self.rank_tables.append(table)
+
+        if engine == "position":
+            self._scanner = PositionMatcher(
+                list(patterns),
+                offset=barcode_offset,
+                upstream=anchors[0],
+                downstream=anchors[1],
+            )
+        elif engine == "vectorized":
+            self._scanner = KmerMatcher(list(patterns))
+        else:
+            self._scanner = AhoCorasickMatcher(list(patterns))
+
+    @property
+    def mismatched(self) -> np.ndarray:
+        return np.array([library.mismatched for library in self.libraries])
+
+    @property
+    def multi_hit(self) -> np.ndarray:
+        return np.array([library.multi_hit for library in self.libraries])
+
+    @property
+    def unlocated(self) -> int:
+        return self._scanner.unlocated
+
+    def reset_counters(self):
+        self._scanner.reset_counters()
+        for library in self.libraries:
+            library.reset_counters()
+
+    def _library_hits(self, sequences):
+        # (library, reads, ranks) of the hits of every library, from a single scan
+        reads, ids = self._scanner._hit_ranks(sequences)
+        reads = np.asarray(reads, dtype=np.int32)
+        ids = np.asarray(ids, dtype=np.int64)
+        for library, table in zip(self.libraries, self.rank_tables):
+            ranks = table[ids]
+            hit = ranks < library._no_hit
+            yield library, reads[hit], ranks[hit]
+
+    def match(self, sequences) -> np.ndarray:
+        """
+        > Assign each read in every library
+
+        :param sequences: a list of read sequences
+        :return: An int32 array of shape (reads, libraries), holding barcode indices of
+            the concatenated libraries, NO_MATCH where the read is not detected
+        """
+        return self._to_assignment(*self._best_ranks(sequences))
+
+    def _best_ranks(self, sequences):
+        # The lowest rank of every library found in every read, and whether the read hits
+        # several barcodes of the library, one column per library
+        best = np.empty((len(sequences), len(self.libraries)), dtype=np.int64)
+        multi = np.empty((len(sequences), len(self.libraries)), dtype=bool)
+        for column, (library, reads, ranks) in enumerate(self._library_hits(sequences)):
+            best[:, column] = library._no_hit
+            np.minimum.at(best[:, column], reads, ranks)
+            multi[:, column] = library._multi_hits(len(sequences), reads, ranks)
+        return best, multi
+
+    def _to_assignment(self, ranks: np.ndarray, multi=None) -> np.ndarray:
+        assignment = np.full(ranks.shape, NO_MATCH, dtype=np.int32)
+        for column, library in enumerate(self.libraries):
+            assigned = library._to_assignment(
+                ranks[:, column], None if multi is None else multi[:, column]
+            )
+            detected = assigned >= 0
+            assignment[detected, column] = assigned[detected] + self.offsets[column]
+        return assignment
+
+    def match_hits(self, sequences):
+        """
+        > Assign each read like match(), and also report every barcode found in it
+
+        :param sequences: a list of read sequences
+        :return: The assignment of match(), then the read positions, barcode indices of
+            the concatenated libraries and mismatches of the hits, one per (read, barcode)
+        """
+        assignment = np.full(
+            (len(sequences), len(self.libraries)), NO_MATCH, dtype=np.int32
+        )
+        hits = []
+        for column, (library, reads, ranks) in enumerate(self._library_hits(sequences)):
+            assigned, reads, barcodes, mismatches = library._hits(
+                len(sequences), reads, ranks
+            )
+            detected = assigned >= 0
+            assignment[detected, column] = assigned[detected] + self.offsets[column]
+            hits.append((reads, barcodes + self.offsets[column], mismatches))
+
+        reads, barcodes, mismatches = (np.concatenate(column) for column in zip(*hits))
+        return assignment, reads, barcodes.astype(np.int32), mismatches
+
+
+class BarcodeIndex(object):
+    """
+    > The barcode library of a run and its search structure
+
+    Built once in the parent process, pickled to the index cache, and loaded once per
+    worker process instead of once per chunk.
+    """
+
+    def __init__(
+        self,
+        barcode_df: pd.DataFrame,
+        engine="aho-corasick",
+        barcode_offset=None,
+        anchors=("", ""),
+        max_mismatch=0,
+        strand="forward",
+    ):
+        if engine == "contains" and strand != "forward":
+            raise ValueError("The contains engine only matches the forward strand")
+        if engine == "position" and strand == "both":
+            raise ValueError("The position engine locates the barcode on one strand")
+
+        self.barcode_df = barcode_df[["Gene", "Barcode"]].reset_index(drop=True)
+        self.engine = engine
+        self.max_mismatch = max_mismatch
+        self.strand = strand
+        self.collisions = None  # Collision report of the Hamming neighborhood
+        self.n_ambiguous = 0
+        self.n_strand_ambiguous = 0  # Sequences of one barcode read on the other strand
+
+        barcodes = self.barcode_df["Barcode"].tolist()
+        ranks = None
+        if max_mismatch > 0 and engine != "contains":
+            neighborhood = NeighborhoodIndex(barcodes, max_mismatch)
+            ranks = neighborhood.index
+            self.collisions = neighborhood.collision_report(barcodes)
+            self.n_ambiguous = neighborhood.n_ambiguous
+        if strand != "forward":
+            ranks, self.n_strand_ambiguous = stranded_ranks(
+                _exact_ranks(barcodes, max_mismatch, ranks), len(barcodes), strand
+            )
+        if strand == "reverse":
+            anchors = _reverse_anchors(anchors)
+
+        if engine == "position":
+            self.matcher = PositionMatcher(
+                barcodes,
+                offset=barcode_offset,
+                upstream=anchors[0],
+                downstream=anchors[1],
+                max_mismatch=max_mismatch,
+                ranks=ranks,
+            )
+        elif engine == "aho-corasick":
+            self.matcher = AhoCorasickMatcher(barcodes, max_mismatch, ranks)
+        elif engine == "vectorized":
+            self.matcher = KmerMatcher(barcodes, max_mismatch, ranks)
+        else:
+            self.matcher = None  # The legacy contains loop works on the dataframe
+
+    def __len__(self):
+        return self.barcode_df.shape[0]
+
+    @staticmethod
+    def load(index_file: pathlib.Path) -> "BarcodeIndex":
+        with open(index_file, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, index_file: pathlib.Path):
+        # Written next to the target and renamed, a concurrent run never reads a partial file
+        tmp_file = pathlib.Path(f"{index_file}.{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, index_file)
+
+
+class SharedBarcodeIndex(BarcodeIndex):
+    """
+    > The barcode libraries of a sample, searched in one scan of its reads
+
+    barcode_df is the concatenation of the libraries, its Library column gives the
+    library of each barcode; the read counts of the workers follow the same order.
+    """
+
+    def __init__(
+        self,
+        barcode_dfs: list,
+        engine="aho-corasick",
+        barcode_offset=None,
+        anchors=("", ""),
+        max_mismatch=0,
+        strand="forward",
+    ):
+        if engine == "contains":
+            raise ValueError("The contains engine cannot share an index")
+        if engine == "position" and strand == "both":
+            raise ValueError("The position engine locates the barcode on one strand")
+
+        barcode_dfs = [
+            df[["Gene", "Barcode"]].reset_index(drop=True) for df in barcode_dfs
+        ]
+        self.barcode_df = pd.concat(
+            [df.assign(Library=library) for library, df in enumerate(barcode_dfs)],
+            ignore_index=True,
+        )
+        self.engine = engine
+        self.max_mismatch = max_mismatch
+        self.strand = strand
+        self.collisions = [None] * len(barcode_dfs)
+        self.n_ambiguous = [0] * len(barcode_dfs)
+        self.n_strand_ambiguous = [0] * len(barcode_dfs)
+
+        libraries = [df["Barcode"].tolist() for df in barcode_dfs]
+        ranks = None
+        if max_mismatch > 0:
+            ranks = []
+            for library, barcodes in enumerate(libraries):
+                neighborhood = NeighborhoodIndex(barcodes, max_mismatch)
+                ranks.append(neighborhood.index)
+                self.collisions[library] = neighborhood.collision_report(barcodes)
+                self.n_ambiguous[library] = neighborhood.n_ambiguous
+        if strand != "forward":
+            ranks = ranks or [None] * len(libraries)
+            for library, barcodes in enumerate(libraries):
+                ranks[library], self.n_strand_ambiguous[library] = stranded_ranks(
+                    _exact_ranks(barcodes, max_mismatch, ranks[library]),
+                    len(barcodes),
+                    strand,
+                )
+        if strand == "reverse":
+            anchors = _reverse_anchors(anchors)
+
+        self.matcher = SharedMatcher(
+            libraries, engine, barcode_offset, anchors, max_mismatch, ranks
+        )
+
+    @property
+    def n_libraries(self) -> int:
+        return len(self.matcher.libraries)
+
+    def library_slice(self, library: int) -> slice:
+        # Position of the library in barcode_df and in the read counts
+        first = self.matcher.offsets[library]
+        return slice(first, first + self.matcher.libraries[library].n_barcodes)
+
+
+def file_digest(file_path: pathlib.Path) -> str:
+    """
+    > SHA-256 of the file content
+
+    :param file_path: the file to hash
+    :return: The hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_barcode_index(
+    barcode_file: pathlib.Path, sep: str, cache_dir: pathlib.Path, **index_options
+):
+    """
+    > Build the barcode index, or load it from the cache keyed by the file content
+
+    :param barcode_file: the barcode file
+    :param sep: separator character of the barcode file
+    :param cache_dir: the directory of the cached indexes
+    :param index_options: engine, barcode_offset, anchors, max_mismatch and strand
+    :return: The BarcodeIndex, the path of its cache file and whether it was cached
+    """
+    index_file = _index_cache_file(cache_dir, [barcode_file], sep, index_options)
+    if index_file.exists():
+        return BarcodeIndex.load(index_file), index_file, True
+
+    barcode_index = BarcodeIndex(load_barcodes(barcode_file, sep), **index_options)
+    barcode_index.save(index_file)
+    return barcode_index, index_file, False
+
+
+def build_shared_barcode_index(
+    barcode_files: list, sep: str, cache_dir: pathlib.Path, **index_options
+):
+    """
+    > Build the shared index of several barcode libraries, or load it from the cache
+
+    :param barcode_files: the barcode files, in the order of the libraries
+    :param sep: separator character of the barcode files
+    :param cache_dir: the directory of the cached indexes
+    :param index_options: engine, barcode_offset, anchors, max_mismatch and strand
+    :return: The SharedBarcodeIndex, the path of its cache file and whether it was cached
+    """
+    index_file = _index_cache_file(cache_dir, barcode_files, sep, index_options)
+    if index_file.exists():
+        return BarcodeIndex.load(index_file), index_file, True
+
+    barcode_index = SharedBarcodeIndex(
+        [load_barcodes(barcode_file, sep) for barcode_file in barcode_files],
+        **index_options,
+    )
+    barcode_index.save(index_file)
+    return barcode_index, index_file, False
+
+
+def _index_cache_file(cache_dir, barcode_files: list, sep: str, index_options: dict):
+    implementation = "pyahocorasick" if ahocorasick is not None else "python"
+    digests = ",".join(file_digest(barcode_file) for barcode_file in barcode_files)
+    key = hashlib.sha256(
+        f"{INDEX_VERSION}|{implementation}|{digests}|{sep}|"
+        f"{sorted(index_options.items())}".encode()
+    ).hexdigest()
+    return pathlib.Path(cache_dir) / f"{key}.pkl"
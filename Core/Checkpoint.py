@@ -0,0 +1,114 @@
+import json
+import os
+import pathlib
+import pickle
+import shutil
+
+from Core.BarcodeMatcher import file_digest
+
+
+class Checkpoint(object):
+    """
+    > Checkpoint manifest of a sample, to resume an interrupted extraction
+
+    The manifest is a JSON Lines file: a header with the fingerprints of the inputs
+    and the options, one line per chunk whose results are saved in the checkpoint
+    directory, and a last line with the digests of the outputs once the sample is
+    complete. Lines are only appended, a killed run leaves at most one truncated line.
+    """
+
+    def __init__(self, manifest_file: pathlib.Path, chunk_dir: pathlib.Path, header):
+        self.manifest_file = pathlib.Path(manifest_file)
+        self.chunk_dir = pathlib.Path(chunk_dir)
+        self.header = header
+        self.chunks = {}  # Chunk name -> manifest record
+        self.outputs = None  # Output file -> sha256, once the sample is complete
+        self.valid = self._load()
+
+    def _load(self) -> bool:
+        # False when there is no manifest or it was written for other inputs
+        if not self.manifest_file.exists():
+            return False
+
+        records, complete = [], 0
+        with open(self.manifest_file, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Truncated line")
+                    records.append(json.loads(line))
+                except ValueError:
+                    break  # Written by an interrupted run
+                complete += len(line)
+        if complete < self.manifest_file.stat().st_size:
+            # The next records go after the last complete one
+            with open(self.manifest_file, "r+b") as f:
+                f.truncate(complete)
+
+        if not records or records[0].get("header") != self.header:
+            return False
+
+        for record in records[1:]:
+            if "chunk" in record:
+                self.chunks[record["chunk"]] = record
+            elif "outputs" in record:
+                self.outputs = record["outputs"]
+        return True
+
+    def _append(self, record: dict, mode="a"):
+        with open(self.manifest_file, mode) as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def reset(self):
+        shutil.rmtree(self.chunk_dir, ignore_errors=True)
+        self.chunk_dir.mkdir(parents=True)
+        self.chunks = {}
+        self.outputs = None
+        self._append({"header": self.header}, mode="w")
+        self.valid = True
+
+    @property
+    def completed(self) -> bool:
+        # The outputs recorded by the previous run are still there, unchanged
+        return self.outputs is not None and all(
+            pathlib.Path(output).exists() and file_digest(output) == digest
+            for output, digest in self.outputs.items()
+        )
+
+    def _chunk_file(self, name: str) -> pathlib.Path:
+        return self.chunk_dir / f"{name}.pkl"
+
+    def load_chunk(self, name: str):
+        """
+        > The saved results of a chunk
+
+        :param name: the chunk name, see Core.FastqIO.FastqChunk.name
+        :return: The worker results of the chunk, None when it has to be extracted
+        """
+        if name not in self.chunks:
+            return None
+        try:
+            with open(self._chunk_file(name), "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save_chunk(self, name: str, result, **fields):
+        # The results are in place before the manifest line that points to them
+        chunk_file = self._chunk_file(name)
+        tmp_file = pathlib.Path(f"{chunk_file}.tmp")
+        with open(tmp_file, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, chunk_file)
+
+        record = {"chunk": name, **fields}
+        self.chunks[name] = record
+        self._append(record)
+
+    def finish(self, output_files: list):
+        self.outputs = {str(output): file_digest(output) for output in output_files}
+        self._append({"outputs": self.outputs})
+        # The chunk results are not needed once the outputs are written
+        shutil.rmtree(self.chunk_dir, ignore_errors=True)
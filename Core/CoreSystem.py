@@ -1,10 +1,10 @@
 import multiprocessing as mp
 import os
 import pathlib
-import shlex
-import subprocess as sp
+import queue
 import sys
-from collections import defaultdict
+import threading
+from collections import Counter, defaultdict
 from concurrent.futures import ProcessPoolExecutor
 from types import SimpleNamespace
 
@@ -97,7 +97,7 @@ class SystemStructure(object):
         self.input_sample_organizer = defaultdict(pathlib.Path)
         self.input_file_organizer = defaultdict(
             pathlib.Path
-        )  # .fastq.gz #TODO: FLASh integration? https://ccb.jhu.edu/software/FLASH/
+        )  # .fastq.gz, the R1 of a read pair merged with --merge
         # should contain absolute path to the file
         self.output_sample_organizer = defaultdict(pathlib.Path)
 
@@ -116,6 +116,8 @@ class SystemStructure(object):
         self.output_dir = Helper.mkdir_if_not(
             "Output" + "/" + self.user_name + "/" + self.project_name
         )
+        self.index_cache_dir = Helper.mkdir_if_not("Cache" + "/" + "barcode_index")
+        self.result_cache_dir = Helper.mkdir_if_not("Cache" + "/" + "results")
 
     def mkdir_sample(self, sample_name: str, barcode_name: str):
         # TODO
@@ -126,19 +128,8 @@ class SystemStructure(object):
             self.output_dir / barcode_name / sample_name
         )
         self.result_dir = Helper.mkdir_if_not(self.output_sample_organizer[sample_name])
-        self.parquet_dir = Helper.mkdir_if_not(self.result_dir / "parquets")
-
-        if len(os.listdir(f"{pathlib.Path.cwd() / self.parquet_dir}")) > 0:
-            sp.run(
-                [
-                    "rm",
-                    "-r",
-                    f"{self.result_dir / 'parquets'}",
-                ]
-            )
-            self.parquet_dir = Helper.mkdir_if_not(
-                self.result_dir / "parquets"
-            )  # Re-create the directory
+        # Emptied by SampleJob when the sample is not resumed from its checkpoint
+        self.assignment_dir = Helper.mkdir_if_not(self.result_dir / "assignments")
 
 
 class ExtractorRunner:
@@ -148,6 +139,9 @@ class ExtractorRunner:
         args.system_structure.mkdir_sample(sample, pathlib.Path(barcode).name)
         self.sample = sample
         self.args = args
+        # The system structure is shared by every sample, keep the directories of this one
+        self.result_dir = args.system_structure.result_dir
+        self.assignment_dir = args.system_structure.assignment_dir
 
         for idx, file_path in enumerate(
             [
@@ -158,7 +152,7 @@ class ExtractorRunner:
             ]
         ):
             # Load input file from input sample folder (only one file)
-            if file_path.suffix in [".fastq", ".fq", ".fastq.gz", ".fq.gz"]:
+            if file_path.name.endswith((".fastq", ".fq", ".fastq.gz", ".fq.gz")):
                 args.logger.info(f"File name : {file_path.stem}")
                 self.args.system_structure.input_file_organizer[self.sample] = (
                     pathlib.Path.cwd() / file_path
@@ -178,67 +172,674 @@ class ExtractorRunner:
                 - 1
             ):
                 raise Exception("No fastq file in the sample folder")
+        self.input_file = self.args.system_structure.input_file_organizer[self.sample]
+        self.mate_file = None  # R2 of a read pair merged before the extraction
+        if args.merge != "off":
+            self._find_read_pair()
 
-        # self.strInputList  => contains all splitted fastq file path; glob can be used
+        self.chunks = []  # FastqChunk tasks, a generator for gzip streams
+        self.shared_assignment_dirs = None  # Library directories of a shared index
+        self.merge_stats = Counter()  # Pairs merged by FLASH, read from its log
 
-        self.args.system_structure.seq_split_dir = Helper.mkdir_if_not(
-            self.args.system_structure.input_sample_organizer[self.sample]
-            / "Split_files"
-        )
+    def _find_read_pair(self):
+        from Core.PairedMerge import FASTQ_SUFFIXES, find_read_pair
 
-        if (
-            len(
-                os.listdir(
-                    f"{pathlib.Path.cwd() / self.args.system_structure.seq_split_dir}"
+        files = list(
+            self.args.system_structure.input_sample_organizer[self.sample].glob("*")
+        )
+        pair = find_read_pair(files)
+        if pair is None:
+            fastq_files = [file for file in files if file.name.endswith(FASTQ_SUFFIXES)]
+            if len(fastq_files) > 1:
+                # Any of them could be an R2, none is extracted in place of the pair
+                raise Exception(
+                    f"{self.sample}: no read pair among "
+                    f"{', '.join(sorted(file.name for file in fastq_files))}, "
+                    "name the mates {name}_1/{name}_2 or {name}_R1/{name}_R2"
                 )
+            self.args.logger.info(f"{self.sample}: no read pair, extracted as it is")
+            return
+        self.input_file, self.mate_file = (pathlib.Path.cwd() / mate for mate in pair)
+        self.args.logger.info(
+            f"{self.sample}: {self.input_file.name} and {self.mate_file.name} "
+            f"are merged with {self.args.merge}"
+        )
+
+    def merge_options(self):
+        # The FLASH -m, -M and -x parameters, None without a read pair
+        if self.mate_file is None:
+            return None
+        return {
+            "min_overlap": self.args.merge_min_overlap,
+            "max_overlap": self.args.merge_max_overlap,
+            "max_mismatch_density": self.args.merge_mismatch_density,
+        }
+
+    def _split_into_chunks(self):
+        # No split files: the workers read their range of the original file
+        from Core.FastqIO import plan_chunks
+        from Core.PairedMerge import flash_chunks, plan_pair_chunks
+
+        if self.mate_file is None:
+            self.chunks = plan_chunks(
+                self.input_file,
+                self.args.chunk_size,
+                threads=min(4, self.args.multicore),
             )
-            > 0
-        ):
-            sp.run(
-                [
-                    "rm",
-                    "-r",
-                    f"{pathlib.Path.cwd() / self.args.system_structure.seq_split_dir}",
-                ]
+        elif self.args.merge == "flash":
+            # The merged reads are chunked from the output of FLASH while it runs
+            self.chunks = flash_chunks(
+                self.input_file,
+                self.mate_file,
+                self.args.chunk_size,
+                self.merge_options(),
+                flash=self.args.flash,
+                log_file=self.result_dir / f"{self.sample}+flash.log",
+                merge_stats=self.merge_stats,
+            )
+        else:
+            # The workers merge the pairs of their chunk before matching the reads
+            self.chunks = plan_pair_chunks(
+                self.input_file,
+                self.mate_file,
+                self.args.chunk_size,
+                self.merge_options(),
             )
-            self.args.system_structure.seq_split_dir = Helper.mkdir_if_not(
-                self.args.system_structure.input_sample_organizer[self.sample]
-                / "Split_files"
-            )  # Re-create the directory
 
-    def _split_into_chunks(self):
-        ### Defensive : original fastq wc == split fastq wc
-        # https://docs.python.org/3.9/library/subprocess.html#security-considerations
-        sp.run(
-            shlex.split(
-                shlex.quote(
-                    f'split "{self.args.system_structure.input_file_organizer[self.sample]}" -l {4 * self.args.chunk_size} -d -a 6 --additional-suffix=.fastq {self.args.system_structure.seq_split_dir}/split_'
-                )
-            ),
-            shell=True,
-            check=True,
+        if isinstance(self.chunks, list):
+            self.args.logger.info(
+                f"{self.sample}: the number of chunks:{len(self.chunks)}"
+            )
+        else:
+            self.args.logger.info(
+                f"{self.sample}: chunks are streamed while decompressing or merging"
+            )
+
+    def _extraction_options(self) -> SimpleNamespace:
+        return SimpleNamespace(
+            validate=not self.args.skip_validation,
+            audit=self.args.audit,
+            audit_ids=self.args.audit_ids,
+            detection_bitmap=self.args.detection_bitmap,
+            quality_filter=self._quality_filter(),
+            umi=self._umi_options(),
+            collapse=self.args.collapse_cache if self.args.collapse else None,
         )
 
+    def _umi_options(self):
+        # Where the UMI is read and how the unique UMIs are counted, None without UMIs
+        if self.args.umi == "off":
+            return None
+        return {
+            "source": self.args.umi,
+            "offset": self.args.umi_offset,
+            "length": self.args.umi_length,
+            "sketch": self.args.umi_sketch,
+            "precision": self.args.umi_precision,
+        }
+
+    def _quality_filter(self):
+        # The Core.ReadFilter options, None when no filter is set
+        options = {
+            "trim_quality": self.args.trim_quality,
+            "min_mean_quality": self.args.min_mean_quality,
+            "min_window_quality": self.args.min_window_quality,
+            "max_n": self.args.max_n,
+        }
+        if all(value is None for value in options.values()):
+            return None
+        if self.args.min_window_quality is not None:
+            # The barcode window of the position engine unless given
+            options["window"] = self.args.quality_window or [
+                self.args.barcode_offset,
+                self.args.barcode_offset
+                + int(self.barcode_index.barcode_df["Barcode"].str.len().max()),
+            ]
+        return options
+
+    def _prepare_barcode_index(self, barcode):
+        # Parsed and indexed once per run; reused from the cache when the file is unchanged
+        from Core.BarcodeMatcher import build_barcode_index
+
+        self.barcode_index, self.index_file, cached = build_barcode_index(
+            self.args.system_structure.barcode_dir / barcode,
+            self.args.sep,
+            self.args.system_structure.index_cache_dir,
+            engine=self.args.engine,
+            barcode_offset=self.args.barcode_offset,
+            anchors=self.args.anchors,
+            max_mismatch=self.args.mismatch,
+            strand=self.args.strand,
+        )
         self.args.logger.info(
-            f"The number of split files:{len(list(self.args.system_structure.seq_split_dir.glob('*')))}"
+            f"Barcode index {'loaded from' if cached else 'saved to'} {self.index_file}"
         )
+        self._report_collisions(
+            self.barcode_index.collisions,
+            self.barcode_index.n_ambiguous,
+            self.barcode_index.n_strand_ambiguous,
+        )
+
+    def _prepare_shared_barcode_index(self, barcodes: list, runners: list):
+        # One index for all the barcode libraries of the sample, the reads are scanned once
+        from Core.BarcodeMatcher import build_shared_barcode_index
+
+        self.barcode_index, self.index_file, cached = build_shared_barcode_index(
+            [self.args.system_structure.barcode_dir / barcode for barcode in barcodes],
+            self.args.sep,
+            self.args.system_structure.index_cache_dir,
+            engine=self.args.engine,
+            barcode_offset=self.args.barcode_offset,
+            anchors=self.args.anchors,
+            max_mismatch=self.args.mismatch,
+            strand=self.args.strand,
+        )
+        self.args.logger.info(
+            f"Shared index of {len(barcodes)} barcode libraries "
+            f"{'loaded from' if cached else 'saved to'} {self.index_file}"
+        )
+        for library, runner in enumerate(runners):
+            runner._report_collisions(
+                self.barcode_index.collisions[library],
+                self.barcode_index.n_ambiguous[library],
+                self.barcode_index.n_strand_ambiguous[library],
+            )
+        self.shared_assignment_dirs = [runner.assignment_dir for runner in runners]
+
+    def _report_collisions(self, collisions, n_ambiguous: int, n_strand_ambiguous=0):
+        if n_strand_ambiguous > 0:
+            self.args.logger.warning(
+                f"{n_strand_ambiguous} sequences match different barcodes on the two strands "
+                f"and will not be assigned"
+            )
+        if self.args.mismatch == 0:
+            return
+        if collisions is not None and collisions.shape[0] > 0:
+            self.args.logger.warning(
+                f"{collisions.shape[0]} barcode neighbor collisions within {self.args.mismatch} mismatches, "
+                f"{n_ambiguous} ambiguous neighbors will not be assigned"
+            )
+            collisions.to_csv(
+                f"{self.result_dir}/{self.sample}+barcode_collisions.csv",
+                index=False,
+            )
+        else:
+            self.args.logger.info(
+                f"No barcode neighbor collision within {self.args.mismatch} mismatches"
+            )
 
     def _populate_command(self, barcode):
-        return [
+        # The workers write the audit tables of a shared index in every library directory
+        assignment_dir = (
+            [
+                f"{pathlib.Path(directory).absolute()}"
+                for directory in self.shared_assignment_dirs
+            ]
+            if self.shared_assignment_dirs is not None
+            else f"{pathlib.Path(self.assignment_dir).absolute()}"
+        )
+        commands = (
             (
-                str(pathlib.Path.cwd() / self.args.system_structure.seq_split_dir / f),
-                str(
-                    pathlib.Path.cwd()
-                    / self.args.system_structure.barcode_dir
-                    / barcode
-                ),
+                chunk,
+                str(self.index_file.absolute()),
                 self.args.logger,
-                f"{(pathlib.Path(self.args.system_structure.result_dir) / 'parquets').absolute()}",
-                self.args.sep,
+                assignment_dir,
+                self._extraction_options(),
             )
-            for f in sorted(os.listdir(self.args.system_structure.seq_split_dir))
-            if f.endswith(".fastq")
+            for chunk in self.chunks
+        )
+        return list(commands) if isinstance(self.chunks, list) else commands
+
+
+class SampleJob(object):
+    """
+    > The extraction of one sample, scheduled on the worker pool shared by the project
+
+    A reader thread plans the chunks into a bounded queue, so that decompressing a
+    gzip stream waits for the workers instead of holding every chunk in memory, and
+    the results are written on an I/O thread while the workers keep matching the
+    chunks of the other samples. With several
+    barcode files, the reads are matched once against their shared index and the
+    results are written for every barcode file.
+    """
+
+    def __init__(self, sample: str, barcodes: list, args: SimpleNamespace):
+        import numpy as np
+
+        from Core.ReadSummary import ReadSummary
+
+        self.sample = sample
+        self.barcodes = barcodes
+        self.args = args
+        self.runners = [ExtractorRunner(sample, barcode, args) for barcode in barcodes]
+        self.runner = self.runners[0]  # Plans the chunks of the input file
+        if len(barcodes) > 1:
+            self.runner._prepare_shared_barcode_index(barcodes, self.runners)
+        else:
+            self.runner._prepare_barcode_index(barcodes[0])
+
+        # Filled by produce() on the reader thread, at most one chunk per worker ahead
+        self.commands = queue.Queue(maxsize=max(args.multicore, 1))
+        self.cancelled = False
+        self.exhausted = False
+        self.pending = 0
+        self.start = None
+
+        # Per-chunk results are folded as soon as they arrive
+        self.read_counts = np.zeros(len(self.runner.barcode_index), dtype=np.int64)
+        self.read_summary = ReadSummary(len(barcodes))
+        # Per-read detection arrays by chunk start, only with --detection_bitmap
+        self.bitmaps = {} if args.detection_bitmap else None
+        self.read_stats = Counter()
+        # Reported by the workers, see extractor.extract_read_cnts
+        self.chunk_metrics = []
+        self.timings = Counter()  # Seconds spent in the parent: plan, merge and write
+        self.resumed = 0  # Chunks loaded from the checkpoint
+        self.restored = False  # Results taken from the result cache, nothing extracted
+
+        self.checkpoint = self._open_checkpoint()
+        self.completed = self.checkpoint.completed and not args.restart
+        if self.completed:
+            return
+        self.result_cache = self._open_result_cache()
+        if args.restart or not self.checkpoint.valid or self.checkpoint.outputs:
+            self._restart()
+        elif self.checkpoint.chunks:
+            args.logger.info(
+                f"Resuming {sample}: {len(self.checkpoint.chunks)} chunks already extracted"
+            )
+
+    def _open_checkpoint(self):
+        from Core.BarcodeMatcher import file_digest
+        from Core.Checkpoint import Checkpoint
+        from Core.FastqIO import fastq_fingerprint
+
+        # Also the content address of the results, see _open_result_cache
+        method = self.args.fingerprint
+        self.input_fingerprint = fastq_fingerprint(self.runner.input_file, method)
+        if self.runner.mate_file is not None:
+            self.input_fingerprint += (
+                f"+{fastq_fingerprint(self.runner.mate_file, method)}"
+            )
+        self.barcode_digests = {
+            barcode: file_digest(self.args.system_structure.barcode_dir / barcode)
+            for barcode in self.barcodes
+        }
+        header = {
+            "input_file": str(self.runner.input_file),
+            "input_fingerprint": self.input_fingerprint,
+            "barcodes": self.barcode_digests,
+            "index": self.runner.index_file.name,  # Engine and index options
+            "chunk_size": self.args.chunk_size,
+            "options": vars(self.runner._extraction_options()),
+        }
+        if self.runner.mate_file is not None:
+            header["mate_file"] = str(self.runner.mate_file)
+            header["merge"] = {"merger": self.args.merge, **self.runner.merge_options()}
+        return Checkpoint(
+            self.runner.result_dir / f"{self.sample}+checkpoint.jsonl",
+            self.runner.result_dir / "checkpoints",
+            header,
+        )
+
+    def _open_result_cache(self):
+        from Core.ResultCache import ResultCache, result_key
+
+        if self.args.result_cache_mb <= 0:
+            return None
+        # The counts do not depend on the chunk size nor on the worker count
+        params = {
+            "sep": self.args.sep,
+            "engine": self.args.engine,
+            "barcode_offset": self.args.barcode_offset,
+            "anchors": self.args.anchors,
+            "max_mismatch": self.args.mismatch,
+            "strand": self.args.strand,
+            "validate": not self.args.skip_validation,
+            "quality_filter": self.runner._quality_filter(),
+            # The collapse only shows in the read statistics
+            "collapse": self.args.collapse,
+        }
+        if self.runner.mate_file is not None:
+            # FLASH and the in-process merge may not merge the same pairs
+            params["merge"] = {"merger": self.args.merge, **self.runner.merge_options()}
+        self.result_keys = [
+            result_key(self.input_fingerprint, self.barcode_digests[barcode], params)
+            for barcode in self.barcodes
+        ]
+        return ResultCache(
+            self.args.system_structure.result_cache_dir,
+            max_bytes=int(self.args.result_cache_mb * (1 << 20)),
+        )
+
+    def restore_cached(self) -> bool:
+        """
+        > Take the results of every barcode file from the result cache
+
+        The audit tables, the detection bitmaps and the UMI counts are not cached, a run
+        writing them always extracts the reads.
+
+        :return: True when all the barcode files are cached, then only finalize() is left
+        """
+        import time
+
+        import numpy as np
+
+        if (
+            self.result_cache is None
+            or self.args.audit
+            or self.args.detection_bitmap
+            or self.args.umi != "off"
+            or self.args.restart
+        ):
+            return False
+        entries = [self.result_cache.get(key) for key in self.result_keys]
+        if any(entry is None for entry in entries):
+            return False
+
+        self.start = time.time()
+        self.read_counts = np.concatenate([entry["read_counts"] for entry in entries])
+        # Every barcode file counts the same reads, only the detected ones differ
+        self.read_summary.merge(entries[0]["read_summary"])
+        self.read_summary.detected[:] = [
+            entry["read_summary"].detected[0] for entry in entries
         ]
+        # One value per barcode file, as the counters of a shared index
+        self.read_stats = Counter(
+            {
+                key: np.array([entry["read_stats"].get(key, 0) for entry in entries])
+                for key in dict.fromkeys(
+                    key for entry in entries for key in entry["read_stats"]
+                )
+            }
+        )
+        self.restored = True
+        return True
+
+    def _restart(self):
+        # Nothing of a previous run can be reused
+        import shutil
+
+        for runner in self.runners:
+            shutil.rmtree(runner.assignment_dir, ignore_errors=True)
+            Helper.mkdir_if_not(runner.assignment_dir)
+        self.checkpoint.reset()
+
+    @property
+    def index_file(self) -> pathlib.Path:
+        return self.runner.index_file
+
+    def produce(self, wakeup: threading.Event, merge_slots: threading.Semaphore):
+        """
+        > Reader stage: plan the chunks and queue their tasks, None after the last one
+
+        Blocks while the queue is full, which holds back the decompression of a gzip
+        stream, or FLASH, until the workers catch up.
+
+        :param wakeup: set after every queued task, see run_extractor_mp
+        :param merge_slots: taken while FLASH runs, bounds the FLASH processes
+        """
+        import time
+
+        flash = self.runner.mate_file is not None and self.args.merge == "flash"
+        if flash:
+            merge_slots.acquire()
+        start = time.perf_counter()
+        try:
+            self.runner._split_into_chunks()
+            commands = self.runner._populate_command(self.barcodes[0])
+            self.timings["plan_s"] += time.perf_counter() - start
+            for sCmd in commands:
+                if not self._put(sCmd, wakeup):
+                    return
+        finally:
+            if not isinstance(self.runner.chunks, list):
+                # Stops the decompression, or FLASH, of a cancelled extraction
+                self.runner.chunks.close()
+            self._put(None, wakeup)
+            if flash:
+                merge_slots.release()
+
+    def _put(self, item, wakeup: threading.Event) -> bool:
+        # Gives up once the scheduler is cancelled, nobody would empty the queue
+        while not self.cancelled:
+            try:
+                self.commands.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            wakeup.set()
+            return True
+        return False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def next_command(self):
+        """
+        > The next chunk task of the sample
+
+        :return: the worker arguments, None when no chunk is queued yet or all submitted
+        """
+        while not self.exhausted:
+            try:
+                sCmd = self.commands.get_nowait()
+            except queue.Empty:
+                return None
+            if sCmd is None:
+                self.exhausted = True
+                break
+            # Chunks extracted by an interrupted run are not submitted again
+            result = self.checkpoint.load_chunk(sCmd[0].name)
+            if result is None:
+                return sCmd
+            self.reduce(result)
+            self.resumed += 1
+        return None
+
+    @property
+    def done(self) -> bool:
+        return self.exhausted and self.pending == 0
+
+    def collect(self, result):
+        # Results of a worker: reduced, then saved for a resumed run
+        self.reduce(result)
+        metrics = result[-1]
+        self.checkpoint.save_chunk(
+            metrics["chunk"], result, reads=metrics["reads"], hits=metrics["hits"]
+        )
+
+    def reduce(self, result):
+        import time
+
+        import numpy as np
+
+        start = time.perf_counter()
+        counts, summary, stats, metrics = result
+        np.add(self.read_counts, counts, out=self.read_counts)
+        self.read_summary.merge(summary)
+        if self.bitmaps is not None:
+            self.bitmaps[metrics["start"]] = summary.bitmap()
+        self.read_stats.update(stats)
+        self.chunk_metrics.append(metrics)
+        self.timings["merge_s"] += time.perf_counter() - start
+
+    def finalize(self):
+        import time
+
+        import numpy as np
+
+        from Core.BarcodeMatcher import SharedBarcodeIndex
+        from Core.ReadCollapser import DROPPED, MATCHED, RATIO
+
+        self.timings["wall_s"] = time.time() - self.start
+        self.read_stats.update(self.runner.merge_stats)
+        self.args.logger.info(
+            f"Extraction of {self.sample} is done. {self.timings['wall_s']}s elapsed."
+        )
+        # One value per barcode file when restored from a shared index
+        dropped = int(np.max(self.read_stats.get(DROPPED, 0)))
+        if dropped:
+            self.args.logger.warning(
+                f"{self.sample}: {dropped} read sequences did not fit the collapse "
+                f"table and were matched again when met, see --collapse_cache"
+            )
+        start = time.perf_counter()
+
+        # One detection column and one slice of the read counts per barcode file
+        bitmap = (
+            np.concatenate(
+                [self.bitmaps[chunk] for chunk in sorted(self.bitmaps)]
+                or [np.zeros((0, len(self.runners)), dtype=bool)]
+            )
+            if self.bitmaps is not None
+            else None
+        )
+        barcode_index = self.runner.barcode_index
+        umi_counts = None
+        if self.args.umi != "off":
+            umi_counts = (
+                self.read_summary.umis.deduplicated(self.args.umi_mismatch)
+                if self.read_summary.umis is not None
+                else np.zeros(len(barcode_index), dtype=np.int64)
+            )
+        for library, runner in enumerate(self.runners):
+            rows = (
+                barcode_index.library_slice(library)
+                if isinstance(barcode_index, SharedBarcodeIndex)
+                else slice(None)
+            )
+            read_stats = {
+                key: value[library] if np.ndim(value) else value
+                for key, value in self.read_stats.items()
+            }
+            read_summary = self.read_summary.library(library)
+            if umi_counts is not None:
+                read_stats["UMI-deduplicated read"] = int(umi_counts[rows].sum())
+            if MATCHED in read_stats:
+                # Reads per sequence matched, over the sample
+                read_stats[RATIO] = read_summary.total / max(read_stats[MATCHED], 1)
+            self._write_results(
+                runner,
+                barcode_index.barcode_df.iloc[rows],
+                self.read_counts[rows],
+                read_summary,
+                read_stats,
+                umi_counts[rows] if umi_counts is not None else None,
+            )
+            if bitmap is not None:
+                np.save(
+                    f"{runner.result_dir}/{self.sample}+detection_bitmap.npy",
+                    bitmap[:, library],
+                )
+            if (
+                self.result_cache is not None
+                and not self.restored
+                and umi_counts is None
+            ):
+                self.result_cache.put(
+                    self.result_keys[library],
+                    self.read_counts[rows],
+                    read_summary,
+                    read_stats,
+                    sample=self.sample,
+                    barcode=self.barcodes[library],
+                    input_file=str(self.runner.input_file),
+                    engine=self.args.engine,
+                    reads=read_summary.total,
+                )
+        self.timings["write_s"] += time.perf_counter() - start
+        self.checkpoint.finish(
+            [
+                f"{runner.result_dir}/{self.sample}+{output}"
+                for runner in self.runners
+                for output in ("extraction_result.csv", "read_statstics.txt")
+            ]
+        )
+
+        summary = self.summary()
+        self.args.logger.info(
+            f"{self.sample}: {summary['reads']} reads in {summary['chunks']} chunks, "
+            f"{summary['reads_per_sec']} reads/s; parse {summary['parse_s']:.3f}s, "
+            f"match {summary['match_s']:.3f}s (summed over the chunks), "
+            f"merge {summary['merge_s']:.3f}s, write {summary['write_s']:.3f}s, "
+            f"worker peak RSS {summary['worker_peak_rss_mb']} MiB"
+        )
+        for runner in self.runners:
+            self._write_metrics(runner, summary)
+
+    def summary(self) -> dict:
+        """
+        > Aggregate the chunk metrics of the sample
+
+        parse_s, match_s and audit_s are summed over the chunks, so they add up the
+        time of all the workers; wall_s runs from the start of the planning to the end
+        of the extraction.
+
+        :return: A dict of the totals, the throughput and the worker peak RSS
+        """
+        chunks = self.chunk_metrics
+        reads = sum(chunk["reads"] for chunk in chunks)
+        wall = self.timings["wall_s"]
+        return {
+            "chunks": len(chunks),
+            "resumed_chunks": self.resumed,
+            "restored_from_cache": self.restored,
+            "reads": reads,
+            "hits": sum(chunk["hits"] for chunk in chunks),
+            "wall_s": wall,
+            "reads_per_sec": round(reads / wall, 1) if wall > 0 else None,
+            "plan_s": self.timings["plan_s"],
+            "parse_s": sum(chunk["parse_s"] for chunk in chunks),
+            "match_s": sum(chunk["match_s"] for chunk in chunks),
+            "audit_s": sum(chunk["audit_s"] for chunk in chunks),
+            "merge_s": self.timings["merge_s"],
+            "write_s": self.timings["write_s"],
+            "workers": len({chunk["worker_pid"] for chunk in chunks}),
+            "worker_peak_rss_mb": max(
+                (chunk["worker_peak_rss_mb"] for chunk in chunks), default=None
+            ),
+        }
+
+    def _write_metrics(self, runner, summary: dict):
+        import json
+
+        with open(f"{runner.result_dir}/{self.sample}+metrics.json", "w") as f:
+            json.dump(
+                {
+                    "sample": self.sample,
+                    "barcodes": self.barcodes,  # Scanned together with a shared index
+                    "input_file": str(self.runner.input_file),
+                    "engine": self.args.engine,
+                    "summary": summary,
+                    "chunks": self.chunk_metrics,
+                },
+                f,
+                indent=2,
+            )
+
+    def _write_results(
+        self, runner, barcode_df, read_counts, read_summary, read_stats, umi_counts
+    ):
+        df = write_extraction_results(
+            runner.result_dir,
+            self.sample,
+            barcode_df,
+            read_counts,
+            read_summary,
+            read_stats,
+            self.args.logger,
+            umi_counts,
+        )
+        if self.args.verbose:
+            self.args.logger.info(
+                f"Generating multiple detection reports of {self.sample}..."
+            )
+            report_multiple_detection(
+                pathlib.Path(runner.assignment_dir),
+                runner.result_dir,
+                self.sample,
+                df,
+            )
 
 
 def system_struct_checker(func):
@@ -265,110 +866,282 @@ def system_struct_checker(func):
 
 @system_struct_checker
 def run_pipeline(args: SimpleNamespace) -> None:
-    for sample, barcode in args.samples:
-        sample = Helper.SplitSampleInfo(sample)
+    if args.merge == "auto":
+        import shutil
 
-        extractor_runner = ExtractorRunner(sample, barcode, args)
+        args.merge = "flash" if shutil.which(args.flash) else "python"
+        if args.merge == "python":
+            args.logger.warning(
+                f"{args.flash} is not found, the read pairs are merged in-process"
+            )
+    if args.shared_index:
+        # The barcode files listed for the same sample share one scan of its reads
+        entries = defaultdict(list)
+        for sample, barcode in args.samples:
+            if barcode not in entries[Helper.SplitSampleInfo(sample)]:
+                entries[Helper.SplitSampleInfo(sample)].append(barcode)
+        entries = list(entries.items())
+    else:
+        entries = [
+            (Helper.SplitSampleInfo(sample), [barcode])
+            for sample, barcode in args.samples
+        ]
 
-        # Chunking
-        args.logger.info("Splitting sequecnes into chunks")
-        extractor_runner._split_into_chunks()
+    args.logger.info("Loading the barcode indexes...")
+    jobs = []
+    for sample, barcodes in entries:
+        job = SampleJob(sample, barcodes, args)
+        if job.completed:
+            args.logger.info(
+                f"{sample} ({', '.join(barcodes)}) is already extracted from the same inputs, skipped"
+            )
+            continue
+        if job.restore_cached():
+            args.logger.info(
+                f"{sample} ({', '.join(barcodes)}): results restored from the result cache, "
+                f"the FASTQ files matched by their {args.fingerprint} fingerprint"
+            )
+            job.finalize()
+            continue
+        jobs.append(job)
 
-        args.logger.info("Populating command...")
-        listCmd = extractor_runner._populate_command(barcode)
+    args.logger.info("RunMulticore")
+    run_extractor_mp(
+        jobs, args.multicore, args.logger, args.concurrent_samples, args.merge_jobs
+    )
 
-        args.logger.info("RunMulticore")
 
-        # Refactor this block of code for flushing memory
-        run_extractor_mp(
-            listCmd,
-            args.multicore,
-            args.logger,
-            args.verbose,
-            args.system_structure.result_dir,
-            sample,
-        )
-        sp.run(
-            [
-                "rm",
-                "-r",
-                f"{pathlib.Path.cwd() / args.system_structure.seq_split_dir}",
-            ]
-        )
+def run_extractor_mp(jobs: list, iCore, logger, max_samples: int, merge_jobs=1) -> None:
+    """
+    > Stream the chunks of all samples through one worker pool
 
+    Up to max_samples samples are active at a time. Their reader threads queue the
+    chunk tasks, which are submitted round-robin with at most 2 * iCore tasks in
+    flight, and the results are folded into their sample as they arrive; the memory
+    does not grow with the input size. Planning the chunks of the next sample and
+    writing the results of a finished one overlap with the extraction.
 
-def run_extractor_mp(
-    lCmd, iCore, logger, verbose_mode: bool, result_dir: pathlib.Path, sample_name
-) -> None:
+    :param jobs: the SampleJob of every sample, in the project file order
+    :param iCore: the number of worker processes
+    :param logger: a logger object
+    :param max_samples: the number of samples extracted concurrently
+    :param merge_jobs: the number of FLASH processes run concurrently
+    """
     import time
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
 
-    import dask.dataframe as dd
-    import numpy as np
     from tqdm import tqdm
 
     from extractor import main as extractor_main
 
-    for sCmd in lCmd:
-        logger.info(f"Running {sCmd} command with {iCore} cores")
+    waiting = deque(jobs)
+    active = []
+    readers = {}  # Reader thread future -> job
+    running = {}  # Worker future -> job
+    finalizing = []
+    # Set by the readers and by the finished worker tasks, the scheduler sleeps otherwise
+    wakeup = threading.Event()
+    merge_slots = threading.BoundedSemaphore(max(merge_jobs, 1))
 
-    result = []
     start = time.time()
-    with ProcessPoolExecutor(max_workers=iCore) as executor:
-        for rval in list(tqdm(executor.map(extractor_main, lCmd), total=len(lCmd))):
-            result.append(rval)
-    end = time.time()
-    logger.info(f"Extraction is done. {end - start}s elapsed.")
+    # The workers load the barcode index of a sample with its first chunk and release
+    # it after the sample, so --concurrent_samples also bounds the indexes held
+    with ProcessPoolExecutor(max_workers=iCore) as executor, ThreadPoolExecutor(
+        max_workers=max(max_samples, 1)
+    ) as read_executor, ThreadPoolExecutor(max_workers=2) as io_executor, tqdm(
+        unit="read", unit_scale=True
+    ) as progress:
+        # The workers are forked before the readers start FLASH or a decompression
+        # process: a worker forked meanwhile would hold the pipes of that child open
+        executor.submit(os.getpid).result()
+        try:
+            while waiting or active:
+                wakeup.clear()
+                while waiting and len(active) < max(max_samples, 1):
+                    job = waiting.popleft()
+                    logger.info(f"Starting {job.sample} ({', '.join(job.barcodes)})")
+                    job.start = time.time()
+                    active.append(job)
+                    future = read_executor.submit(job.produce, wakeup, merge_slots)
+                    future.add_done_callback(lambda _: wakeup.set())
+                    readers[future] = job
+
+                for future in [future for future in readers if future.done()]:
+                    readers.pop(future)
+                    future.result()
+                for future in [future for future in running if future.done()]:
+                    job = running.pop(future)
+                    result = future.result()
+                    job.collect(result)
+                    job.pending -= 1
+                    progress.update(result[-1]["reads"])
+
+                # Round-robin over the active samples, bounded number of tasks in flight
+                live_index_files = frozenset(
+                    str(job.index_file.absolute()) for job in active
+                )
+                submitted = True
+                while submitted and len(running) < 2 * iCore:
+                    submitted = False
+                    for job in active:
+                        if len(running) >= 2 * iCore:
+                            break
+                        sCmd = job.next_command()
+                        if sCmd is None:
+                            continue
+                        future = executor.submit(extractor_main, sCmd, live_index_files)
+                        future.add_done_callback(lambda _: wakeup.set())
+                        running[future] = job
+                        job.pending += 1
+                        submitted = True
+
+                for job in [job for job in active if job.done]:
+                    active.remove(job)
+                    finalizing.append(io_executor.submit(job.finalize))
+                if not active:
+                    continue
+                wakeup.wait()
+        except BaseException:
+            for job in active:
+                job.cancel()
+            raise
+
+        for future in finalizing:
+            future.result()
+    logger.info(f"Extraction is done. {time.time() - start}s elapsed.")
+
+    return
+
 
-    logger.info("Generating statistics...")
+def write_extraction_results(
+    result_dir,
+    sample_name,
+    barcode_df,
+    read_counts,
+    read_summary,
+    read_stats: dict,
+    logger,
+    umi_counts=None,
+):
+    """
+    > Write the read statistics and the extraction result of a sample
+
+    :param result_dir: the result directory of the sample
+    :param sample_name: the sample name
+    :param barcode_df: the Gene/Barcode table the read counts refer to
+    :param read_counts: the read count of every barcode
+    :param read_summary: the ReadSummary of the barcode file
+    :param read_stats: the other read statistics, written as they are
+    :param logger: a logger object
+    :param umi_counts: the unique UMIs of every barcode, written next to the read
+        counts in the UMI mode
+    :return: The Gene/Barcode/Read_counts/RPM dataframe
+    """
+    from Core.ReadFilter import INPUT
+
+    logger.info(f"Generating statistics of {sample_name}...")
 
     with open(f"{result_dir}/{sample_name}+read_statstics.txt", "w") as f:
-        read_stat = np.concatenate([rval for rval in result], axis=0)
-        detected, total_read, detection_rate = (
-            read_stat.sum(),
-            read_stat.shape[0],
-            read_stat.sum() / read_stat.shape[0],
-        )
+        # The summary counts the reads matched, after the quality filter if any
+        detected, matched_read = int(read_summary.detected.sum()), read_summary.total
+        total_read = read_stats.get(INPUT, matched_read)
+        detection_rate = detected / max(total_read, 1)
         f.write(f"Total read: {total_read}\n")
+        if INPUT in read_stats:
+            f.write(f"Read passing the quality filter: {matched_read}\n")
         f.write(f"Detected read: {detected}\n")
         f.write(f"Detection rate in the sequence pool: {detection_rate}\n")
+        if INPUT in read_stats:
+            f.write(
+                "Detection rate in the reads passing the quality filter: "
+                f"{detected / max(matched_read, 1)}\n"
+            )
+        f.write(f"Unmatched read: {matched_read - detected}\n")
+        for key, value in read_stats.items():
+            if key == INPUT:
+                continue
+            if key == "Detected read with mismatches" and value == 0:
+                # Also 0 when not measured, without --mismatch or by the contains engine
+                continue
+            f.write(f"{key}: {value}\n")
+        if "Multi-hit read" not in read_stats:
+            # The contains engine stops at the first barcode found in a read
+            f.write("Multi-hit read: n/a (contains engine)\n")
+        for lengths, count in read_summary.length_distribution().items():
+            f.write(f"Read length {lengths}: {count}\n")
 
-    logger.info("Generating final extraction results...")
-
-    # TODO: asynchronous merging of parquet files
-    # load multiple csv files into one dask dataframe
-    # TODO : Refactor this block of code
-    parquets = []
-    for f in pathlib.Path(f"{result_dir}/parquets").glob("*.parquet"):
-        d_parquet = dd.read_parquet(f)
-        # d_parquet["n_ids"] = d_parquet["ID"].apply(len, meta=("ID", "object"))  # BUG
-        # d_parquet = d_parquet.explode("ID")
-        # d_parquet["Read_counts"] = (
-        #     d_parquet["Read_counts"] / d_parquet["n_ids"]
-        # )  # mutiplied and divided by the number of IDs
-        parquets.append(d_parquet)
-    df = dd.concat(parquets)
+    logger.info(f"Generating final extraction results of {sample_name}...")
 
+    df = barcode_df[["Gene", "Barcode"]].reset_index(drop=True)
+    df["Read_counts"] = read_counts
     df["RPM"] = df["Read_counts"] / df["Read_counts"].sum() * 1e6
+    if umi_counts is not None:
+        # Deduplicated counts, PCR duplicates of a molecule share its UMI
+        df["UMI_counts"] = umi_counts
+        df["UMI_RPM"] = df["UMI_counts"] / df["UMI_counts"].sum() * 1e6
 
-    df.drop(["ID"], axis=1).groupby(["Gene", "Barcode"]).sum().compute().to_csv(
+    df.groupby(["Gene", "Barcode"]).sum().to_csv(
         f"{result_dir}/{sample_name}+extraction_result.csv", index=True
     )
-    # TODO: refactor this block of code
+    return df
 
-    # if verbose_mode:
-    #     # Create NGS_ID_classification.csv
 
-    #     df.drop(["Read_counts"], axis=1).dropna(subset=["ID"]).set_index(
-    #         "ID"
-    #     ).compute().to_csv(
-    #         f"{result_dir}/{sample_name}+multiple_detection_test_result.csv", index=True
-    #     )
-    #     # Create Barcode_multiple_detection_test.csv
-    #     df.groupby(["ID"])["Barcode"].count().compute().to_csv(
-    #         f"{result_dir}/{sample_name}+multiple_detection_test_by_id.csv"
-    #     )
+def report_multiple_detection(
+    assignment_dir: pathlib.Path,
+    result_dir: pathlib.Path,
+    sample_name,
+    barcode_df,
+) -> None:
+    """
+    > Summarize the reads hitting several barcodes from the per-read assignment tables
 
-    #     # Create statistics for analysis
-    #     gc.collect()
+    The Arrow tables are memory-mapped and reduced one chunk at a time.
 
-    return
+    :param assignment_dir: the directory of the audit mode assignment tables
+    :param result_dir: the result directory of the sample
+    :param sample_name: the sample name
+    :param barcode_df: the Gene/Barcode table the barcode indices refer to
+    """
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+
+    n_barcodes = barcode_df.shape[0]
+    hit_reads = np.zeros(n_barcodes, dtype=np.int64)
+    assigned_reads = np.zeros(n_barcodes, dtype=np.int64)
+    shared_reads = np.zeros(n_barcodes, dtype=np.int64)
+    barcodes_per_read = Counter()
+
+    for assignment_file in sorted(assignment_dir.glob("*.arrow")):
+        with pa.memory_map(str(assignment_file), "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+        reads = table.column("Read").to_numpy()
+        barcodes = table.column("Barcode").to_numpy()
+        assigned = table.column("Assigned").to_numpy(zero_copy_only=False)
+        if reads.shape[0] == 0:
+            continue
+
+        hits_per_read = np.bincount(reads)
+        shared = hits_per_read[reads] > 1
+        hit_reads += np.bincount(barcodes, minlength=n_barcodes)
+        assigned_reads += np.bincount(barcodes[assigned], minlength=n_barcodes)
+        shared_reads += np.bincount(barcodes[shared], minlength=n_barcodes)
+        n_hits, n_reads = np.unique(
+            hits_per_read[hits_per_read > 0], return_counts=True
+        )
+        barcodes_per_read.update(dict(zip(n_hits.tolist(), n_reads.tolist())))
+
+    df = barcode_df[["Gene", "Barcode"]].copy()
+    df["Hit_reads"] = hit_reads
+    df["Assigned_reads"] = assigned_reads
+    df["Shared_reads"] = shared_reads  # Hits in reads where several barcodes are found
+    df.to_csv(
+        f"{result_dir}/{sample_name}+multiple_detection_test_result.csv", index=False
+    )
+
+    pd.DataFrame(
+        sorted(barcodes_per_read.items()), columns=["Barcodes_per_read", "Reads"]
+    ).to_csv(
+        f"{result_dir}/{sample_name}+multiple_detection_test_by_id.csv", index=False
+    )
@@ -0,0 +1,186 @@
+import pathlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from Core.FastqIO import FastqChunk, plan_chunks
+
+
+def find_flank(seq: str, flank: str, start=0, max_mismatch=0) -> int:
+    """
+    > First position of a constant region in a read, with up to max_mismatch substitutions
+
+    Exact matches are found with str.find. With mismatches, the flank is cut into
+    max_mismatch + 1 pieces, one of which has to match exactly (pigeonhole), and the
+    candidate positions of every piece are verified by Hamming distance.
+
+    :param seq: the read sequence
+    :param flank: the constant region
+    :param start: the first position searched
+    :param max_mismatch: the number of substitutions tolerated
+    :return: The position of the flank, -1 when it is not found
+    """
+    if max_mismatch == 0:
+        return seq.find(flank, start)
+
+    best = seq.find(flank, start)
+    if best == start:
+        return best
+    size = len(flank) // (max_mismatch + 1)
+    for piece_start in range(0, size * (max_mismatch + 1), size):
+        piece_end = (
+            len(flank) if piece_start + 2 * size > len(flank) else piece_start + size
+        )
+        piece = flank[piece_start:piece_end]
+        pos = seq.find(piece, start + piece_start)
+        while pos >= 0:
+            candidate = pos - piece_start
+            if best >= 0 and candidate >= best:
+                break
+            if candidate + len(flank) <= len(seq) and (
+                _hamming(seq[candidate : candidate + len(flank)], flank) <= max_mismatch
+            ):
+                best = candidate
+                break
+            pos = seq.find(piece, pos + 1)
+    return best
+
+
+def _hamming(a: str, b: str) -> int:
+    return sum(x != y for x, y in zip(a, b))
+
+
+class FlankLocator(object):
+    """
+    > Reads out the barcode between an upstream and a downstream constant region
+
+    With barcode_length, the barcode is the window of that length after the upstream
+    region, and the downstream region is only checked right after it. Without, the
+    barcode runs up to the next occurrence of the downstream region.
+    """
+
+    def __init__(self, upstream="", downstream="", barcode_length=None, max_mismatch=0):
+        if not upstream and not downstream:
+            raise ValueError("At least one constant region is required")
+        if not (upstream and downstream) and barcode_length is None:
+            raise ValueError("A single constant region requires the barcode length")
+        for flank in (upstream, downstream):
+            if flank and len(flank) <= max_mismatch:
+                raise ValueError(f"{flank} is too short for {max_mismatch} mismatches")
+
+        self.upstream = upstream.upper()
+        self.downstream = downstream.upper()
+        self.barcode_length = barcode_length
+        self.max_mismatch = max_mismatch
+
+    def barcode(self, seq: str):
+        # (barcode, None) or (None, the reason the read has no barcode)
+        if not self.upstream:
+            end = find_flank(
+                seq, self.downstream, self.barcode_length, self.max_mismatch
+            )
+            if end < 0:
+                return None, "Downstream region not found"
+            return seq[end - self.barcode_length : end], None
+
+        pos = find_flank(seq, self.upstream, 0, self.max_mismatch)
+        if pos < 0:
+            return None, "Upstream region not found"
+        start = pos + len(self.upstream)
+
+        if self.barcode_length is None:
+            end = find_flank(seq, self.downstream, start, self.max_mismatch)
+            if end < 0:
+                return None, "Downstream region not found"
+            if end == start:
+                return None, "Empty barcode"
+            return seq[start:end], None
+
+        end = start + self.barcode_length
+        if end + len(self.downstream) > len(seq):
+            return None, "Read too short"
+        if self.downstream and (
+            _hamming(seq[end : end + len(self.downstream)], self.downstream)
+            > self.max_mismatch
+        ):
+            return None, "Downstream region not found"
+        return seq[start:end], None
+
+
+def discover_chunk(chunk: FastqChunk, locator: FlankLocator, validate=True):
+    """
+    > Count the barcodes found between the constant regions of the reads of a chunk
+
+    :param chunk: the reads
+    :param locator: the constant regions
+    :param validate: cheap structural check of the records
+    :return: A Counter of barcode -> reads, and a Counter of the read statistics
+    """
+    barcodes, stats = Counter(), Counter()
+    for batch in chunk.open(validate=validate):
+        stats["Total read"] += len(batch)
+        for seq in batch.sequences:
+            barcode, reason = locator.barcode(seq)
+            if barcode is None:
+                stats[reason] += 1
+            else:
+                barcodes[barcode] += 1
+    stats["Detected read"] = sum(barcodes.values())
+    return barcodes, stats
+
+
+def discover_barcodes(
+    fastq_file: pathlib.Path,
+    locator: FlankLocator,
+    chunk_size=100000,
+    n_jobs=1,
+    validate=True,
+):
+    """
+    > Count the barcodes of a FASTQ file, its chunks matched in parallel
+
+    :param fastq_file: the FASTQ file, plain or gzip compressed
+    :param locator: the constant regions
+    :param chunk_size: the number of reads in a chunk
+    :param n_jobs: the number of worker processes
+    :param validate: cheap structural check of the records
+    :return: A Counter of barcode -> reads, and a Counter of the read statistics
+    """
+    barcodes, stats = Counter(), Counter()
+    with ProcessPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        # Bounded number of chunks in flight, gzip chunks hold their records
+        pending = []
+        for chunk in plan_chunks(fastq_file, chunk_size, threads=min(4, n_jobs)):
+            pending.append(executor.submit(discover_chunk, chunk, locator, validate))
+            if len(pending) >= 2 * max(n_jobs, 1):
+                chunk_barcodes, chunk_stats = pending.pop(0).result()
+                barcodes.update(chunk_barcodes)
+                stats.update(chunk_stats)
+        for future in pending:
+            chunk_barcodes, chunk_stats = future.result()
+            barcodes.update(chunk_barcodes)
+            stats.update(chunk_stats)
+    return barcodes, stats
+
+
+def barcode_library(barcodes: Counter, min_reads=1, gene_prefix="BC") -> pd.DataFrame:
+    """
+    > Turn the discovered barcodes into a barcode library, the most abundant first
+
+    :param barcodes: the Counter of barcode -> reads
+    :param min_reads: the reads a barcode needs to be kept
+    :param gene_prefix: the barcodes are named gene_prefix + their rank
+    :return: A Gene/Barcode/Reads dataframe
+    """
+    df = pd.DataFrame(barcodes.most_common(), columns=["Barcode", "Reads"])
+    df = df[df["Reads"] >= min_reads].reset_index(drop=True)
+    df.insert(0, "Gene", [f"{gene_prefix}{rank + 1}" for rank in range(df.shape[0])])
+    return df
+
+
+def write_barcode_library(df: pd.DataFrame, barcode_file: pathlib.Path, sep=":"):
+    # The format of the files in Barcodes, see Core.BarcodeMatcher.load_barcodes
+    with open(barcode_file, "w") as f:
+        for gene, barcode in zip(df["Gene"], df["Barcode"]):
+            f.write(f"{gene}{sep}{barcode}\n")
@@ -0,0 +1,484 @@
+import gzip
+import hashlib
+import io
+import itertools
+import os
+import pathlib
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    from xopen import xopen  # Decompression in a separate pigz/igzip process
+except ImportError:
+    xopen = None
+
+BATCH_SIZE = 10000  # Reads per batch handed to the matching engine
+SCAN_BLOCK_SIZE = 1 << 24  # Bytes read at once while looking for chunk boundaries
+BGZF_SAMPLE_BLOCKS = (
+    16  # BGZF blocks inflated to estimate the number of reads per block
+)
+GZIP_MAGIC = b"\x1f\x8b"
+FINGERPRINT_SAMPLES = 16  # Evenly spaced blocks hashed by fastq_fingerprint
+FINGERPRINT_BLOCK_SIZE = 1 << 16
+# 'sampled' hashes the file status and blocks of the file, 'full' its whole content
+FINGERPRINT_METHODS = ["sampled", "full"]
+
+# 3-bit base codes of the encoded batches: A, C, G, T, N, any other letter, and the
+# padding after the end of a read
+BASE_CODES = np.full(256, 5, dtype=np.uint8)
+BASE_CODES[np.frombuffer(b"ACGTN", dtype=np.uint8)] = np.arange(5, dtype=np.uint8)
+PAD_CODE = 7
+
+
+class ReadBatch(object):
+    """
+    > A batch of FASTQ records kept close to the raw bytes
+
+    Sequences are decoded in one go for the matching engines, the read IDs are only
+    decoded when they are asked for.
+    """
+
+    def __init__(self, headers: list, sequences: list, qualities: list):
+        self.headers = headers
+        self.sequences = sequences
+        self.qualities = qualities
+
+    def __len__(self):
+        return len(self.sequences)
+
+    @property
+    def ids(self) -> list:
+        # Same as the skbio metadata["id"]: the header without "@", up to the first whitespace
+        return [header[1:].split(maxsplit=1)[0].decode() for header in self.headers]
+
+    def encoded(self):
+        return encode_sequences(self.sequences)
+
+
+def encode_sequences(sequences: list):
+    """
+    > Encode reads into a fixed-width uint8 matrix of 3-bit base codes
+
+    :param sequences: a list of upper-case read sequences
+    :return: The (reads, longest read) matrix, padded with PAD_CODE, and the int64
+        array of the read lengths
+    """
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    width = int(lengths.max()) if lengths.shape[0] else 0
+    codes = BASE_CODES[np.frombuffer("".join(sequences).encode("ascii"), np.uint8)]
+    if codes.shape[0] == width * lengths.shape[0]:
+        # Reads of the same length, the usual case before trimming
+        return codes.reshape(lengths.shape[0], width), lengths
+
+    matrix = np.full((lengths.shape[0], width), PAD_CODE, dtype=np.uint8)
+    rows = np.repeat(np.arange(lengths.shape[0]), lengths)
+    columns = np.arange(codes.shape[0]) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    matrix[rows, columns] = codes
+
+    return matrix, lengths
+
+
+def _validate(lines: list, first_read: int):
+    headers, seqs, pluses, quals = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    for n, (header, seq, plus, qual) in enumerate(zip(headers, seqs, pluses, quals)):
+        if (
+            header[:1] != b"@"
+            or plus[:1] != b"+"
+            or len(seq.rstrip(b"\r\n")) != len(qual.rstrip(b"\r\n"))
+        ):
+            raise ValueError(f"Malformed FASTQ record: read {first_read + n + 1}")
+
+
+def read_fastq_batches(
+    handle, batch_size=BATCH_SIZE, validate=True, first_read=0
+) -> ReadBatch:
+    """
+    > Parse a binary FASTQ stream into batches of at most batch_size records
+
+    :param handle: a file object opened in binary mode
+    :param batch_size: the number of records in a batch
+    :param validate: cheap structural check of the records (header, separator and
+        sequence/quality length) instead of the full skbio verification
+    :param first_read: ordinal of the first read of the stream, used in error messages
+    :return: A generator of ReadBatch
+    """
+    n_read = first_read
+    while True:
+        lines = list(itertools.islice(handle, 4 * batch_size))
+        if not lines:
+            return
+        if len(lines) % 4 != 0:
+            raise ValueError(
+                f"Truncated FASTQ record: read {n_read + len(lines) // 4 + 1}"
+            )
+        if validate:
+            _validate(lines, n_read)
+
+        yield ReadBatch(
+            lines[0::4],
+            b"".join(lines[1::4]).decode("ascii").upper().splitlines(),
+            [qual.rstrip(b"\r\n") for qual in lines[3::4]],
+        )
+        n_read += len(lines) // 4
+
+
+def chunk_byte_ranges(sequence_file: pathlib.Path, chunk_size: int) -> list:
+    """
+    > Split a FASTQ file into record-aligned byte ranges of chunk_size reads
+
+    Only the newlines are counted, nothing is written to the disk.
+
+    :param sequence_file: the FASTQ file
+    :param chunk_size: the number of reads in a chunk
+    :return: A list of (start, end) byte offsets, end excluded
+    """
+    lines_per_chunk = 4 * chunk_size
+    boundaries = [0]
+    offset, n_lines = 0, 0  # n_lines: complete lines since the last boundary
+
+    with open(sequence_file, "rb") as handle:
+        while True:
+            block = handle.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+
+            n_newlines = block.count(b"\n")
+            if n_lines + n_newlines >= lines_per_chunk:
+                newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+                idx = lines_per_chunk - n_lines - 1
+                while idx < n_newlines:
+                    boundaries.append(offset + int(newlines[idx]) + 1)
+                    idx += lines_per_chunk
+                n_lines = n_newlines - (idx - lines_per_chunk) - 1
+            else:
+                n_lines += n_newlines
+            offset += len(block)
+
+    return [
+        (start, end)
+        for start, end in zip(boundaries, boundaries[1:] + [offset])
+        if start < end
+    ]
+
+
+class _ByteRange(io.RawIOBase):
+    # Raw stream over [start, end) of a file, wrapped in a BufferedReader for fast line iteration
+
+    def __init__(self, sequence_file: pathlib.Path, start: int, end: int):
+        self._raw = open(sequence_file, "rb", buffering=0)
+        self._raw.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._remaining <= 0:
+            return 0
+        n_bytes = self._raw.readinto(memoryview(buffer)[: self._remaining])
+        self._remaining -= n_bytes
+        return n_bytes
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+def _bgzf_block_header(handle):
+    # Reads a BGZF block header, returns (block length, header length), (0, 0) at EOF
+    header = handle.read(12)
+    if not header:
+        return 0, 0
+    if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+        raise ValueError("Not a BGZF block")
+
+    (xlen,) = struct.unpack("<H", header[10:12])
+    extra = handle.read(xlen)
+    pos = 0
+    while pos + 4 <= len(extra):
+        (slen,) = struct.unpack("<H", extra[pos + 2 : pos + 4])
+        if extra[pos : pos + 2] == b"BC" and slen == 2:
+            (bsize,) = struct.unpack("<H", extra[pos + 4 : pos + 6])
+            return bsize + 1, 12 + xlen
+        pos += 4 + slen
+
+    raise ValueError("Not a BGZF block")
+
+
+def _inflate_bgzf_block(handle):
+    # Returns the uncompressed data of the next block, None at EOF
+    block_length, header_length = _bgzf_block_header(handle)
+    if not block_length:
+        return None
+    payload = handle.read(block_length - header_length)
+    return zlib.decompress(
+        payload[:-8], -15
+    )  # Raw deflate, without the CRC32/ISIZE footer
+
+
+def compression_of(sequence_file: pathlib.Path) -> str:
+    """
+    > Detect the compression of a FASTQ file from its content
+
+    :param sequence_file: the FASTQ file
+    :return: "bgzf", "gzip" or "plain"
+    """
+    with open(sequence_file, "rb") as handle:
+        if handle.read(2) != GZIP_MAGIC:
+            return "plain"
+        handle.seek(0)
+        try:
+            _bgzf_block_header(handle)
+        except ValueError:
+            return "gzip"
+    return "bgzf"
+
+
+def bgzf_block_ranges(sequence_file: pathlib.Path, chunk_size: int) -> list:
+    """
+    > Group the BGZF blocks of a file into ranges of about chunk_size reads
+
+    The number of reads per block is estimated from the first blocks, so the chunk size
+    is approximate for BGZF inputs.
+
+    :param sequence_file: the BGZF compressed FASTQ file
+    :param chunk_size: the number of reads in a chunk
+    :return: A list of (start, end) compressed byte offsets of block boundaries
+    """
+    offsets = []
+    with open(sequence_file, "rb") as handle:
+        offset = 0
+        while True:
+            handle.seek(offset)
+            block_length, _ = _bgzf_block_header(handle)
+            if not block_length:
+                break
+            offsets.append(offset)
+            offset += block_length
+
+        handle.seek(0)
+        n_newlines, n_blocks = 0, 0
+        for _ in range(BGZF_SAMPLE_BLOCKS):
+            data = _inflate_bgzf_block(handle)
+            if data is None:
+                break
+            n_newlines += data.count(b"\n")
+            n_blocks += 1
+
+    reads_per_block = n_newlines / 4 / max(n_blocks, 1)
+    blocks_per_chunk = (
+        max(1, round(chunk_size / reads_per_block)) if reads_per_block else 1
+    )
+    boundaries = offsets[::blocks_per_chunk]
+
+    return list(zip(boundaries, boundaries[1:] + [offset]))
+
+
+class _BgzfRange(io.RawIOBase):
+    # Raw stream inflating BGZF blocks from start to the end of the file; only the blocks
+    # before end are owned by the chunk, the rest is read to complete its last record
+
+    def __init__(self, sequence_file: pathlib.Path, start: int, end: int):
+        self._raw = open(sequence_file, "rb")
+        self._raw.seek(start)
+        self._offset = start
+        self._end = end
+        self._pending = memoryview(b"")
+        self.owned = 0  # Uncompressed bytes coming from the owned blocks
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            data = _inflate_bgzf_block(self._raw)
+            if data is None:
+                return 0
+            if self._offset < self._end:
+                self.owned += len(data)
+            self._offset = self._raw.tell()
+            self._pending = memoryview(data)
+
+        n_bytes = min(len(buffer), len(self._pending))
+        buffer[:n_bytes] = self._pending[:n_bytes]
+        self._pending = self._pending[n_bytes:]
+        return n_bytes
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+def _owned_lines(handle, raw: _BgzfRange, first_chunk: bool):
+    # A record belongs to the chunk whose owned bytes hold the newline before its header
+    lines = iter(handle)
+    pos = 0
+    if not first_chunk:
+        # Skip the partial line, then resync on a header: a quality line can start with
+        # "@" as well, but two lines after it comes a sequence, never a "+" line
+        pos += len(next(lines, b""))
+        ahead = list(itertools.islice(lines, 3))
+        while ahead and not (
+            len(ahead) == 3 and ahead[0][:1] == b"@" and ahead[2][:1] == b"+"
+        ):
+            pos += len(ahead.pop(0))
+            ahead.extend(itertools.islice(lines, 1))
+        lines = itertools.chain(ahead, lines)
+
+    while True:
+        record = list(itertools.islice(lines, 4))
+        if not record or (pos > raw.owned):
+            return
+        pos += sum(len(line) for line in record)
+        yield from record
+
+
+def gzip_chunks(sequence_file: pathlib.Path, chunk_size: int, threads=1):
+    """
+    > Decompress a gzip FASTQ as a stream and cut it into chunks of chunk_size reads
+
+    :param sequence_file: the gzip compressed FASTQ file
+    :param chunk_size: the number of reads in a chunk
+    :param threads: decompression threads, used when xopen is installed
+    :return: A generator of FastqChunk holding the records in memory
+    """
+    if xopen is not None:
+        handle = xopen(sequence_file, "rb", threads=threads)
+    else:
+        handle = gzip.open(sequence_file, "rb")
+
+    with handle:
+        first_read = 0
+        while True:
+            lines = list(itertools.islice(handle, 4 * chunk_size))
+            if not lines:
+                return
+            yield FastqChunk(
+                sequence_file,
+                first_read,
+                first_read + len(lines) // 4,
+                data=b"".join(lines),
+            )
+            first_read += len(lines) // 4
+
+
+def fastq_fingerprint(sequence_file: pathlib.Path, method="sampled") -> str:
+    """
+    > Content fingerprint of a large FASTQ file
+
+    The 'sampled' method hashes the size, the modification time and the inode of the
+    file with evenly spaced blocks of it, the first and the last one included, instead
+    of the whole content: an edit between the blocks that keeps the size is only seen
+    through the modification time. The 'full' method hashes the whole content, and
+    does not change when the file is copied or touched.
+
+    :param sequence_file: the FASTQ file, compressed or not
+    :param method: sampled or full
+    :return: The hex digest
+    """
+    stat = os.stat(sequence_file)
+    if method == "full":
+        digest = hashlib.sha256(f"{stat.st_size}".encode())
+        with open(sequence_file, "rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    size = stat.st_size
+    digest = hashlib.sha256(f"{size}:{stat.st_mtime_ns}:{stat.st_ino}".encode())
+    with open(sequence_file, "rb") as handle:
+        for sample in range(FINGERPRINT_SAMPLES + 1):
+            handle.seek(
+                max(size - FINGERPRINT_BLOCK_SIZE, 0) * sample // FINGERPRINT_SAMPLES
+            )
+            digest.update(handle.read(FINGERPRINT_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+class FastqChunk(object):
+    """
+    > A unit of work for the extraction workers
+
+    start and end are record-aligned byte offsets for plain files, block offsets for
+    BGZF files and read ordinals for gzip streams, whose records are carried in data.
+    """
+
+    def __init__(
+        self, sequence_file, start: int, end: int, compression="plain", data=None
+    ):
+        self.sequence_file = str(sequence_file)
+        self.start = start
+        self.end = end
+        self.compression = "gzip" if data is not None else compression
+        self.data = data
+
+    def __repr__(self):
+        return f"FastqChunk({self.sequence_file}, {self.start}, {self.end}, {self.compression})"
+
+    @property
+    def name(self) -> str:
+        # Identifies the chunk in the audit tables, the metrics and the checkpoints
+        return f"{pathlib.Path(self.sequence_file).name}+{self.start}"
+
+    def open(self, batch_size=BATCH_SIZE, validate=True):
+        """
+        > Stream the records of the chunk as ReadBatch objects
+        """
+        if self.data is not None:
+            yield from read_fastq_batches(
+                io.BytesIO(self.data), batch_size, validate, self.start
+            )
+        elif self.compression == "bgzf":
+            raw = _BgzfRange(self.sequence_file, self.start, self.end)
+            with io.BufferedReader(raw) as handle:
+                yield from read_fastq_batches(
+                    _owned_lines(handle, raw, self.start == 0), batch_size, validate
+                )
+        else:
+            yield from open_fastq(
+                self.sequence_file, self.start, self.end, batch_size, validate
+            )
+
+
+def plan_chunks(sequence_file: pathlib.Path, chunk_size: int, threads=1):
+    """
+    > Plan the chunks of a plain, BGZF or gzip compressed FASTQ file
+
+    :param sequence_file: the FASTQ file
+    :param chunk_size: the number of reads in a chunk
+    :param threads: decompression threads for gzip streams
+    :return: A list of FastqChunk, or a generator of them for gzip streams
+    """
+    compression = compression_of(sequence_file)
+    if compression == "gzip":
+        return gzip_chunks(sequence_file, chunk_size, threads)
+    if compression == "bgzf":
+        ranges = bgzf_block_ranges(sequence_file, chunk_size)
+    else:
+        ranges = chunk_byte_ranges(sequence_file, chunk_size)
+
+    return [FastqChunk(sequence_file, start, end, compression) for start, end in ranges]
+
+
+def open_fastq(
+    sequence_file: pathlib.Path,
+    start=0,
+    end=None,
+    batch_size=BATCH_SIZE,
+    validate=True,
+):
+    """
+    > Stream a FASTQ file, or a record-aligned byte range of it, as ReadBatch objects
+
+    :param sequence_file: the FASTQ file
+    :param start: the first byte of the range
+    :param end: the end of the range (excluded), the end of the file by default
+    :return: A generator of ReadBatch
+    """
+    end = os.path.getsize(sequence_file) if end is None else end
+    with io.BufferedReader(_ByteRange(sequence_file, start, end)) as handle:
+        yield from read_fastq_batches(handle, batch_size, validate)
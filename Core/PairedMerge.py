@@ -0,0 +1,340 @@
+import itertools
+import os
+import pathlib
+import re
+import subprocess
+from collections import Counter
+
+import numpy as np
+
+from Core.BarcodeMatcher import reverse_complement
+from Core.FastqIO import (
+    BATCH_SIZE,
+    FastqChunk,
+    ReadBatch,
+    chunk_byte_ranges,
+    compression_of,
+    encode_sequences,
+)
+from Core.Separator import _open_records
+
+# Defaults of FLASH, -m, -M and -x
+MIN_OVERLAP = 10
+MAX_OVERLAP = 65
+MAX_MISMATCH_DENSITY = 0.25
+MIN_QUALITY = 2  # Phred quality of a base the mates disagree on, at least
+PHRED_OFFSET = 33
+
+# {stem}_1.fastq.gz / {stem}_2.fastq.gz, or the Illumina {stem}_R1_001.fastq.gz; the
+# extension is not part of the key, a pair may mix plain and compressed mates
+MATE_PATTERN = re.compile(
+    r"^(?P<stem>.+)[_.]R?(?P<mate>[12])(?P<lane>_\d+)?\.f(ast)?q(\.gz)?$"
+)
+FASTQ_SUFFIXES = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+FLASH_STATS = {"Combined pairs": "Merged pair", "Uncombined pairs": "Unmerged pair"}
+
+
+def find_read_pair(files: list):
+    """
+    > Find the two mates of a paired-end run among the files of a sample
+
+    :param files: the files of the sample folder
+    :return: The (R1, R2) paths, None when the files do not hold a pair
+    """
+    mates = {}
+    for file in sorted(files):
+        match = MATE_PATTERN.match(pathlib.Path(file).name)
+        if match is not None:
+            mates[match["stem"], match["lane"], match["mate"]] = file
+    for (stem, lane, mate), file in mates.items():
+        if mate == "1" and (stem, lane, "2") in mates:
+            return file, mates[stem, lane, "2"]
+    return None
+
+
+def best_overlaps(
+    sequences: list,
+    mates: list,
+    min_overlap=MIN_OVERLAP,
+    max_overlap=MAX_OVERLAP,
+    max_mismatch_density=MAX_MISMATCH_DENSITY,
+) -> np.ndarray:
+    """
+    > Find the overlap of every read with the reverse complement of its mate
+
+    As FLASH does, the overlap with the lowest mismatch density wins, the longest one
+    on a tie, and the density of an overlap longer than max_overlap is taken over its
+    first max_overlap bases. Every overlap length is tried on the whole batch at once:
+    the reads are encoded reversed, so the end of every read is a slice, and stored
+    base-major, so the slices are contiguous rows.
+
+    :param sequences: the reads
+    :param mates: the reverse complements of their mates
+    :param min_overlap: the shortest overlap accepted
+    :param max_overlap: the number of bases the mismatch density is taken over
+    :param max_mismatch_density: the highest mismatch density accepted
+    :return: The int64 array of the overlap lengths, 0 for the pairs left unmerged
+    """
+    reverse, lengths = encode_sequences([seq[::-1] for seq in sequences])
+    forward, mate_lengths = encode_sequences(mates)
+    reverse, forward = np.ascontiguousarray(reverse.T), np.ascontiguousarray(forward.T)
+    shortest = np.minimum(lengths, mate_lengths)
+
+    overlaps = np.zeros(len(sequences), dtype=np.int64)
+    best_density = np.full(len(sequences), np.inf)
+    for overlap in range(min_overlap, int(shortest.max(initial=0)) + 1):
+        width = min(overlap, max_overlap)
+        # The last bases of the reads, from the first base of the overlap on
+        ends = reverse[overlap - width : overlap][::-1]
+        density = (ends != forward[:width]).sum(axis=0, dtype=np.int32) / width
+        better = (
+            (overlap <= shortest)
+            & (density <= max_mismatch_density)
+            & (density <= best_density)
+        )
+        overlaps[better] = overlap
+        best_density[better] = density[better]
+    return overlaps
+
+
+def _consensus(seq1: str, seq2: str, qual1: bytes, qual2: bytes):
+    # The better base of every overlapping position, the agreeing bases reinforce each
+    # other and a disagreement costs the difference of the two qualities
+    if seq1 == seq2:
+        return (
+            seq1,
+            np.maximum(
+                np.frombuffer(qual1, np.uint8), np.frombuffer(qual2, np.uint8)
+            ).tobytes(),
+        )
+
+    bases1, bases2 = np.frombuffer(seq1.encode(), np.uint8), np.frombuffer(
+        seq2.encode(), np.uint8
+    )
+    quals1, quals2 = np.frombuffer(qual1, np.uint8), np.frombuffer(qual2, np.uint8)
+    first = quals1 >= quals2
+    quality = np.where(
+        bases1 == bases2,
+        np.maximum(quals1, quals2),
+        np.maximum(
+            np.abs(quals1.astype(np.int16) - quals2) + PHRED_OFFSET,
+            MIN_QUALITY + PHRED_OFFSET,
+        ),
+    )
+    return (
+        np.where(first, bases1, bases2).tobytes().decode(),
+        quality.astype(np.uint8).tobytes(),
+    )
+
+
+def merge_pairs(batch: ReadBatch, mate_batch: ReadBatch, **kwargs):
+    """
+    > Merge the overlapping mates of a batch of read pairs into single reads
+
+    :param batch: the R1 reads
+    :param mate_batch: the R2 reads, in the same order
+    :param kwargs: see best_overlaps
+    :return: A ReadBatch of the merged reads, with the R1 headers, and the number of
+        pairs left unmerged
+    """
+    if len(batch) != len(mate_batch):
+        raise ValueError("The mate files do not hold the same number of reads")
+    mates = [reverse_complement(seq) for seq in mate_batch.sequences]
+    overlaps = best_overlaps(batch.sequences, mates, **kwargs)
+
+    headers, sequences, qualities = [], [], []
+    for read in np.flatnonzero(overlaps).tolist():
+        overlap = int(overlaps[read])
+        seq1, seq2 = batch.sequences[read], mates[read]
+        qual1, qual2 = batch.qualities[read], mate_batch.qualities[read][::-1]
+        head = len(seq1) - overlap
+        sequence, quality = _consensus(
+            seq1[head:], seq2[:overlap], qual1[head:], qual2[:overlap]
+        )
+        headers.append(batch.headers[read])
+        sequences.append(seq1[:head] + sequence + seq2[overlap:])
+        qualities.append(qual1[:head] + quality + qual2[overlap:])
+
+    return ReadBatch(headers, sequences, qualities), len(batch) - len(sequences)
+
+
+class PairedChunk(object):
+    """
+    > The same reads of the two mate files, merged by the worker as they are parsed
+
+    Stands for a FastqChunk of the merged reads; the pairs merged and left unmerged are
+    counted in merge_stats while the chunk is read.
+    """
+
+    def __init__(self, chunk: FastqChunk, mate_chunk: FastqChunk, merge_options: dict):
+        self.chunk = chunk
+        self.mate_chunk = mate_chunk
+        self.merge_options = merge_options
+        self.merge_stats = Counter()
+
+    def __repr__(self):
+        return f"PairedChunk({self.chunk}, {self.mate_chunk})"
+
+    @property
+    def sequence_file(self) -> str:
+        return self.chunk.sequence_file
+
+    @property
+    def start(self) -> int:
+        return self.chunk.start
+
+    @property
+    def end(self) -> int:
+        return self.chunk.end
+
+    @property
+    def name(self) -> str:
+        return self.chunk.name
+
+    def open(self, batch_size=BATCH_SIZE, validate=True):
+        batches = itertools.zip_longest(
+            self.chunk.open(batch_size, validate),
+            self.mate_chunk.open(batch_size, validate),
+        )
+        for batch, mate_batch in batches:
+            if batch is None or mate_batch is None:
+                raise ValueError("The mate files do not hold the same number of reads")
+            merged, n_unmerged = merge_pairs(batch, mate_batch, **self.merge_options)
+            self.merge_stats["Merged pair"] += len(merged)
+            self.merge_stats["Unmerged pair"] += n_unmerged
+            yield merged
+
+
+def plan_pair_chunks(
+    sequence_file: pathlib.Path,
+    mate_file: pathlib.Path,
+    chunk_size: int,
+    merge_options: dict,
+):
+    """
+    > Plan the chunks of a read pair, the same reads of both mate files in every chunk
+
+    Plain files are cut into byte ranges of chunk_size reads; compressed files are
+    decompressed side by side and their chunks carry the records.
+
+    :param sequence_file: the R1 FASTQ file
+    :param mate_file: the R2 FASTQ file
+    :param chunk_size: the number of read pairs in a chunk
+    :param merge_options: see best_overlaps
+    :return: A list of PairedChunk, or a generator of them for compressed files
+    """
+    if compression_of(sequence_file) == compression_of(mate_file) == "plain":
+        ranges = chunk_byte_ranges(sequence_file, chunk_size)
+        mate_ranges = chunk_byte_ranges(mate_file, chunk_size)
+        if len(ranges) != len(mate_ranges):
+            raise ValueError("The mate files do not hold the same number of reads")
+        return [
+            PairedChunk(
+                FastqChunk(sequence_file, *byte_range),
+                FastqChunk(mate_file, *mate_range),
+                merge_options,
+            )
+            for byte_range, mate_range in zip(ranges, mate_ranges)
+        ]
+    return _streamed_pair_chunks(sequence_file, mate_file, chunk_size, merge_options)
+
+
+def _streamed_pair_chunks(sequence_file, mate_file, chunk_size: int, merge_options):
+    with _open_records(sequence_file) as handle, _open_records(mate_file) as mate:
+        first_read = 0
+        while True:
+            lines = list(itertools.islice(handle, 4 * chunk_size))
+            mate_lines = list(itertools.islice(mate, 4 * chunk_size))
+            if len(lines) != len(mate_lines):
+                raise ValueError("The mate files do not hold the same number of reads")
+            if not lines:
+                return
+            last_read = first_read + len(lines) // 4
+            yield PairedChunk(
+                FastqChunk(sequence_file, first_read, last_read, data=b"".join(lines)),
+                FastqChunk(mate_file, first_read, last_read, data=b"".join(mate_lines)),
+                merge_options,
+            )
+            first_read = last_read
+
+
+def flash_chunks(
+    sequence_file: pathlib.Path,
+    mate_file: pathlib.Path,
+    chunk_size: int,
+    merge_options: dict,
+    flash="flash",
+    log_file=None,
+    merge_stats=None,
+):
+    """
+    > Merge a read pair with FLASH and cut its output into chunks while it runs
+
+    The merged reads are read from the standard output of FLASH, nothing is written to
+    the disk but its log; FLASH waits while the chunks are not consumed. FLASH runs a
+    single thread: with more, its output order changes from run to run, while the
+    chunks are named and checkpointed by their read ordinals.
+
+    :param sequence_file: the R1 FASTQ file
+    :param mate_file: the R2 FASTQ file
+    :param chunk_size: the number of merged reads in a chunk
+    :param merge_options: see best_overlaps, passed as -m, -M and -x
+    :param flash: the FLASH executable
+    :param log_file: the file FLASH writes its messages to
+    :param merge_stats: a Counter given the pairs merged and left unmerged by FLASH
+    :return: A generator of FastqChunk holding the merged records
+    """
+    options = {
+        "min_overlap": MIN_OVERLAP,
+        "max_overlap": MAX_OVERLAP,
+        "max_mismatch_density": MAX_MISMATCH_DENSITY,
+        **merge_options,
+    }
+    command = [
+        str(flash),
+        str(sequence_file),
+        str(mate_file),
+        "--to-stdout",
+        f"--min-overlap={options['min_overlap']}",
+        f"--max-overlap={options['max_overlap']}",
+        f"--max-mismatch-density={options['max_mismatch_density']}",
+        "--threads=1",
+    ]
+    with open(log_file or os.devnull, "wb") as log:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log)
+        try:
+            first_read = 0
+            while True:
+                lines = list(itertools.islice(process.stdout, 4 * chunk_size))
+                if not lines:
+                    break
+                yield FastqChunk(
+                    sequence_file,
+                    first_read,
+                    first_read + len(lines) // 4,
+                    data=b"".join(lines),
+                )
+                first_read += len(lines) // 4
+        except BaseException:
+            # Stopped early when the extraction is cancelled
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"FLASH exited with {process.returncode}, see {log_file}")
+    if merge_stats is not None and log_file is not None:
+        merge_stats.update(parse_flash_log(log_file))
+
+
+def parse_flash_log(log_file: pathlib.Path) -> Counter:
+    # "[FLASH]     Combined pairs:   9000" and "[FLASH]     Uncombined pairs: 1000"
+    stats = Counter()
+    with open(log_file) as f:
+        for line in f:
+            key, _, value = line.replace("[FLASH]", "").partition(":")
+            if key.strip() in FLASH_STATS and value.strip().isdigit():
+                stats[FLASH_STATS[key.strip()]] = int(value)
+    return stats
@@ -0,0 +1,113 @@
+import numpy as np
+
+MAX_SEQUENCES = 1 << 18  # Sequences remembered by a worker across its chunks
+
+# Read statistics of the collapse, summed over the chunks
+MATCHED = "Matched read sequence"
+RATIO = "Read collapse ratio"
+EVICTION = "Collapse table eviction"
+DROPPED = "Read sequence dropped from the collapse table"
+
+# Engines matching every read on its whole sequence; the position engine is a single
+# lookup per read already and counts the reads without a barcode window as it goes
+COLLAPSED_ENGINES = ["aho-corasick", "vectorized"]
+
+
+class ReadCollapser(object):
+    """
+    > Matches every distinct read sequence once, the identical reads share its result
+
+    The reads of a batch are made unique with a dict, and the sequences already matched
+    in an earlier batch or chunk of the worker are looked up in a table of their ranks,
+    so only the new ones reach the matcher. The ranks of every read are then turned
+    into its assignment as if it had been matched, the mismatch and multi-hit counters
+    included.
+
+    The table holds at most max_sequences sequences. When it is full, the less abundant
+    half is dropped: a high-diversity sample fills it with sequences met once, while the
+    abundant sequences of an amplicon library stay. The read counts of the sequences
+    kept are halved, so that the sequences abundant in the first chunks only give way
+    in turn. The evictions and the sequences they drop, or that find no room left, are
+    counted in the read statistics: a dropped sequence met again is matched again.
+
+    :param matcher: the matcher of the barcode index, see Core.BarcodeMatcher
+    :param max_sequences: the size of the table, 0 to collapse within the batches only
+    """
+
+    def __init__(self, matcher, max_sequences=MAX_SEQUENCES):
+        self.matcher = matcher
+        self.max_sequences = max_sequences
+        self.rows = {}  # Sequence -> row of ranks and reads
+        self.sequences = []
+        self.ranks = None
+        self.multi = None  # Whether the sequence hits several barcodes, as ranks
+        self.reads = np.zeros(max_sequences, dtype=np.int64)
+
+    def match(self, sequences: list, read_stats) -> np.ndarray:
+        """
+        > Assign each read like the matcher does
+
+        :param sequences: a list of read sequences
+        :param read_stats: a Counter given the number of sequences actually matched
+        :return: The assignment of the matcher
+        """
+        unique = {}
+        inverse = np.fromiter(
+            (unique.setdefault(seq, len(unique)) for seq in sequences),
+            np.int64,
+            len(sequences),
+        )
+        unique = list(unique)
+        reads = np.bincount(inverse, minlength=len(unique))
+        rows = np.fromiter(
+            (self.rows.get(seq, -1) for seq in unique), np.int64, len(unique)
+        )
+        known, new = np.flatnonzero(rows >= 0), np.flatnonzero(rows < 0).tolist()
+
+        new_ranks, new_multi = self.matcher._best_ranks([unique[read] for read in new])
+        read_stats[MATCHED] += len(new)
+        if self.ranks is None:
+            self.ranks = np.zeros(
+                (self.max_sequences,) + new_ranks.shape[1:], dtype=np.int64
+            )
+            self.multi = np.zeros(self.ranks.shape, dtype=bool)
+        ranks = np.empty((len(unique),) + new_ranks.shape[1:], dtype=np.int64)
+        ranks[known] = self.ranks[rows[known]]
+        ranks[new] = new_ranks
+        multi = np.empty(ranks.shape, dtype=bool)
+        multi[known] = self.multi[rows[known]]
+        multi[new] = new_multi
+        self.reads[rows[known]] += reads[known]
+        self._remember(
+            [unique[read] for read in new], new_ranks, new_multi, reads[new], read_stats
+        )
+
+        return self.matcher._to_assignment(ranks[inverse], multi[inverse])
+
+    def _remember(self, sequences: list, ranks, multi, reads: np.ndarray, read_stats):
+        if len(self.sequences) + len(sequences) > self.max_sequences:
+            self._evict(read_stats)
+        size = len(self.sequences)
+        room = self.max_sequences - size
+        if len(sequences) > room:
+            read_stats[DROPPED] += len(sequences) - room
+        sequences = sequences[:room]
+        self.rows.update(zip(sequences, range(size, size + len(sequences))))
+        self.sequences.extend(sequences)
+        self.ranks[size : len(self.sequences)] = ranks[:room]
+        self.multi[size : len(self.sequences)] = multi[:room]
+        self.reads[size : len(self.sequences)] = reads[:room]
+
+    def _evict(self, read_stats):
+        # The most abundant half stays, in its order
+        size = len(self.sequences)
+        kept = np.sort(
+            np.argsort(-self.reads[:size], kind="stable")[: self.max_sequences // 2]
+        )
+        read_stats[EVICTION] += 1
+        read_stats[DROPPED] += size - kept.shape[0]
+        self.sequences = [self.sequences[row] for row in kept.tolist()]
+        self.rows = dict(zip(self.sequences, range(len(self.sequences))))
+        self.ranks[: kept.shape[0]] = self.ranks[kept]
+        self.multi[: kept.shape[0]] = self.multi[kept]
+        self.reads[: kept.shape[0]] = self.reads[kept] // 2
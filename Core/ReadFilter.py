@@ -0,0 +1,133 @@
+import numpy as np
+
+from Core.FastqIO import ReadBatch
+
+PHRED_OFFSET = 33
+
+# Read statistics of the filter; a read is counted for the first filter it fails
+INPUT = "Read before the quality filter"  # The Total read of the statistics file
+TRIMMED = "Trimmed read kept"
+EMPTY = "Filtered read: empty after trimming"
+MEAN_QUALITY = "Filtered read: mean quality"
+WINDOW_QUALITY = "Filtered read: barcode window quality"
+N_CONTENT = "Filtered read: N content"
+# Only met with --skip_validation, counted when there are some
+MALFORMED = "Filtered read: sequence and quality lengths differ"
+
+
+def _byte_matrix(records: list, lengths: np.ndarray, pad: int, width: int):
+    # Same layout as Core.FastqIO.encode_sequences, on the raw bytes
+    data = np.frombuffer(b"".join(records), dtype=np.uint8)
+    if data.shape[0] == width * lengths.shape[0]:
+        return data.reshape(lengths.shape[0], width)
+
+    matrix = np.full((lengths.shape[0], width), pad, dtype=np.uint8)
+    valid = np.arange(width) < lengths[:, None]
+    matrix[valid] = data
+    return matrix
+
+
+class ReadFilter(object):
+    """
+    > Pre-match quality filter of the read batches
+
+    The quality and base matrices of a batch are built once, right after it is parsed,
+    and the reads are trimmed and filtered with array operations before any of them
+    reaches the matching engine. Every filter is off when its threshold is None.
+
+    :param trim_quality: the 3' bases below this Phred quality are trimmed
+    :param min_mean_quality: the lowest mean Phred quality of a read
+    :param min_window_quality: the lowest Phred quality of a base of the barcode window
+    :param window: the (start, end) of the barcode window, end excluded
+    :param max_n: the largest number of N bases in a read
+    """
+
+    def __init__(
+        self,
+        trim_quality=None,
+        min_mean_quality=None,
+        min_window_quality=None,
+        window=None,
+        max_n=None,
+    ):
+        if min_window_quality is not None and window is None:
+            raise ValueError("The barcode window quality filter requires the window")
+        self.trim_quality = trim_quality
+        self.min_mean_quality = min_mean_quality
+        self.min_window_quality = min_window_quality
+        self.window = window
+        self.max_n = max_n
+
+    def filter(self, batch: ReadBatch, read_stats) -> ReadBatch:
+        """
+        > Trim and filter a batch of reads
+
+        :param batch: the parsed reads
+        :param read_stats: a Counter given the trimmed and filtered reads of every filter
+        :return: The ReadBatch of the reads kept, trimmed
+        """
+        read_stats[INPUT] += len(batch)
+        lengths = np.fromiter(map(len, batch.qualities), np.int64, len(batch))
+        seq_lengths = np.fromiter(map(len, batch.sequences), np.int64, len(batch))
+        # Both matrices share their width, every one is filled from its own lengths
+        width = int(max(lengths.max(initial=0), seq_lengths.max(initial=0)))
+        qualities = _byte_matrix(batch.qualities, lengths, PHRED_OFFSET, width)
+        columns = np.arange(qualities.shape[1])
+        trimmed = lengths
+
+        if self.trim_quality is not None:
+            # The last base at or above the threshold ends the read
+            good = (qualities >= self.trim_quality + PHRED_OFFSET) & (
+                columns < lengths[:, None]
+            )
+            trimmed = np.where(
+                good.any(axis=1), qualities.shape[1] - good[:, ::-1].argmax(axis=1), 0
+            )
+        valid = columns < trimmed[:, None]
+
+        keep = np.ones(len(batch), dtype=bool)
+        rejected = {}
+        if (seq_lengths != lengths).any():
+            rejected[MALFORMED] = seq_lengths != lengths
+        if self.trim_quality is not None:
+            rejected[EMPTY] = trimmed == 0
+        if self.min_mean_quality is not None:
+            total = np.where(valid, qualities, PHRED_OFFSET).sum(axis=1, dtype=np.int64)
+            mean = (total - PHRED_OFFSET * qualities.shape[1]) / np.maximum(trimmed, 1)
+            rejected[MEAN_QUALITY] = mean < self.min_mean_quality
+        if self.min_window_quality is not None:
+            start, end = self.window
+            # Bases past the end of a read do not count, a read too short to hold the
+            # window is left to the matching engine
+            window = np.where(valid, qualities, 255)[:, start:end]
+            lowest = window.min(axis=1, initial=255).astype(np.int64) - PHRED_OFFSET
+            rejected[WINDOW_QUALITY] = lowest < self.min_window_quality
+        if self.max_n is not None:
+            bases = _byte_matrix(
+                ["".join(batch.sequences).encode("ascii")],
+                seq_lengths,
+                ord("A"),
+                width,
+            )
+            n_bases = np.count_nonzero((bases == ord("N")) & valid, axis=1)
+            rejected[N_CONTENT] = n_bases > self.max_n
+
+        for key, mask in rejected.items():
+            read_stats[key] += int(np.count_nonzero(mask & keep))
+            keep &= ~mask
+        if self.trim_quality is not None:
+            read_stats[TRIMMED] += int(np.count_nonzero((trimmed < lengths) & keep))
+        if keep.all() and (trimmed == lengths).all():
+            return batch
+
+        kept, trimmed = np.flatnonzero(keep).tolist(), trimmed.tolist()
+        return ReadBatch(
+            [batch.headers[read] for read in kept],
+            [batch.sequences[read][: trimmed[read]] for read in kept],
+            [batch.qualities[read][: trimmed[read]] for read in kept],
+        )
+
+    def filter_batches(self, batches, read_stats):
+        # Streamed: every batch is filtered as soon as it is parsed
+        for batch in batches:
+            yield self.filter(batch, read_stats)
@@ -0,0 +1,84 @@
+import numpy as np
+
+LENGTH_BUCKET = 10  # Width of the read length buckets, in bases
+
+
+class ReadSummary(object):
+    """
+    > Running read counters of a chunk or of a sample
+
+    This is what the workers return instead of a per-read detection array: the total,
+    the detected reads of every barcode library and the read length histogram. The
+    per-read bitmap is only kept when asked for, with keep_bitmap, and the UmiCounter of
+    the detected reads in the UMI mode.
+    """
+
+    def __init__(self, n_libraries=1, keep_bitmap=False):
+        self.total = 0
+        self.detected = np.zeros(n_libraries, dtype=np.int64)
+        self.length_buckets = np.zeros(0, dtype=np.int64)
+        self.bitmaps = [] if keep_bitmap else None
+        self.umis = None  # Core.UmiCounter.UmiCounter, set by the worker
+
+    def add(self, detected: np.ndarray, lengths: np.ndarray):
+        """
+        > Count a batch of reads
+
+        :param detected: the detection array of the batch, one column per library
+        :param lengths: the read lengths
+        """
+        # One column per library, the batch may be empty after the quality filter
+        detected = detected[:, None] if detected.ndim == 1 else detected
+        self.total += detected.shape[0]
+        self.detected += np.count_nonzero(detected, axis=0)
+        self._add_buckets(np.bincount(np.asarray(lengths) // LENGTH_BUCKET))
+        if self.bitmaps is not None:
+            self.bitmaps.append(detected)
+
+    def _add_buckets(self, buckets: np.ndarray):
+        # Grown to the longest read seen
+        missing = buckets.shape[0] - self.length_buckets.shape[0]
+        if missing > 0:
+            self.length_buckets = np.pad(self.length_buckets, (0, missing))
+        self.length_buckets[: buckets.shape[0]] += buckets
+
+    def merge(self, other: "ReadSummary"):
+        # The bitmaps of the chunks arrive in any order, the caller keeps them by chunk
+        self.total += other.total
+        self.detected += other.detected
+        self._add_buckets(other.length_buckets)
+        if other.umis is not None:
+            if self.umis is None:
+                from Core.UmiCounter import UmiCounter
+
+                self.umis = UmiCounter(
+                    other.umis.n_barcodes, other.umis.sketch, other.umis.precision
+                )
+            self.umis.merge(other.umis)
+
+    def library(self, library: int) -> "ReadSummary":
+        # The counters of one library of a shared index
+        summary = ReadSummary(1)
+        summary.total = self.total
+        summary.detected[0] = self.detected[library]
+        summary.length_buckets = self.length_buckets.copy()
+        return summary
+
+    def bitmap(self) -> np.ndarray:
+        """
+        > The per-read detection array of the batches added, when kept
+
+        :return: A bool array of shape (reads, libraries), None without keep_bitmap
+        """
+        if self.bitmaps is None:
+            return None
+        if not self.bitmaps:
+            return np.zeros((0, self.detected.shape[0]), dtype=bool)
+        return np.concatenate(self.bitmaps, axis=0)
+
+    def length_distribution(self) -> dict:
+        return {
+            f"{bucket * LENGTH_BUCKET}-{(bucket + 1) * LENGTH_BUCKET - 1}": int(count)
+            for bucket, count in enumerate(self.length_buckets)
+            if count
+        }
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import time
+
+import numpy as np
+
+# Bump when the layout of the cached results changes, invalidates the cache
+RESULT_CACHE_VERSION = 2
+
+
+def result_key(fastq_fingerprint: str, barcode_digest: str, params: dict) -> str:
+    """
+    > Content address of the results of one barcode library on one FASTQ file
+
+    :param fastq_fingerprint: see Core.FastqIO.fastq_fingerprint
+    :param barcode_digest: the sha256 of the barcode file
+    :param params: the matching parameters the counts depend on
+    :return: The hex key
+    """
+    return hashlib.sha256(
+        f"{RESULT_CACHE_VERSION}|{fastq_fingerprint}|{barcode_digest}|"
+        f"{sorted(params.items())}".encode()
+    ).hexdigest()
+
+
+class ResultCache(object):
+    """
+    > Local cache of the per-barcode read counts and statistics of finished runs
+
+    An entry is a pickle of the results and a JSON file describing it, both named
+    after the key. Reading an entry refreshes its modification time, and the least
+    recently used entries are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir: pathlib.Path, max_bytes: int = None):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def _files(self, key: str):
+        return self.cache_dir / f"{key}.pkl", self.cache_dir / f"{key}.json"
+
+    def get(self, key: str):
+        """
+        > The cached results of a key
+
+        :param key: see result_key
+        :return: A dict of read_counts, read_summary and read_stats, None on a miss
+        """
+        result_file, _ = self._files(key)
+        try:
+            with open(result_file, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(result_file)
+
+        return entry
+
+    def put(self, key: str, read_counts, read_summary, read_stats: dict, **meta):
+        """
+        > Store the results of a barcode library, then evict over the size limit
+
+        :param key: see result_key
+        :param read_counts: the read count of every barcode
+        :param read_summary: the ReadSummary of the barcode file
+        :param read_stats: the other read statistics
+        :param meta: what the entry is about, shown by inspect()
+        """
+        result_file, meta_file = self._files(key)
+        entry = {
+            "read_counts": np.asarray(read_counts, dtype=np.int64),
+            "read_summary": read_summary,
+            "read_stats": {
+                name: int(value) if np.ndim(value) == 0 else value
+                for name, value in read_stats.items()
+            },
+        }
+        # Written next to the target and renamed, a concurrent run never reads a partial file
+        for target, write in (
+            (result_file, lambda f: pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)),
+            (meta_file, lambda f: f.write(json.dumps(meta, default=str).encode())),
+        ):
+            tmp_file = pathlib.Path(f"{target}.{os.getpid()}.tmp")
+            with open(tmp_file, "wb") as f:
+                write(f)
+            os.replace(tmp_file, target)
+
+        if self.max_bytes is not None:
+            self.prune(max_bytes=self.max_bytes)
+
+    def entries(self) -> list:
+        """
+        > Describe the cached entries, the most recently used first
+
+        :return: A list of dicts with the key, size, last use and the stored meta
+        """
+        entries = []
+        for result_file in self.cache_dir.glob("*.pkl"):
+            meta_file = result_file.with_suffix(".json")
+            try:
+                stat = result_file.stat()
+                meta = json.loads(meta_file.read_text()) if meta_file.exists() else {}
+            except (OSError, ValueError):
+                continue
+            entries.append(
+                {
+                    "key": result_file.stem,
+                    "bytes": stat.st_size
+                    + (meta_file.stat().st_size if meta_file.exists() else 0),
+                    "last_used": stat.st_mtime,
+                    **meta,
+                }
+            )
+        return sorted(entries, key=lambda entry: entry["last_used"], reverse=True)
+
+    def remove(self, key: str):
+        for cache_file in self._files(key):
+            cache_file.unlink(missing_ok=True)
+
+    def prune(self, max_bytes: int = None, older_than: float = None) -> list:
+        """
+        > Evict the least recently used entries
+
+        :param max_bytes: keep the most recently used entries within this size
+        :param older_than: also evict the entries unused for this many seconds
+        :return: The evicted entries
+        """
+        evicted, total = [], 0
+        for entry in self.entries():
+            total += entry["bytes"]
+            if (max_bytes is not None and total > max_bytes) or (
+                older_than is not None and time.time() - entry["last_used"] > older_than
+            ):
+                self.remove(entry["key"])
+                evicted.append(entry)
+                total -= entry["bytes"]
+        return evicted
@@ -0,0 +1,124 @@
+import gzip
+import itertools
+import pathlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from Core.FastqIO import BATCH_SIZE, _validate, compression_of, xopen
+
+WRITE_BUFFER_SIZE = 1 << 22  # Bytes buffered by every fragment output
+
+
+def fragment_bins(frag_lengths: list, generosity: int) -> dict:
+    """
+    > Map every read length to the fragments it is accepted for
+
+    :param frag_lengths: the expected fragment lengths
+    :param generosity: the length difference tolerated on either side
+    :return: A dict of read length -> tuple of fragment indices, overlapping windows
+        send a read to every fragment they cover
+    """
+    bins = {}
+    for idx, frag_length in enumerate(frag_lengths):
+        for length in range(frag_length - generosity, frag_length + generosity + 1):
+            bins[length] = bins.get(length, ()) + (idx,)
+    return bins
+
+
+def fragment_files(fastq_file: pathlib.Path, n_fragments: int, output_dir=None) -> list:
+    # {input file name}_F1.fastq, ... next to the input file unless output_dir is given
+    fastq_file = pathlib.Path(fastq_file).absolute()
+    output_dir = fastq_file.parent if output_dir is None else pathlib.Path(output_dir)
+    return [
+        output_dir / f"{fastq_file.name}_F{idx + 1}.fastq" for idx in range(n_fragments)
+    ]
+
+
+def _open_records(fastq_file: pathlib.Path):
+    if compression_of(fastq_file) == "plain":
+        return open(fastq_file, "rb")
+    if xopen is not None:
+        return xopen(fastq_file, "rb")
+    return gzip.open(fastq_file, "rb")
+
+
+def separate(
+    fastq_file: pathlib.Path,
+    frag_lengths: list,
+    generosity=1,
+    output_dir=None,
+    batch_size=BATCH_SIZE,
+    validate=True,
+) -> Counter:
+    """
+    > Split a FASTQ file by read length, in one pass over the records
+
+    The records are written as they are, quality lines included, to one output per
+    fragment length; see fragment_files.
+
+    :param fastq_file: the FASTQ file, plain or gzip compressed
+    :param frag_lengths: the expected fragment lengths
+    :param generosity: the length difference tolerated on either side
+    :param output_dir: the directory of the outputs, next to the input by default
+    :param batch_size: the number of records routed at once
+    :param validate: cheap structural check of the records
+    :return: A Counter of the reads written to F1, F2, ..., and of the Total and
+        Unassigned reads
+    """
+    bins = fragment_bins(frag_lengths, generosity)
+    output_files = fragment_files(fastq_file, len(frag_lengths), output_dir)
+    counts = Counter()
+
+    outputs = [open(f, "wb", buffering=WRITE_BUFFER_SIZE) for f in output_files]
+    try:
+        with _open_records(fastq_file) as handle:
+            n_read = 0
+            while True:
+                lines = list(itertools.islice(handle, 4 * batch_size))
+                if not lines:
+                    break
+                if len(lines) % 4 != 0:
+                    raise ValueError(
+                        f"Truncated FASTQ record: read {n_read + len(lines) // 4 + 1}"
+                    )
+                if validate:
+                    _validate(lines, n_read)
+                if not lines[-1].endswith(b"\n"):
+                    lines[-1] += b"\n"  # Last record of a file without a final newline
+
+                routed = [[] for _ in output_files]
+                for first in range(0, len(lines), 4):
+                    fragments = bins.get(len(lines[first + 1].rstrip(b"\r\n")), ())
+                    if not fragments:
+                        counts["Unassigned"] += 1
+                    for idx in fragments:
+                        routed[idx].extend(lines[first : first + 4])
+                for idx, (output, records) in enumerate(zip(outputs, routed)):
+                    output.writelines(records)
+                    counts[f"F{idx + 1}"] += len(records) // 4
+
+                n_read += len(lines) // 4
+                counts["Total"] += len(lines) // 4
+    finally:
+        for output in outputs:
+            output.close()
+
+    return counts
+
+
+def separate_files(files: list, frag_lengths: list, n_jobs=1, **kwargs) -> dict:
+    """
+    > Split several FASTQ files by read length, one file per worker process
+
+    :param files: the FASTQ files
+    :param frag_lengths: the expected fragment lengths
+    :param n_jobs: the number of worker processes
+    :param kwargs: see separate
+    :return: A dict of FASTQ file -> the Counter returned by separate
+    """
+    with ProcessPoolExecutor(max_workers=max(min(n_jobs, len(files)), 1)) as executor:
+        futures = {
+            fastq_file: executor.submit(separate, fastq_file, frag_lengths, **kwargs)
+            for fastq_file in files
+        }
+        return {fastq_file: future.result() for fastq_file, future in futures.items()}
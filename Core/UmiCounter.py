@@ -0,0 +1,248 @@
+import numpy as np
+
+from Core.FastqIO import encode_sequences
+
+MAX_UMI_LENGTH = 16
+UMI_SHIFT = 2 * MAX_UMI_LENGTH + 2  # Bits of a UMI code, its length marker included
+HLL_PRECISION = 10  # 2^10 registers per barcode, about 3% error
+COMPACT_SIZE = 1 << 22  # Keys buffered before they are made unique again
+MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def umi_sequences(batch, source="position", offset=0, length=8) -> list:
+    """
+    > Read the UMI of every read of a batch
+
+    :param batch: the ReadBatch
+    :param source: "position", the UMI is at offset in the read, or "header", the UMI
+        is the last ":" or "_" separated field of the read ID
+    :param offset: the 0-based position of the UMI in the read
+    :param length: the length of the UMI in the read
+    :return: A list of UMI sequences, empty when the read has none
+    """
+    if source == "header":
+        return [
+            read_id.replace("_", ":").rsplit(":", 1)[-1].upper()
+            if ":" in read_id or "_" in read_id
+            else ""
+            for read_id in batch.ids
+        ]
+    return [
+        seq[offset : offset + length] if len(seq) >= offset + length else ""
+        for seq in batch.sequences
+    ]
+
+
+def encode_umis(umis: list) -> np.ndarray:
+    """
+    > Encode UMIs into integer codes, 2 bits per base after a leading 1 marking the length
+
+    :param umis: the UMI sequences
+    :return: The uint64 codes, 0 for the empty, too long or N-containing UMIs
+    """
+    matrix, lengths = encode_sequences(umis)
+    codes = np.ones(len(umis), dtype=np.uint64)
+    for column in range(min(matrix.shape[1], MAX_UMI_LENGTH)):
+        within = column < lengths
+        codes = np.where(
+            within, (codes << np.uint64(2)) | matrix[:, column].astype(np.uint64), codes
+        )
+    valid = (
+        (lengths > 0)
+        & (lengths <= MAX_UMI_LENGTH)
+        & ((matrix < 4) | (np.arange(matrix.shape[1]) >= lengths[:, None])).all(axis=1)
+    )
+    return np.where(valid, codes, np.uint64(0))
+
+
+def _splitmix64(keys: np.ndarray) -> np.ndarray:
+    # 64-bit finalizer, spreads the (barcode, UMI) keys over the HyperLogLog registers
+    with np.errstate(over="ignore"):
+        keys = keys + np.uint64(0x9E3779B97F4A7C15)
+        keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return keys ^ (keys >> np.uint64(31))
+
+
+class UmiCounter(object):
+    """
+    > Unique (barcode, UMI) pairs of a chunk or of a sample
+
+    With the "set" sketch, the pairs are kept exactly as sorted 64-bit keys with their
+    read counts, which also allows collapsing the UMIs one mismatch away from a more
+    abundant one. With "hll", every barcode has a HyperLogLog sketch of 2^precision
+    one-byte registers; a chunk keeps only the registers it touched.
+    """
+
+    def __init__(self, n_barcodes: int, sketch="set", precision=HLL_PRECISION):
+        self.n_barcodes = n_barcodes
+        self.sketch = sketch
+        self.precision = precision
+        # Sorted unique keys and their read counts, followed by the pending ones
+        self.keys = [np.zeros(0, dtype=np.uint64)]
+        self.counts = [np.zeros(0, dtype=np.int64)]
+        self.registers = None  # Dense (barcodes, 2^precision) registers, once merged
+
+    def add(self, assignment: np.ndarray, umis: np.ndarray):
+        """
+        > Count the UMIs of the detected reads of a batch
+
+        :param assignment: the barcode of every read, one column per library of a
+            shared index
+        :param umis: the UMI codes of the reads, see encode_umis
+        """
+        if assignment.ndim == 2:
+            umis = np.repeat(umis, assignment.shape[1])
+            assignment = assignment.ravel()
+        counted = (assignment >= 0) & (umis > 0)
+        keys = (assignment[counted].astype(np.uint64) << np.uint64(UMI_SHIFT)) | umis[
+            counted
+        ]
+        if self.sketch == "hll":
+            self._add_registers(assignment[counted], keys)
+        else:
+            keys, counts = np.unique(keys, return_counts=True)
+            self._add_keys(keys, counts)
+
+    def _add_keys(self, keys, counts=None):
+        self.keys.append(keys)
+        if counts is not None:
+            self.counts.append(counts.astype(np.int64))
+        if sum(map(len, self.keys)) > COMPACT_SIZE + len(self.keys[0]):
+            self._compact()
+
+    def _compact(self):
+        if self.sketch == "hll":
+            self.keys = [np.unique(np.concatenate(self.keys))]
+            return
+        keys, inverse = np.unique(np.concatenate(self.keys), return_inverse=True)
+        counts = np.bincount(
+            inverse, weights=np.concatenate(self.counts), minlength=keys.shape[0]
+        )
+        self.keys, self.counts = [keys], [counts.astype(np.int64)]
+
+    def _add_registers(self, barcodes, keys):
+        # Register: the first bits of the hash; value: the position of the first 1 after
+        hashes = _splitmix64(keys)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = (hashes << np.uint64(self.precision)) & MASK64
+        width = 64 - self.precision
+        ranks = np.where(
+            rest > 0,
+            64 - np.floor(np.log2(np.maximum(rest, 1).astype(np.float64))),
+            width + 1,
+        )
+        ranks = np.minimum(ranks, width + 1).astype(np.int64)
+        # The highest rank of every register, as sparse (register, rank) keys
+        slots = barcodes.astype(np.int64) << self.precision | index
+        self._add_keys(
+            np.unique(slots.astype(np.uint64) << np.uint64(8) | ranks.astype(np.uint64))
+        )
+
+    def merge(self, other: "UmiCounter"):
+        if self.sketch == "hll":
+            self._dense()
+            if other.registers is not None:
+                np.maximum(self.registers, other.registers, out=self.registers)
+            slots, ranks = other._sparse_registers()
+            np.maximum.at(self.registers.ravel(), slots, ranks)
+        else:
+            for keys, counts in zip(other.keys, other.counts):
+                self._add_keys(keys, counts)
+
+    def _sparse_registers(self):
+        keys = np.concatenate(self.keys)
+        return (keys >> np.uint64(8)).astype(np.int64), (keys & np.uint64(255)).astype(
+            np.uint8
+        )
+
+    def _dense(self):
+        if self.registers is None:
+            self.registers = np.zeros(
+                (self.n_barcodes, 1 << self.precision), dtype=np.uint8
+            )
+        slots, ranks = self._sparse_registers()
+        np.maximum.at(self.registers.ravel(), slots, ranks)
+        self.keys = [np.zeros(0, dtype=np.uint64)]
+
+    def deduplicated(self, max_mismatch=0) -> np.ndarray:
+        """
+        > The number of unique UMIs of every barcode
+
+        :param max_mismatch: 1 to collapse a UMI into a neighbor one mismatch away with
+            at least 2n - 1 reads, n being its own, and the chains of them into their
+            top UMI, as the directional method of UMI-tools; "set" sketch only
+        :return: The int64 array of the UMI counts, in the barcode index order
+        """
+        if self.sketch == "hll":
+            return self._estimate()
+
+        self._compact()
+        keys, counts = self.keys[0], self.counts[0]
+        kept = np.ones(keys.shape[0], dtype=bool)
+        if max_mismatch > 0:
+            kept = ~self._absorbed(keys, counts)
+        barcodes = (keys[kept] >> np.uint64(UMI_SHIFT)).astype(np.int64)
+        return np.bincount(barcodes, minlength=self.n_barcodes).astype(np.int64)
+
+    @staticmethod
+    def _absorbed(keys: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        # Every substitution of every base of the UMIs is looked up among the sorted keys
+        # of the same barcode. As the breadth-first search of UMI-tools, a UMI is absorbed
+        # by a neighbor of at least 2n - 1 reads, which leaves only the top of every chain;
+        # the single-read UMIs absorb each other, so every cluster of them keeps one UMI
+        # unless a more abundant neighbor absorbs it
+        umis = keys & np.uint64((1 << UMI_SHIFT) - 1)
+        lengths = np.zeros(keys.shape[0], dtype=np.int64)
+        marker = umis.copy()
+        while (marker > 1).any():
+            lengths += marker > 1
+            marker = np.where(marker > 1, marker >> np.uint64(2), marker)
+
+        absorbed = np.zeros(keys.shape[0], dtype=bool)
+        sources, targets = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for position in range(int(lengths.max(initial=0))):
+            within = position < lengths
+            shift = (np.maximum(lengths - 1 - position, 0) * 2).astype(np.uint64)
+            base = (keys >> shift) & np.uint64(3)
+            for substitute in range(1, 4):
+                replaced = (base + np.uint64(substitute)) & np.uint64(3)
+                neighbors = (keys & ~(np.uint64(3) << shift)) | (replaced << shift)
+                found = np.minimum(np.searchsorted(keys, neighbors), keys.shape[0] - 1)
+                neighbor_counts = counts[found]
+                neighbor = within & (keys[found] == neighbors)
+                absorbed |= (
+                    neighbor
+                    & (neighbor_counts >= 2 * counts - 1)
+                    & (neighbor_counts > counts)
+                )
+                tie = np.flatnonzero(neighbor & (counts == 1) & (neighbor_counts == 1))
+                sources.append(tie)
+                targets.append(found[tie])
+
+        # Clusters of single-read UMIs, labelled with their lowest row
+        rows = np.arange(keys.shape[0])
+        labels = rows.copy()
+        sources, targets = np.concatenate(sources), np.concatenate(targets)
+        while True:
+            lowest = labels.copy()
+            np.minimum.at(lowest, sources, labels[targets])
+            lowest = lowest[lowest]
+            if (lowest == labels).all():
+                break
+            labels = lowest
+        cluster_absorbed = np.zeros(keys.shape[0], dtype=bool)
+        np.logical_or.at(cluster_absorbed, labels, absorbed)
+        return absorbed | (labels != rows) | cluster_absorbed[labels]
+
+    def _estimate(self) -> np.ndarray:
+        self._dense()
+        registers = 1 << self.precision
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        harmonic = np.exp2(-self.registers.astype(np.float64)).sum(axis=1)
+        estimate = alpha * registers**2 / harmonic
+        zeros = np.count_nonzero(self.registers == 0, axis=1)
+        # Linear counting for the small cardinalities, most barcodes
+        small = (estimate <= 2.5 * registers) & (zeros > 0)
+        estimate[small] = registers * np.log(registers / zeros[small])
+        return np.rint(estimate).astype(np.int64)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+import argparse
+import json
+import logging
+import os
+import pathlib
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+from Core.BarcodeMatcher import BarcodeIndex, ahocorasick, load_barcodes
+from Core.CoreSystem import write_extraction_results
+from Core.FastqIO import plan_chunks
+from Core.ReadSummary import ReadSummary
+from extractor import ENGINES
+from test_generator import (
+    generate_barcodes,
+    generate_fastq,
+    reads_for_size,
+    write_barcode_file,
+)
+
+# Project layout of the end-to-end runs, inside the work directory
+USER, PROJECT, SAMPLE = "bench", "bench", "sample"
+BARCODE_FILE = "bench_barcodes.txt"
+RSS_SAMPLING = 0.05  # Seconds between two samples of the end-to-end memory
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def tree_rss_mb(pid: int) -> float:
+    """
+    > Resident memory of a process and all its descendants, read from /proc
+
+    :param pid: the root process
+    :return: The summed RSS in MiB, 0 once the process is gone
+    """
+    children = {}
+    for stat_file in pathlib.Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # The command name may contain spaces, the fields after it do not
+            fields = stat_file.read_text().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat_file.parent.name))
+
+    rss_pages, stack = 0, [pid]
+    while stack:
+        process = stack.pop()
+        try:
+            rss_pages += int(
+                pathlib.Path(f"/proc/{process}/statm").read_text().split()[1]
+            )
+        except (OSError, IndexError):
+            continue
+        stack.extend(children.get(process, []))
+    return rss_pages * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+
+
+class StageTimer(object):
+    """
+    > Wall time, throughput and peak RSS of the benchmark stages
+
+    The peak RSS is the one of the benchmark process at the end of the stage, or the
+    sampled peak of the whole run_extractor process tree for the end-to-end runs.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.records = []
+
+    def record(self, stage: str, seconds: float, reads: int, **fields):
+        record = {
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "reads": int(reads),
+            "reads_per_sec": round(reads / seconds, 1) if seconds > 0 else None,
+            "peak_rss_mb": round(fields.pop("peak_rss_mb", peak_rss_mb()), 1),
+            **fields,
+        }
+        self.records.append(record)
+        self.logger.info(
+            " ".join(
+                f"{key}={value}" for key, value in record.items() if value is not None
+            )
+        )
+        return record
+
+
+def prepare_dataset(args, workdir: pathlib.Path, logger):
+    # Generated in the project layout run_extractor.py expects
+    barcode_dir = workdir / "Barcodes"
+    sample_dir = workdir / "Input" / USER / PROJECT / SAMPLE
+    user_dir = workdir / "User" / USER
+    for directory in (barcode_dir, sample_dir, user_dir):
+        directory.mkdir(parents=True, exist_ok=True)
+    for stale in sample_dir.glob("*"):
+        stale.unlink()
+    with open(user_dir / f"{PROJECT}.txt", "w") as f:
+        f.write(f"{SAMPLE},{BARCODE_FILE}\n")
+
+    rng = np.random.default_rng(args.seed)
+    barcodes = generate_barcodes(args.barcodes, args.barcode_length, rng)
+    write_barcode_file(barcode_dir / BARCODE_FILE, barcodes)
+
+    n_reads = (
+        reads_for_size(args.size_mb, args.read_length) if args.size_mb else args.reads
+    )
+    fastq_file = sample_dir / ("reads.fastq.gz" if args.gzip else "reads.fastq")
+    logger.info(f"Generating {n_reads} reads into {fastq_file}")
+    truth = generate_fastq(
+        fastq_file,
+        barcodes,
+        n_reads,
+        args.read_length,
+        args.hit_rate,
+        args.error_rate,
+        args.offset,
+        args.upstream,
+        args.downstream,
+        args.seed + 1,
+    )
+    return barcode_dir / BARCODE_FILE, fastq_file, n_reads, truth
+
+
+def benchmark_stages(args, barcode_file, fastq_file, n_reads, truth, timer, workdir):
+    start = time.perf_counter()
+    chunks = list(plan_chunks(fastq_file, args.chunk_size, threads=args.threads))
+    timer.record("split", time.perf_counter() - start, n_reads, chunks=len(chunks))
+
+    # Parsed batches are kept in memory, the match stage times the matching alone
+    start = time.perf_counter()
+    parsed = [[batch.sequences for batch in chunk.open()] for chunk in chunks]
+    timer.record("parse", time.perf_counter() - start, n_reads)
+
+    barcode_df = load_barcodes(barcode_file)
+    results = None
+    for engine in args.engines:
+        start = time.perf_counter()
+        barcode_index = BarcodeIndex(
+            barcode_df,
+            engine,
+            barcode_offset=args.offset + len(args.upstream),
+            anchors=(args.upstream, args.downstream),
+            max_mismatch=args.mismatch,
+        )
+        timer.record(
+            "index", time.perf_counter() - start, 0, engine=engine, reads_per_sec=None
+        )
+        if barcode_index.matcher is None:
+            continue  # The legacy contains loop is only timed end-to-end
+
+        start = time.perf_counter()
+        results = []
+        for batches in parsed:
+            detection = [
+                barcode_index.matcher.match(sequences) for sequences in batches
+            ]
+            detection = np.concatenate(detection) if detection else np.zeros(0, int)
+            results.append(
+                (
+                    np.bincount(
+                        detection[detection >= 0], minlength=len(barcode_index)
+                    ),
+                    detection >= 0,
+                )
+            )
+        seconds = time.perf_counter() - start
+        detected = sum(int(counts.sum()) for counts, _ in results)
+        timer.record(
+            "match",
+            seconds,
+            n_reads,
+            engine=engine,
+            detected=detected,
+            recall=round(detected / max(int(truth.sum()), 1), 4),
+        )
+
+    if results is None:
+        return
+
+    # Reduction of the per-chunk results and output of the last engine
+    start = time.perf_counter()
+    read_counts = np.zeros(len(barcode_index), dtype=np.int64)
+    for counts, _ in results:
+        np.add(read_counts, counts, out=read_counts)
+    read_summary = ReadSummary()
+    for batches, (_, detection) in zip(parsed, results):
+        read_summary.add(
+            detection,
+            np.array(
+                [len(seq) for sequences in batches for seq in sequences], np.int64
+            ),
+        )
+    timer.record("merge", time.perf_counter() - start, n_reads)
+
+    result_dir = workdir / "stage_output"
+    result_dir.mkdir(exist_ok=True)
+    start = time.perf_counter()
+    write_extraction_results(
+        result_dir,
+        SAMPLE,
+        barcode_index.barcode_df,
+        read_counts,
+        read_summary,
+        Counter(),
+        logging.getLogger("benchmark.write"),
+    )
+    timer.record("write", time.perf_counter() - start, n_reads)
+
+
+def benchmark_pipeline(args, n_reads, timer, workdir, logger):
+    script = pathlib.Path(__file__).resolve().parent / "run_extractor.py"
+    for engine in args.engines:
+        # Cold runs, the barcode index is built every time
+        shutil.rmtree(workdir / "Cache", ignore_errors=True)
+        command = [
+            sys.executable,
+            str(script),
+            "-u",
+            USER,
+            "-p",
+            PROJECT,
+            "-t",
+            str(args.threads),
+            "-c",
+            str(args.chunk_size),
+            "--engine",
+            engine,
+            "--mismatch",
+            str(args.mismatch),
+        ]
+        if engine == "position":
+            command += ["--barcode_offset", str(args.offset + len(args.upstream))]
+        logger.info(" ".join(command))
+
+        start = time.perf_counter()
+        peak = 0.0
+        with open(workdir / f"pipeline_{engine}.log", "w") as log:
+            process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=log)
+            # ru_maxrss of a child starts from the RSS of this process, the process
+            # tree is sampled instead
+            while process.poll() is None:
+                peak = max(peak, tree_rss_mb(process.pid))
+                time.sleep(RSS_SAMPLING)
+        seconds = time.perf_counter() - start
+        if process.returncode != 0:
+            raise RuntimeError(
+                f"run_extractor.py failed, see {workdir / f'pipeline_{engine}.log'}"
+            )
+        timer.record(
+            "pipeline",
+            seconds,
+            n_reads,
+            engine=engine,
+            peak_rss_mb=peak,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the extraction stages on synthetic data"
+    )
+    parser.add_argument("--barcodes", type=int, default=1000, help="Barcode count")
+    parser.add_argument("--barcode_length", type=int, default=20)
+    parser.add_argument("--reads", type=int, default=200000)
+    parser.add_argument(
+        "--size_mb", type=float, default=None, help="Overrides --reads, uncompressed"
+    )
+    parser.add_argument("--read_length", type=int, default=150)
+    parser.add_argument("--hit_rate", type=float, default=0.8)
+    parser.add_argument("--error_rate", type=float, default=0.001)
+    parser.add_argument("--offset", type=int, default=20)
+    parser.add_argument("--upstream", type=str, default="")
+    parser.add_argument("--downstream", type=str, default="")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--engines",
+        type=lambda value: value.split(","),
+        default=["aho-corasick", "vectorized"],
+        help=f"Comma separated, among {', '.join(ENGINES)}",
+    )
+    parser.add_argument("--mismatch", type=int, choices=[0, 1, 2], default=0)
+    parser.add_argument("-t", "--thread", dest="threads", type=int, default=4)
+    parser.add_argument("-c", "--chunk_size", type=int, default=100000)
+    parser.add_argument(
+        "--skip_pipeline", action="store_true", help="Only time the stages in-process"
+    )
+    parser.add_argument(
+        "-w", "--workdir", type=pathlib.Path, default=pathlib.Path("Benchmark")
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=pathlib.Path,
+        default=pathlib.Path("benchmark_results.json"),
+        help="Runs are appended to this JSON list",
+    )
+    args = parser.parse_args()
+    args.upstream, args.downstream = args.upstream.upper(), args.downstream.upper()
+    for engine in args.engines:
+        if engine not in ENGINES:
+            parser.error(f"Unknown engine {engine}")
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    workdir = args.workdir.resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    timer = StageTimer(logger)
+
+    start = time.perf_counter()
+    barcode_file, fastq_file, n_reads, truth = prepare_dataset(args, workdir, logger)
+    timer.record("generate", time.perf_counter() - start, n_reads)
+
+    benchmark_stages(args, barcode_file, fastq_file, n_reads, truth, timer, workdir)
+    if not args.skip_pipeline:
+        benchmark_pipeline(args, n_reads, timer, workdir, logger)
+
+    run = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "parameters": {
+            key: value for key, value in sorted(vars(args).items()) if key != "workdir"
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pyahocorasick": ahocorasick is not None,
+            "cpu_count": os.cpu_count(),
+            "fastq_bytes": fastq_file.stat().st_size,
+        },
+        "stages": timer.records,
+    }
+    runs = json.loads(args.output.read_text()) if args.output.exists() else []
+    runs.append(run)
+    args.output.write_text(json.dumps(runs, indent=2, default=str))
+    logger.info(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,95 +8,331 @@ __author__ = "forestkeep21@naver.com"
 __editor__ = "poowooho3@g.skku.edu"
 
 import gc
-import pathlib
+import os
+import resource
+import time
+import weakref
+from collections import Counter
 
 import numpy as np
 import pandas as pd
-import skbio
 from tqdm import tqdm
 
+from Core.BarcodeMatcher import NO_MATCH, BarcodeIndex, SharedBarcodeIndex
+from Core.FastqIO import FastqChunk
+from Core.PairedMerge import PairedChunk
+from Core.ReadCollapser import ReadCollapser
+from Core.ReadFilter import ReadFilter
+from Core.ReadSummary import ReadSummary
+from Core.UmiCounter import UmiCounter, encode_umis, umi_sequences
+
+ENGINES = ["aho-corasick", "vectorized", "position", "contains"]
+
+# Barcode indexes loaded by this worker process, keyed by their cache file; loaded by
+# the first chunk of a sample and released once no active sample uses them
+_BARCODE_INDEXES = {}
+# ReadCollapser of every matcher, kept across the chunks of the worker
+_COLLAPSERS = weakref.WeakKeyDictionary()
+
+
+def load_barcode_index(index_file) -> BarcodeIndex:
+    index_file = str(index_file)
+    if index_file not in _BARCODE_INDEXES:
+        _BARCODE_INDEXES[index_file] = BarcodeIndex.load(index_file)
+    return _BARCODE_INDEXES[index_file]
+
+
+def release_barcode_indexes(live_index_files):
+    # The indexes of the finished samples go, with their ReadCollapser
+    for index_file in list(_BARCODE_INDEXES):
+        if index_file not in live_index_files:
+            del _BARCODE_INDEXES[index_file]
+
 
 def extract_read_cnts(
-    sequence_file: pathlib.Path, barcode_file: pathlib.Path, result_dir, sep=":"
+    sequence_chunk: FastqChunk,
+    barcode_index: BarcodeIndex,
+    result_dir,
+    validate=True,
+    audit=False,
+    audit_ids=False,
+    detection_bitmap=False,
+    quality_filter=None,
+    umi=None,
+    collapse=None,
 ):
-    # df index == barcode, column == read count
-
-    tqdm.pandas()
-    # Load barcode file
-    result_df = pd.read_csv(
-        barcode_file, sep=sep, header=None, names=["Gene", "Barcode"]
-    ).iloc[:, [0, 1]]  # Use only Gene and Barcode columns
-    if not result_df["Barcode"].is_unique:
-        # Barcode used as a PK in the database, so duplication is not allowed
-        print("Barcode duplication detected!")
-        print("Remove duplicated Barcodes... only the first one will be kept.")
-        result_df.drop_duplicates(subset=["Barcode"], keep="first", inplace=True)
-
-    result_df["Barcode"] = result_df["Barcode"].str.upper()
-    result_df["Barcode_copy"] = result_df["Barcode"]
-
-    result_df = result_df.set_index("Barcode")  # TODO: tentative design
-
-    # Load a split sequencing result using high-level I/O; validating fastq format
-    result_df["Read_counts"] = 0
-    result_df["ID"] = ""
-    seqs = skbio.io.read(
-        sequence_file, format="fastq", verify=True, variant="illumina1.8"
-    )  # FASTQ format verification using skbio
-
-    seq_df = pd.DataFrame(
-        [(seq.metadata["id"], seq._string.decode()) for seq in seqs],
-        columns=["ID", "Sequence"],
+    # sequence_chunk == a range of the FASTQ file, the records of a gzip stream, or a
+    # PairedChunk merged while it is read
+    # Returns the read counts in the barcode file order, the ReadSummary counters (with
+    # the per-read detection array only when detection_bitmap is set) and the read
+    # statistics of the chunk; in audit mode, the barcode hits of every read are also
+    # written to result_dir as an Arrow table
+    # With a SharedBarcodeIndex the summary counts every library, the counters are
+    # per-library arrays and result_dir lists the library directories
+    # The chunk metrics (timings, reads, hits and worker memory) are returned last
+    # quality_filter holds the ReadFilter options, the reads it drops are not matched
+    # umi holds the UMI source and sketch, the UMIs of the detected reads are counted in
+    # summary.umis
+    # collapse is the number of sequences the ReadCollapser of the worker remembers, the
+    # identical reads are matched once; None matches every read
+    start = time.perf_counter()
+    timings = Counter()
+    summary = ReadSummary(
+        barcode_index.n_libraries
+        if isinstance(barcode_index, SharedBarcodeIndex)
+        else 1,
+        keep_bitmap=detection_bitmap,
     )
-    seq_detection_array = np.zeros(seq_df.shape[0], dtype=bool)
 
-    for idx, row in tqdm(result_df.iterrows()):
-        # query_result format
-        #
+    read_stats = Counter()
+    # Stream the split sequencing result in batches; cheap FASTQ structure validation
+    batches = sequence_chunk.open(validate=validate)
+    if quality_filter is not None:
+        batches = ReadFilter(**quality_filter).filter_batches(batches, read_stats)
+    batches = _timed(batches, timings)
 
-        query_result = seq_df["Sequence"].str.contains(row["Barcode_copy"])
-        # boolean indexing for fast processing
-        result_df.at[idx, "ID"] = (
-            seq_df.loc[query_result[query_result].index]["ID"].to_numpy().tolist()
+    audit_tables, audit_read_ids = [], []
+    matcher = barcode_index.matcher
+    if matcher is None:
+        seq_df = pd.DataFrame(
+            [
+                (read_id, seq)
+                for batch in batches
+                for read_id, seq in zip(batch.ids, batch.sequences)
+            ],
+            columns=["ID", "Sequence"],
         )
-        result_df.loc[idx, "Read_counts"] = (query_result.sum(),)
+        # Taken before the loop, which drops the matched reads from seq_df
+        lengths = seq_df["Sequence"].str.len().to_numpy()
+        assignment = _contains_loop(
+            barcode_index.barcode_df, seq_df.copy() if audit else seq_df
+        )
+        detected = assignment >= 0
+        summary.add(detected, lengths)
+        read_counts = np.bincount(
+            assignment[detected], minlength=len(barcode_index)
+        ).astype(np.int64)
 
-        seq_detection_array[query_result[query_result].index] = True
+        if audit:
+            reads = np.flatnonzero(detected).astype(np.int32)
+            audit_tables.append(
+                _assignment_table(
+                    0,
+                    assignment,
+                    reads,
+                    assignment[reads],
+                    np.zeros(reads.shape[0], dtype=np.int8),
+                )
+            )
+            audit_read_ids.append(seq_df["ID"].to_numpy()[reads])
+
+        del seq_df
+        gc.collect()
+    else:
+        matcher.reset_counters()
+        collapser = None
+        if collapse is not None and not audit:
+            collapser = _COLLAPSERS.get(matcher)
+            if collapser is None or collapser.max_sequences != collapse:
+                collapser = _COLLAPSERS[matcher] = ReadCollapser(matcher, collapse)
+        read_counts = np.zeros(len(barcode_index), dtype=np.int64)
+        if umi is not None:
+            summary.umis = UmiCounter(
+                len(barcode_index), umi["sketch"], umi["precision"]
+            )
+        n_read = 0
+
+        # Single pass over the reads for the whole library, one batch at a time
+        for batch in batches:
+            if audit:
+                assignment, reads, barcodes, mismatches = matcher.match_hits(
+                    batch.sequences
+                )
+                audit_tables.append(
+                    _assignment_table(n_read, assignment, reads, barcodes, mismatches)
+                )
+                if audit_ids:
+                    audit_read_ids.append(np.asarray(batch.ids, dtype=object)[reads])
+            elif collapser is not None:
+                assignment = collapser.match(batch.sequences, read_stats)
+            else:
+                assignment = matcher.match(batch.sequences)
+
+            detected = assignment >= 0
+            read_counts += np.bincount(
+                assignment[detected], minlength=len(barcode_index)
+            )
+            if umi is not None:
+                umis = encode_umis(
+                    umi_sequences(batch, umi["source"], umi["offset"], umi["length"])
+                )
+                summary.umis.add(assignment, umis)
+                read_stats["Read without UMI"] += int(np.count_nonzero(umis == 0))
+            summary.add(
+                detected,
+                np.fromiter(map(len, batch.sequences), np.int64, len(batch)),
+            )
+            n_read += len(batch)
+
+        read_stats["Detected read with mismatches"] += matcher.mismatched
+        read_stats["Multi-hit read"] += matcher.multi_hit
+        if barcode_index.engine == "position":
+            read_stats["Barcode window not located"] += matcher.unlocated
+
+    if isinstance(sequence_chunk, PairedChunk):
+        # Counted while the pairs were merged, the reads above are the merged ones
+        read_stats.update(sequence_chunk.merge_stats)
+
+    matched = time.perf_counter()
+    if audit:
+        assignment_file = f"{sequence_chunk.name}.arrow"
+        if isinstance(barcode_index, SharedBarcodeIndex):
+            for library, library_dir in enumerate(result_dir):
+                tables, read_ids = _library_tables(
+                    audit_tables,
+                    audit_read_ids if audit_ids else None,
+                    barcode_index.library_slice(library),
+                )
+                write_assignment_table(
+                    tables, read_ids, f"{library_dir}/{assignment_file}"
+                )
+        else:
+            write_assignment_table(
+                audit_tables,
+                audit_read_ids if audit_ids else None,
+                f"{result_dir}/{assignment_file}",
+            )
+
+    metrics = {
+        "chunk": sequence_chunk.name,
+        "start": sequence_chunk.start,
+        "reads": summary.total,
+        "hits": int(summary.detected.sum()),
+        "parse_s": timings["parse"],
+        "match_s": matched - start - timings["parse"],
+        "audit_s": time.perf_counter() - matched,
+        **_worker_memory(),
+    }
+    return read_counts, summary, read_stats, metrics
 
-        # TODO: Sample with replacement option
-        # Without replacement from the sequence pool
-        seq_df.drop(query_result[query_result].index, inplace=True, axis=0)
 
-    del seq_df
-    gc.collect()
+def _timed(batches, timings: Counter):
+    # Time spent reading and parsing, the batches are produced lazily
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            timings["parse"] += time.perf_counter() - start
+            return
+        timings["parse"] += time.perf_counter() - start
+        yield batch
 
-    result_df.drop("Barcode_copy", axis=1, inplace=True)
-    result_df.reset_index(inplace=True, drop=False)
-    result_df.iloc[1], result_df.iloc[-1] = result_df.iloc[-1], result_df.iloc[1]
 
-    def name():
-        from datetime import datetime
+def _worker_memory() -> dict:
+    # Current RSS from /proc when available, the peak from getrusage (KiB on Linux)
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError):
+        rss = None
+    return {
+        "worker_pid": os.getpid(),
+        "worker_rss_mb": rss,
+        "worker_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
 
-        dt_string = datetime.now().strftime("%Y-%m-%d;%H:%M:%S")
-        return str(f"{dt_string}")
 
-    result_df.to_parquet(
-        f"{result_dir}/{name()}+{pathlib.Path(sequence_file).name}.parquet"
+def _assignment_table(
+    first_read: int, assignment, reads, barcodes, mismatches
+) -> pd.DataFrame:
+    # One row per (read, barcode) hit; Assigned marks the barcode the read is counted for
+    assigned = (
+        (assignment[reads] == barcodes[:, None]).any(axis=1)
+        if assignment.ndim == 2  # One column per library of a shared index
+        else assignment[reads] == barcodes
+    )
+    return pd.DataFrame(
+        {
+            "Read": (reads + first_read).astype(np.int32),
+            "Barcode": barcodes.astype(np.int32),
+            "Mismatch": mismatches.astype(np.int8),
+            "Assigned": assigned,
+        }
     )
 
-    del result_df
-    gc.collect()
 
-    return seq_detection_array
+def _library_tables(tables: list, read_ids, library: slice):
+    # The rows of one library of a shared index, with barcode indices local to it
+    masks = [
+        (
+            (table["Barcode"] >= library.start) & (table["Barcode"] < library.stop)
+        ).to_numpy()
+        for table in tables
+    ]
+    library_tables = [
+        table[mask].assign(Barcode=table["Barcode"][mask] - library.start)
+        for table, mask in zip(tables, masks)
+    ]
+    if read_ids is None:
+        return library_tables, None
+    return library_tables, [ids[mask] for ids, mask in zip(read_ids, masks)]
 
 
-def main(*args) -> pd.DataFrame:
-    (sequence, barcode, logger, result_dir, sep) = args[0]
+def write_assignment_table(tables: list, read_ids, assignment_file):
+    """
+    > Write the per-read assignments of a chunk as an uncompressed Arrow IPC file
+
+    The file can be memory-mapped, see Core.CoreSystem.report_multiple_detection.
+
+    :param tables: the assignment tables of the batches
+    :param read_ids: the read ID of every row, None to leave the ID column out
+    :param assignment_file: the output file
+    """
+    table = (
+        pd.concat(tables, ignore_index=True)
+        if tables
+        else _assignment_table(
+            0,
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.int8),
+        )
+    )
+    if read_ids is not None:
+        # Dictionary-encoded: a read hitting several barcodes stores its ID once
+        table["ID"] = pd.Categorical(
+            np.concatenate(read_ids) if read_ids else np.zeros(0, dtype=object)
+        )
+
+    table.to_feather(assignment_file, compression="uncompressed")
 
-    # start = time.time()
-    rval = extract_read_cnts(sequence, barcode, result_dir, sep)
-    # end = time.time()
 
-    # logger.info(f"Extraction is done. {end - start}s elapsed.")
+def _contains_loop(barcode_df: pd.DataFrame, seq_df: pd.DataFrame) -> np.ndarray:
+    # Legacy engine: one str.contains scan of the pool per barcode
+    assignment = np.full(seq_df.shape[0], NO_MATCH, dtype=np.int32)
+
+    for idx, barcode in tqdm(enumerate(barcode_df["Barcode"])):
+        query_result = seq_df["Sequence"].str.contains(barcode)
+        # boolean indexing for fast processing
+        assignment[query_result[query_result].index] = idx
 
-    return rval
+        # TODO: Sample with replacement option
+        # Without replacement from the sequence pool
+        seq_df.drop(query_result[query_result].index, inplace=True, axis=0)
+
+    return assignment
+
+
+def main(*args) -> pd.DataFrame:
+    (sequence, index_file, logger, result_dir, options) = args[0]
+    if len(args) > 1:
+        # The index files of the samples being extracted, see run_extractor_mp
+        release_barcode_indexes(args[1])
+
+    # Timings are returned with the chunk metrics, see Core.CoreSystem.SampleJob
+    return extract_read_cnts(
+        sequence, load_barcode_index(index_file), result_dir, **vars(options)
+    )
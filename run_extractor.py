@@ -4,6 +4,7 @@ import os
 import sys
 import argparse
 import pathlib
+import shutil
 from types import SimpleNamespace
 import json
 from datetime import datetime
@@ -15,9 +16,254 @@ from Core.CoreSystem import (
     Helper,
     run_pipeline,
 )
+from Core.FastqIO import FINGERPRINT_METHODS
+from Core.ReadCollapser import COLLAPSED_ENGINES
+
+
+def cache_main(argv: list):
+    # python run_extractor.py cache {inspect,prune}: maintenance of the result cache
+    import pandas as pd
+
+    from Core.ResultCache import ResultCache
+
+    parser = argparse.ArgumentParser(
+        prog="extractor_SKKUGE cache",
+        description="Inspect or prune the cached results of previous extractions",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=pathlib.Path,
+        default=pathlib.Path("Cache") / "results",
+        help="Result cache directory. Default is Cache/results.",
+    )
+    actions = parser.add_subparsers(dest="action", required=True)
+    actions.add_parser("inspect", help="List the entries, the most recently used first")
+    prune = actions.add_parser("prune", help="Evict the least recently used entries")
+    prune.add_argument(
+        "--max_size_mb",
+        type=float,
+        default=None,
+        help="Keep the most recently used entries within this size",
+    )
+    prune.add_argument(
+        "--older_than_days",
+        type=float,
+        default=None,
+        help="Evict the entries unused for this many days",
+    )
+    prune.add_argument("--all", action="store_true", help="Empty the cache")
+    args = parser.parse_args(argv)
+
+    cache = ResultCache(args.cache_dir)
+    if args.action == "inspect":
+        entries = cache.entries()
+        if entries:
+            df = pd.DataFrame(entries)
+            df["key"] = df["key"].str[:12]
+            df["size_mb"] = (df.pop("bytes") / (1 << 20)).round(3)
+            df["last_used"] = pd.to_datetime(df["last_used"], unit="s").dt.floor("s")
+            print(df.to_string(index=False))
+        print(
+            f"{len(entries)} entries, "
+            f"{sum(entry['bytes'] for entry in entries) / (1 << 20):.3f} MiB in {args.cache_dir}"
+        )
+        return
+
+    if not args.all and args.max_size_mb is None and args.older_than_days is None:
+        parser.error("prune requires --max_size_mb, --older_than_days or --all")
+    max_bytes = None if args.max_size_mb is None else int(args.max_size_mb * (1 << 20))
+    older_than = None if args.older_than_days is None else args.older_than_days * 86400
+    evicted = cache.prune(max_bytes=0 if args.all else max_bytes, older_than=older_than)
+    print(
+        f"{len(evicted)} entries evicted, "
+        f"{sum(entry['bytes'] for entry in evicted) / (1 << 20):.3f} MiB freed"
+    )
+
+
+def separate_main(argv: list):
+    # python run_extractor.py separate: split FASTQ files by fragment length
+    import pandas as pd
+
+    from Core.Separator import separate_files
+
+    parser = argparse.ArgumentParser(
+        prog="extractor_SKKUGE separate",
+        description="Split FASTQ files by read length into one file per fragment, "
+        "{input file name}_F1.fastq, ... Records are kept as they are, quality lines included.",
+    )
+    parser.add_argument(
+        "files", nargs="+", type=pathlib.Path, help="FASTQ files, plain or gzip"
+    )
+    parser.add_argument(
+        "-f",
+        "--frag_length",
+        dest="frag_lengths",
+        nargs="+",
+        type=int,
+        required=True,
+        help="Expected fragment lengths, F1 is the first one",
+    )
+    parser.add_argument(
+        "-g",
+        "--generosity",
+        type=int,
+        default=1,
+        help="Length difference tolerated on either side of a fragment length. Default is 1.",
+    )
+    parser.add_argument(
+        "-t",
+        "--thread",
+        dest="multicore",
+        type=int,
+        default=0,
+        help="Files separated in parallel, 0 for the CPU count",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        type=pathlib.Path,
+        default=None,
+        help="Output directory, next to every input file by default",
+    )
+    parser.add_argument(
+        "--skip_validation",
+        action="store_true",
+        help="Skip the FASTQ record structure check done while parsing.",
+    )
+    args = parser.parse_args(argv)
+    if args.generosity < 0:
+        parser.error("--generosity must be positive")
+    if args.output_dir is not None:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    counts = separate_files(
+        args.files,
+        args.frag_lengths,
+        n_jobs=args.multicore or os.cpu_count(),
+        generosity=args.generosity,
+        output_dir=args.output_dir,
+        validate=not args.skip_validation,
+    )
+    columns = [f"F{idx + 1}" for idx in range(len(args.frag_lengths))]
+    df = pd.DataFrame(counts).T.reindex(columns=columns + ["Total", "Unassigned"])
+    print(df.fillna(0).astype(int).to_string())
+
+
+def discover_main(argv: list):
+    # python run_extractor.py discover: barcode library from the constant regions
+    from collections import Counter
+
+    from Core.Discovery import (
+        FlankLocator,
+        barcode_library,
+        discover_barcodes,
+        write_barcode_library,
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="extractor_SKKUGE discover",
+        description="Discover the barcodes found between constant regions (ClonTracer-style libraries) "
+        "and write them as a barcode file for the extraction, the most abundant first.",
+    )
+    parser.add_argument(
+        "files", nargs="+", type=pathlib.Path, help="FASTQ files, plain or gzip"
+    )
+    parser.add_argument(
+        "--upstream", type=str, default="", help="Constant region before the barcode"
+    )
+    parser.add_argument(
+        "--downstream", type=str, default="", help="Constant region after the barcode"
+    )
+    parser.add_argument(
+        "-l",
+        "--barcode_length",
+        type=int,
+        default=None,
+        help="Barcode length, required with a single constant region. Without it, the barcode runs up to the downstream region.",
+    )
+    parser.add_argument(
+        "--mismatch",
+        type=int,
+        choices=[0, 1, 2],
+        default=0,
+        help="Mismatches tolerated in each constant region. Default is 0.",
+    )
+    parser.add_argument(
+        "--min_reads",
+        type=int,
+        default=1,
+        help="Reads a barcode needs to enter the library. Default is 1.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=pathlib.Path,
+        required=True,
+        help="The barcode file written, e.g. Barcodes/library.txt; the read counts and statistics are written next to it",
+    )
+    parser.add_argument(
+        "--separator",
+        dest="sep",
+        type=str,
+        default=":",
+        help="Separator character for the barcode file. Default is ':'.",
+    )
+    parser.add_argument("-t", "--thread", dest="multicore", type=int, default=0)
+    parser.add_argument("-c", "--chunk_size", type=int, default=100000)
+    parser.add_argument(
+        "--skip_validation",
+        action="store_true",
+        help="Skip the FASTQ record structure check done while parsing.",
+    )
+    args = parser.parse_args(argv)
+    try:
+        locator = FlankLocator(
+            args.upstream, args.downstream, args.barcode_length, args.mismatch
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    barcodes = Counter()
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output.with_name(f"{args.output.stem}_stat.txt"), "w") as s:
+        for fastq_file in args.files:
+            file_barcodes, stats = discover_barcodes(
+                fastq_file,
+                locator,
+                chunk_size=args.chunk_size,
+                n_jobs=args.multicore or os.cpu_count(),
+                validate=not args.skip_validation,
+            )
+            barcodes.update(file_barcodes)
+            s.write(f"File: {fastq_file.name}\n")
+            total_read, detected = stats.pop("Total read", 0), stats.pop(
+                "Detected read", 0
+            )
+            s.write(f"Total read: {total_read}\n")
+            s.write(f"Detected read: {detected}\n")
+            s.write(
+                f"Detection rate in the sequence pool: {detected / max(total_read, 1)}\n"
+            )
+            for key, value in stats.items():
+                s.write(f"{key}: {value}\n")
+            s.write(f"Unique barcodes: {len(file_barcodes)}\n")
+
+    df = barcode_library(barcodes, min_reads=args.min_reads)
+    write_barcode_library(df, args.output, sep=args.sep)
+    df.to_csv(args.output.with_name(f"{args.output.stem}_counts.csv"), index=False)
+    print(
+        f"{df.shape[0]} barcodes of {len(barcodes)} discovered written to {args.output}"
+    )
+
+
+# Maintenance commands, given as the first argument; the extraction is the default
+COMMANDS = {"cache": cache_main, "separate": separate_main, "discover": discover_main}
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         prog="extractor_SKKUGE",
         description="Counting sequence reads for each barcode from NGS rawdata, tested on Python v3.9 (tentative)",
@@ -54,7 +300,40 @@ def main():
         "--verbose",
         dest="verbose",
         action="store_true",
-        help="unique mutation test",
+        help="unique mutation test: multiple detection reports built from the audit tables",
+    )
+    parser.add_argument(
+        "--concurrent_samples",
+        default=2,
+        type=int,
+        dest="concurrent_samples",
+        help="Number of samples whose chunks share the worker pool at a time. Default is 2.",
+    )
+    parser.add_argument(
+        "--shared_index",
+        dest="shared_index",
+        action="store_true",
+        help="Scan the reads of a sample once for all the barcode files listed for it in the project file, the results are still written per barcode file.",
+    )
+    parser.add_argument(
+        "--restart",
+        dest="restart",
+        action="store_true",
+        help="Ignore the checkpoints: extract every sample again instead of resuming the interrupted ones and skipping the completed ones.",
+    )
+    parser.add_argument(
+        "--result_cache_mb",
+        default=1024,
+        type=float,
+        dest="result_cache_mb",
+        help="Size limit of the result cache, which returns the results of an unchanged FASTQ file, barcode file and matching parameters without extracting them again. 0 disables it. Default is 1024. See 'run_extractor.py cache -h'.",
+    )
+    parser.add_argument(
+        "--fingerprint",
+        dest="fingerprint",
+        choices=FINGERPRINT_METHODS,
+        default="sampled",
+        help="How an unchanged FASTQ file is recognized by the result cache and the checkpoints. 'sampled' hashes the size, modification time and inode of the file with 17 blocks of 64 KB, 'full' hashes the whole file, which takes a read of it but survives a copy. Default is 'sampled'.",
     )
     parser.add_argument(
         "--separator",
@@ -63,9 +342,260 @@ def main():
         help="Separator character for the barcode file. Default is ':'.",
         default=":",
     )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        type=str,
+        choices=["aho-corasick", "vectorized", "position", "contains"],
+        default="aho-corasick",
+        help="Barcode matching engine. 'aho-corasick' scans each read once for all barcodes, 'vectorized' looks up every k-mer of a read batch at once with NumPy (ACGTN barcodes of up to 21 bases), 'position' looks up the barcode window given by --barcode_offset or --anchors, 'contains' is the legacy per-barcode search. Default is 'aho-corasick'.",
+    )
+    parser.add_argument(
+        "--barcode_offset",
+        dest="barcode_offset",
+        type=int,
+        default=None,
+        help="0-based position of the barcode in the read, used by the 'position' engine.",
+    )
+    parser.add_argument(
+        "--anchors",
+        dest="anchors",
+        type=str,
+        default=None,
+        help="Constant regions flanking the barcode as 'UPSTREAM,DOWNSTREAM', either side may be empty. Used by the 'position' engine.",
+    )
+
+    parser.add_argument(
+        "--mismatch",
+        dest="mismatch",
+        type=int,
+        choices=[0, 1, 2],
+        default=0,
+        help="Number of mismatches tolerated in a barcode, not supported by the 'contains' engine. Default is 0.",
+    )
+
+    parser.add_argument(
+        "--strand",
+        dest="strand",
+        choices=["forward", "reverse", "both"],
+        default="forward",
+        help="Read strand the barcodes are matched on. 'reverse' takes R2 reads as they are, without reverse complementing them first, 'both' matches either orientation. Not supported by the 'contains' engine, nor 'both' by the 'position' engine. Default is 'forward'.",
+    )
+
+    parser.add_argument(
+        "--merge",
+        dest="merge",
+        choices=["off", "auto", "flash", "python"],
+        default="off",
+        help="Merge the read pair of a sample folder ({name}_1/{name}_2 or {name}_R1/{name}_R2 FASTQ files) before the extraction. 'flash' streams the merged reads of FLASH into the extraction, 'python' merges the pairs in the worker processes, 'auto' uses FLASH when it is found. Default is 'off', the first FASTQ file is extracted.",
+    )
+    parser.add_argument(
+        "--flash",
+        dest="flash",
+        default="flash",
+        help="FLASH executable. Default is 'flash', searched in the PATH.",
+    )
+    parser.add_argument(
+        "--merge_jobs",
+        dest="merge_jobs",
+        type=int,
+        default=2,
+        help="Number of FLASH processes run at a time. Default is 2.",
+    )
+    parser.add_argument(
+        "--merge_min_overlap",
+        dest="merge_min_overlap",
+        type=int,
+        default=10,
+        help="Minimum overlap of the mates, FLASH -m. Default is 10.",
+    )
+    parser.add_argument(
+        "--merge_max_overlap",
+        dest="merge_max_overlap",
+        type=int,
+        default=65,
+        help="Overlap length the mismatch density is computed over, FLASH -M. Default is 65.",
+    )
+    parser.add_argument(
+        "--merge_mismatch_density",
+        dest="merge_mismatch_density",
+        type=float,
+        default=0.25,
+        help="Maximum mismatch density of the overlap, FLASH -x. Default is 0.25.",
+    )
+
+    parser.add_argument(
+        "--trim_quality",
+        dest="trim_quality",
+        type=int,
+        default=None,
+        help="Trim the 3' end of the reads down to the last base of at least this Phred quality, before matching.",
+    )
+    parser.add_argument(
+        "--min_mean_quality",
+        dest="min_mean_quality",
+        type=float,
+        default=None,
+        help="Drop the reads whose mean Phred quality is below this, before matching.",
+    )
+    parser.add_argument(
+        "--min_window_quality",
+        dest="min_window_quality",
+        type=int,
+        default=None,
+        help="Drop the reads with a base below this Phred quality in the barcode window, before matching. The window is --quality_window, or the barcode at --barcode_offset.",
+    )
+    parser.add_argument(
+        "--quality_window",
+        dest="quality_window",
+        type=str,
+        default=None,
+        help="Barcode window of --min_window_quality as 'START,END', 0-based and END excluded.",
+    )
+    parser.add_argument(
+        "--max_n",
+        dest="max_n",
+        type=int,
+        default=None,
+        help="Drop the reads with more N bases than this, before matching.",
+    )
+
+    parser.add_argument(
+        "--collapse",
+        dest="collapse",
+        action="store_true",
+        help="Match every distinct read sequence once, the identical reads share its result. 'aho-corasick' and 'vectorized' engines, without the audit tables.",
+    )
+    parser.add_argument(
+        "--collapse_cache",
+        dest="collapse_cache",
+        type=int,
+        default=1 << 18,
+        help="Read sequences every worker remembers across its chunks with --collapse, the less abundant half is dropped when it is full. 0 collapses the reads of a batch only. Default is 262144.",
+    )
+    parser.add_argument(
+        "--umi",
+        dest="umi",
+        choices=["off", "position", "header"],
+        default="off",
+        help="Also count the unique UMIs of every barcode. 'position' reads the UMI at --umi_offset, 'header' takes the last ':' or '_' separated field of the read ID. Default is 'off'.",
+    )
+    parser.add_argument(
+        "--umi_offset",
+        dest="umi_offset",
+        type=int,
+        default=0,
+        help="0-based position of the UMI in the read. Default is 0.",
+    )
+    parser.add_argument(
+        "--umi_length",
+        dest="umi_length",
+        type=int,
+        default=8,
+        help="Length of the UMI in the read, at most 16. Default is 8.",
+    )
+    parser.add_argument(
+        "--umi_sketch",
+        dest="umi_sketch",
+        choices=["set", "hll"],
+        default="set",
+        help="'set' counts the unique UMIs exactly, 'hll' estimates them with a HyperLogLog sketch of fixed memory per barcode. Default is 'set'.",
+    )
+    parser.add_argument(
+        "--umi_precision",
+        dest="umi_precision",
+        type=int,
+        default=10,
+        help="HyperLogLog registers per barcode as a power of 2, from 4 to 16. Default is 10, about 3%% error.",
+    )
+    parser.add_argument(
+        "--umi_mismatch",
+        dest="umi_mismatch",
+        type=int,
+        choices=[0, 1],
+        default=0,
+        help="Collapse a UMI into a UMI one mismatch away with at least 2n - 1 reads, n being its own, as sequencing errors, and every chain of them into its top UMI, as the directional method of UMI-tools. 'set' sketch only. Default is 0.",
+    )
+
+    parser.add_argument(
+        "--skip_validation",
+        dest="skip_validation",
+        action="store_true",
+        help="Skip the FASTQ record structure check done while parsing.",
+    )
+
+    parser.add_argument(
+        "--audit",
+        dest="audit",
+        action="store_true",
+        help="Write the per-read barcode hits of every chunk as memory-mappable Arrow tables for auditing.",
+    )
+    parser.add_argument(
+        "--audit_ids",
+        dest="audit_ids",
+        action="store_true",
+        help="Keep the read IDs in the audit tables, dictionary-encoded.",
+    )
+
+    parser.add_argument(
+        "--detection_bitmap",
+        dest="detection_bitmap",
+        action="store_true",
+        help="Also write the per-read detection array of every sample as a NumPy bool array, in the read order. The read statistics do not need it.",
+    )
 
     args = parser.parse_args()
 
+    if args.engine == "position" and args.barcode_offset is None and not args.anchors:
+        parser.error("--engine position requires --barcode_offset or --anchors")
+    if args.engine == "contains" and args.mismatch > 0:
+        parser.error("--mismatch is not supported by --engine contains")
+    if args.engine == "contains" and args.shared_index:
+        parser.error("--shared_index is not supported by --engine contains")
+    if args.engine == "contains" and args.strand != "forward":
+        parser.error("--strand is not supported by --engine contains")
+    if args.engine == "position" and args.strand == "both":
+        # The window of a reverse read is not at the offset or between the anchors of
+        # a forward one
+        parser.error("--engine position cannot locate the barcode on both strands")
+    if args.merge == "flash" and shutil.which(args.flash) is None:
+        parser.error(f"--merge flash: {args.flash} is not found")
+    if args.merge_min_overlap < 1 or args.merge_max_overlap < args.merge_min_overlap:
+        parser.error("--merge_max_overlap must be at least --merge_min_overlap >= 1")
+    if args.quality_window is not None:
+        try:
+            args.quality_window = [int(pos) for pos in args.quality_window.split(",")]
+        except ValueError:
+            args.quality_window = None
+        if args.quality_window is None or len(args.quality_window) != 2:
+            parser.error("--quality_window must be 'START,END'")
+    if (
+        args.min_window_quality is not None
+        and args.quality_window is None
+        and args.barcode_offset is None
+    ):
+        parser.error(
+            "--min_window_quality requires --quality_window or --barcode_offset"
+        )
+    if args.umi != "off" and args.engine == "contains":
+        parser.error("--umi is not supported by --engine contains")
+    if not 1 <= args.umi_length <= 16:
+        parser.error("--umi_length must be from 1 to 16")
+    if not 4 <= args.umi_precision <= 16:
+        parser.error("--umi_precision must be from 4 to 16")
+    if args.umi_sketch == "hll" and args.umi_mismatch > 0:
+        parser.error("--umi_mismatch requires --umi_sketch set")
+    # The multiple detection reports are built from the audit tables
+    args.audit = args.audit or args.verbose
+    if args.collapse and args.engine not in COLLAPSED_ENGINES:
+        parser.error(f"--collapse is not supported by --engine {args.engine}")
+    if args.collapse and args.audit:
+        parser.error("--collapse is not supported with the audit tables")
+    if args.collapse_cache < 0:
+        parser.error("--collapse_cache must not be negative")
+    # "UPSTREAM" alone is accepted as an upstream-only anchor
+    args.anchors = tuple((args.anchors or "").upper().split(",") + [""])[:2]
+
     system_structure = SystemStructure(args.user_name, args.project_name)
 
     # Prepare logger
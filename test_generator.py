@@ -1,10 +1,160 @@
-with open("test_barcode.txt", mode='w') as barcode, open("sequence.fastq", mode='w') as seq:
-    nt = ['A', 'T', 'G', 'C']
+#!/usr/bin/env python
+import argparse
+import gzip
+import pathlib
 
-    for n in nt:
-        for i in range(10000000):
-            seq.write(f"{n * 300}\n")
+import numpy as np
 
-    for n in nt:
-        barcode.write(f"{n}:{n}\n")
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+BLOCK_SIZE = 100000  # Reads generated at once
 
+
+def generate_barcodes(n_barcodes: int, length: int, rng) -> list:
+    """
+    > Draw unique random barcodes
+
+    :param n_barcodes: the number of barcodes
+    :param length: the barcode length
+    :param rng: a numpy random Generator
+    :return: A list of n_barcodes distinct ACGT strings
+    """
+    if 4**length < n_barcodes:
+        raise ValueError(f"{n_barcodes} barcodes do not fit in {length} bases")
+
+    barcodes = {}
+    while len(barcodes) < n_barcodes:
+        for codes in rng.integers(0, 4, (n_barcodes, length), dtype=np.uint8):
+            barcodes.setdefault(BASES[codes].tobytes().decode(), None)
+            if len(barcodes) == n_barcodes:
+                break
+    return list(barcodes)
+
+
+def write_barcode_file(barcode_file: pathlib.Path, barcodes: list, sep=":"):
+    with open(barcode_file, "w") as f:
+        for idx, barcode in enumerate(barcodes):
+            f.write(f"gene{idx}{sep}{barcode}\n")
+
+
+def generate_fastq(
+    fastq_file: pathlib.Path,
+    barcodes: list,
+    n_reads: int,
+    read_length=150,
+    hit_rate=0.8,
+    error_rate=0.001,
+    offset=20,
+    upstream="",
+    downstream="",
+    seed=0,
+) -> np.ndarray:
+    """
+    > Write random reads, a hit_rate fraction of them carrying a barcode at offset
+
+    The barcode is inserted between the upstream and downstream constant regions, then
+    every base of the read is substituted with probability error_rate.
+
+    :param fastq_file: the FASTQ file, gzip compressed when it ends with .gz
+    :param barcodes: the barcode library, all barcodes of the same length
+    :param n_reads: the number of reads
+    :param read_length: the read length
+    :param hit_rate: the fraction of reads carrying a barcode
+    :param error_rate: the per-base substitution rate
+    :param offset: the position of the upstream region, then of the barcode
+    :param upstream: the constant region before the barcode
+    :param downstream: the constant region after the barcode
+    :param seed: the seed of the random generator
+    :return: The number of reads generated for each barcode, before the errors
+    """
+    rng = np.random.default_rng(seed)
+    codes = {base: code for code, base in enumerate("ACGT")}
+    library = np.array(
+        [
+            [codes[base] for base in upstream + barcode + downstream]
+            for barcode in barcodes
+        ],
+        dtype=np.uint8,
+    )
+    if offset + library.shape[1] > read_length:
+        raise ValueError("The barcode and its constant regions do not fit in the read")
+
+    truth = np.zeros(len(barcodes), dtype=np.int64)
+    opener = gzip.open if str(fastq_file).endswith(".gz") else open
+    with opener(fastq_file, "wb") as f:
+        for first in range(0, n_reads, BLOCK_SIZE):
+            n_block = min(BLOCK_SIZE, n_reads - first)
+            reads = rng.integers(0, 4, (n_block, read_length), dtype=np.uint8)
+
+            hits = np.flatnonzero(rng.random(n_block) < hit_rate)
+            chosen = rng.integers(0, len(barcodes), hits.shape[0])
+            reads[hits, offset : offset + library.shape[1]] = library[chosen]
+            truth += np.bincount(chosen, minlength=len(barcodes))
+
+            # Substitution to one of the 3 other bases
+            errors = rng.random(reads.shape) < error_rate
+            reads[errors] = (reads[errors] + rng.integers(1, 4, errors.sum())) % 4
+
+            sequences = BASES[reads]
+            qualities = rng.integers(33 + 25, 33 + 41, reads.shape, dtype=np.uint8)
+            f.write(
+                b"".join(
+                    b"@synthetic:%d 1:N:0:1\n%s\n+\n%s\n"
+                    % (first + n, seq.tobytes(), qual.tobytes())
+                    for n, (seq, qual) in enumerate(zip(sequences, qualities))
+                )
+            )
+
+    return truth
+
+
+def reads_for_size(size_mb: float, read_length: int) -> int:
+    # Approximate number of uncompressed records in size_mb
+    record_size = len("@synthetic:10000000 1:N:0:1\n+\n") + 2 * (read_length + 1)
+    return max(int(size_mb * (1 << 20) / record_size), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Synthetic barcode library and FASTQ file for testing the extractor"
+    )
+    parser.add_argument("-o", "--output", type=pathlib.Path, default=pathlib.Path("."))
+    parser.add_argument("--barcodes", type=int, default=1000, help="Barcode count")
+    parser.add_argument("--barcode_length", type=int, default=20)
+    parser.add_argument("--reads", type=int, default=100000)
+    parser.add_argument(
+        "--size_mb", type=float, default=None, help="Overrides --reads, uncompressed"
+    )
+    parser.add_argument("--read_length", type=int, default=150)
+    parser.add_argument("--hit_rate", type=float, default=0.8)
+    parser.add_argument("--error_rate", type=float, default=0.001)
+    parser.add_argument("--offset", type=int, default=20)
+    parser.add_argument("--upstream", type=str, default="")
+    parser.add_argument("--downstream", type=str, default="")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    barcodes = generate_barcodes(args.barcodes, args.barcode_length, rng)
+    write_barcode_file(args.output / "test_barcode.txt", barcodes)
+
+    n_reads = (
+        reads_for_size(args.size_mb, args.read_length) if args.size_mb else args.reads
+    )
+    generate_fastq(
+        args.output / ("sequence.fastq.gz" if args.gzip else "sequence.fastq"),
+        barcodes,
+        n_reads,
+        args.read_length,
+        args.hit_rate,
+        args.error_rate,
+        args.offset,
+        args.upstream.upper(),
+        args.downstream.upper(),
+        args.seed + 1,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import random
+
+import numpy as np
+import pandas as pd
+
+from Core.BarcodeMatcher import BarcodeIndex
+from Core.Checkpoint import Checkpoint
+from Core.FastqIO import plan_chunks
+from extractor import extract_read_cnts
+
+HEADER = {"input_file": "reads.fastq", "chunk_size": 50}
+
+
+def _library(tmp_path):
+    rng = random.Random(0)
+    barcodes = ["".join(rng.choice("ACGT") for _ in range(10)) for _ in range(5)]
+    with open(tmp_path / "reads.fastq", "w") as f:
+        for read in range(500):
+            seq = "".join(rng.choice("ACGT") for _ in range(8)) + rng.choice(barcodes)
+            f.write(f"@read{read}\n{seq}\n+\n{'I' * len(seq)}\n")
+    barcode_df = pd.DataFrame({"Gene": list("abcde"), "Barcode": barcodes})
+    return plan_chunks(tmp_path / "reads.fastq", 50), BarcodeIndex(barcode_df)
+
+
+def _open(tmp_path, header=HEADER):
+    return Checkpoint(tmp_path / "checkpoint.jsonl", tmp_path / "chunks", header)
+
+
+def test_resume_extracts_only_the_missing_chunks(tmp_path):
+    chunks, barcode_index = _library(tmp_path)
+    full = sum(
+        extract_read_cnts(chunk, barcode_index, str(tmp_path))[0] for chunk in chunks
+    )
+
+    checkpoint = _open(tmp_path)
+    assert not checkpoint.valid
+    checkpoint.reset()
+    for chunk in chunks[:4]:
+        result = extract_read_cnts(chunk, barcode_index, str(tmp_path))
+        checkpoint.save_chunk(chunk.name, result, reads=result[1].total)
+    # Killed while the manifest line of the next chunk was written
+    with open(checkpoint.manifest_file, "a") as f:
+        f.write('{"chunk": "' + chunks[4].name)
+
+    resumed = _open(tmp_path)
+    assert resumed.valid
+    assert sorted(resumed.chunks) == sorted(chunk.name for chunk in chunks[:4])
+    read_counts, extracted = 0, []
+    for chunk in chunks:
+        result = resumed.load_chunk(chunk.name)
+        if result is None:
+            result = extract_read_cnts(chunk, barcode_index, str(tmp_path))
+            resumed.save_chunk(chunk.name, result, reads=result[1].total)
+            extracted.append(chunk.name)
+        read_counts = read_counts + result[0]
+    assert extracted == [chunk.name for chunk in chunks[4:]]
+    assert np.array_equal(read_counts, full)
+    # The truncated line was dropped before the new records were appended
+    assert len(_open(tmp_path).chunks) == len(chunks)
+
+
+def test_outputs_complete_the_sample(tmp_path):
+    checkpoint = _open(tmp_path)
+    checkpoint.reset()
+    output = tmp_path / "result.csv"
+    output.write_text("Gene,Barcode\n")
+    checkpoint.finish([output])
+
+    assert _open(tmp_path).completed
+    assert not (tmp_path / "chunks").exists()
+    output.write_text("Gene,Barcode\na,ACGT\n")
+    assert not _open(tmp_path).completed
+
+
+def test_other_inputs_invalidate_the_checkpoint(tmp_path):
+    checkpoint = _open(tmp_path)
+    checkpoint.reset()
+    checkpoint.save_chunk("reads.fastq+0", "result")
+
+    other = _open(tmp_path, {**HEADER, "chunk_size": 100})
+    assert not other.valid
+    assert other.load_chunk("reads.fastq+0") is None
@@ -0,0 +1,122 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Core.BarcodeMatcher import BarcodeIndex, reverse_complement
+from Core.FastqIO import plan_chunks
+from extractor import extract_read_cnts
+
+N_BARCODES = 20
+BARCODE_LENGTH = 16
+OFFSET = 10
+
+
+def _random_seq(rng, length: int) -> str:
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def _mutate(rng, barcode: str) -> str:
+    # One substitution, never back to the barcode base
+    pos = rng.randrange(len(barcode))
+    base = rng.choice([base for base in "ACGT" if base != barcode[pos]])
+    return barcode[:pos] + base + barcode[pos + 1 :]
+
+
+@pytest.fixture(scope="module")
+def barcode_df():
+    rng = random.Random(0)
+    barcodes = list(
+        dict.fromkeys(_random_seq(rng, BARCODE_LENGTH) for _ in range(N_BARCODES))
+    )
+    return pd.DataFrame(
+        {"Gene": [f"g{idx}" for idx in range(len(barcodes))], "Barcode": barcodes}
+    )
+
+
+def _write_library(tmp_path, barcode_df, mismatch=False, reverse=False):
+    # Reads holding one barcode at OFFSET, a tenth of them holding none; returns the
+    # FASTQ chunk and the expected read count of every barcode
+    rng = random.Random(1)
+    barcodes = barcode_df["Barcode"].tolist()
+    expected = np.zeros(len(barcodes), dtype=np.int64)
+    fastq_file = tmp_path / "reads.fastq"
+    with open(fastq_file, "w") as f:
+        for read in range(2000):
+            if read % 10 == 0:
+                window = _random_seq(rng, BARCODE_LENGTH)
+            else:
+                idx = rng.randrange(len(barcodes))
+                expected[idx] += 1
+                window = barcodes[idx]
+                if mismatch and read % 3 == 0:
+                    window = _mutate(rng, window)
+            seq = _random_seq(rng, OFFSET) + window + _random_seq(rng, 28)
+            if reverse and read % 2 == 0:
+                seq = reverse_complement(seq)
+            f.write(f"@read{read}\n{seq}\n+\n{'I' * len(seq)}\n")
+
+    (chunk,) = plan_chunks(fastq_file, 10000)
+    return chunk, expected
+
+
+def _read_counts(chunk, barcode_df, tmp_path, **index_options):
+    barcode_index = BarcodeIndex(barcode_df, **index_options)
+    read_counts, summary, read_stats, _ = extract_read_cnts(
+        chunk, barcode_index, str(tmp_path)
+    )
+    return read_counts
+
+
+def test_engines_agree_on_exact_matches(tmp_path, barcode_df):
+    chunk, expected = _write_library(tmp_path, barcode_df)
+
+    for engine in ["aho-corasick", "vectorized", "contains"]:
+        read_counts = _read_counts(chunk, barcode_df, tmp_path, engine=engine)
+        assert read_counts.tolist() == expected.tolist(), engine
+    read_counts = _read_counts(
+        chunk, barcode_df, tmp_path, engine="position", barcode_offset=OFFSET
+    )
+    assert read_counts.tolist() == expected.tolist()
+
+
+def test_engines_agree_with_mismatches(tmp_path, barcode_df):
+    chunk, expected = _write_library(tmp_path, barcode_df, mismatch=True)
+
+    exact = _read_counts(chunk, barcode_df, tmp_path, engine="contains")
+    assert exact.sum() < expected.sum()
+    for engine in ["aho-corasick", "vectorized"]:
+        read_counts = _read_counts(
+            chunk, barcode_df, tmp_path, engine=engine, max_mismatch=1
+        )
+        assert read_counts.tolist() == expected.tolist(), engine
+
+
+@pytest.mark.parametrize("mismatch", [0, 1])
+def test_engines_agree_on_both_strands(tmp_path, barcode_df, mismatch):
+    chunk, expected = _write_library(
+        tmp_path, barcode_df, mismatch=mismatch > 0, reverse=True
+    )
+
+    for engine in ["aho-corasick", "vectorized"]:
+        forward = _read_counts(
+            chunk, barcode_df, tmp_path, engine=engine, max_mismatch=mismatch
+        )
+        assert forward.sum() < expected.sum()
+        read_counts = _read_counts(
+            chunk,
+            barcode_df,
+            tmp_path,
+            engine=engine,
+            max_mismatch=mismatch,
+            strand="both",
+        )
+        assert read_counts.tolist() == expected.tolist(), engine
+
+
+def test_position_engine_rejects_both_strands(barcode_df):
+    with pytest.raises(ValueError):
+        BarcodeIndex(
+            barcode_df, engine="position", barcode_offset=OFFSET, strand="both"
+        )
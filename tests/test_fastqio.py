@@ -0,0 +1,97 @@
+import gzip
+import os
+import random
+import struct
+import zlib
+
+import pytest
+
+from Core.FastqIO import compression_of, fastq_fingerprint, plan_chunks
+
+
+def _records(n_reads: int) -> list:
+    rng = random.Random(0)
+    records = []
+    for read in range(n_reads):
+        seq = "".join(rng.choice("ACGT") for _ in range(rng.randint(20, 60)))
+        records.append((f"read{read}", seq))
+    return records
+
+
+def _fastq_bytes(records: list) -> bytes:
+    return "".join(
+        f"@{read_id}\n{seq}\n+\n{'I' * len(seq)}\n" for read_id, seq in records
+    ).encode("ascii")
+
+
+def _bgzf_block(data: bytes) -> bytes:
+    # A gzip member with the BC extra field holding its size, as written by bgzip
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    header = (
+        b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff"
+        + struct.pack("<H", 6)
+        + b"BC"
+        + struct.pack("<HH", 2, len(payload) + 25)
+    )
+    return header + payload + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def _write(fastq_file, data: bytes, compression: str):
+    if compression == "gzip":
+        with gzip.open(fastq_file, "wb") as f:
+            f.write(data)
+    elif compression == "bgzf":
+        # Small blocks of random sizes, so the records straddle the blocks
+        rng = random.Random(1)
+        with open(fastq_file, "wb") as f:
+            pos = 0
+            while pos < len(data):
+                size = rng.randint(1, 700)
+                f.write(_bgzf_block(data[pos : pos + size]))
+                pos += size
+            f.write(_bgzf_block(b""))
+    else:
+        fastq_file.write_bytes(data)
+
+
+@pytest.mark.parametrize("compression", ["plain", "bgzf", "gzip"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1000])
+def test_chunks_hold_every_read_once(tmp_path, compression, chunk_size):
+    records = _records(300)
+    fastq_file = tmp_path / ("reads.fastq" if compression == "plain" else "reads.fq.gz")
+    _write(fastq_file, _fastq_bytes(records), compression)
+    assert compression_of(fastq_file) == compression
+
+    chunks = list(plan_chunks(fastq_file, chunk_size))
+    reads = [
+        (read_id, seq)
+        for chunk in chunks
+        for batch in chunk.open(batch_size=5)
+        for read_id, seq in zip(batch.ids, batch.sequences)
+    ]
+    assert reads == records
+    assert len({chunk.name for chunk in chunks}) == len(chunks)
+    if chunk_size < len(records):
+        assert len(chunks) > 1
+
+
+def test_fingerprint_methods(tmp_path):
+    fastq_file = tmp_path / "reads.fastq"
+    data = _fastq_bytes(_records(20000))
+    fastq_file.write_bytes(data)
+    sampled = fastq_fingerprint(fastq_file)
+    full = fastq_fingerprint(fastq_file, "full")
+
+    # Touched: the sampled fingerprint follows the modification time
+    stat = os.stat(fastq_file)
+    os.utime(fastq_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert fastq_fingerprint(fastq_file) != sampled
+    assert fastq_fingerprint(fastq_file, "full") == full
+
+    # Edited in place, keeping the size and the modification time
+    middle = len(data) // 32
+    edited = data[:middle] + bytes([data[middle] ^ 1]) + data[middle + 1 :]
+    fastq_file.write_bytes(edited)
+    os.utime(fastq_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert fastq_fingerprint(fastq_file, "full") != full
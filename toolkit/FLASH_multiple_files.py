@@ -1,6 +1,9 @@
 import subprocess
 import shlex
 
+# The extraction merges the read pair of a sample folder itself, FLASH output streamed
+# into the chunks: python run_extractor.py -u {user} -p {project} --merge flash
+
 # example_cmd = "/flash HKK_220314__10_1.fastq.gz HKK_220314__10_2.fastq.gz -M 400 -m 10 -O -o 0314_10"
 
 DATE = "20230109"  # YYYYMMDD